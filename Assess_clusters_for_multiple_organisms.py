@@ -128,7 +128,7 @@ def write_to_file(outfile, multiples, pathways_dict):
 		outfl.write(header)
 		#iterate
 		for method in multiples:
-			print method
+			print(method)
 			#iterate
 			for cluster in multiples[method]:
 				#add organisms
@@ -8,6 +8,10 @@ set the_organism = `basename $organism`
 set workdir = $3 #directory for writing results
 set reference_db = $4 #directory with genome in fasta format
 set pathways = $5 #KEGG pathways .list file for the organism
+set workers = 1 #number of processes for simulations, optional sixth argument
+if ($#argv >= 6) set workers = $6
+set seed = 10 #seed of the simulations, optional seventh argument, seeded null distributions are cached in null_cache of the workdir
+if ($#argv >= 7) set seed = $7
 #results dir
 mkdir -p $workdir/high/${the_organism}
 mkdir -p $workdir/changed/${the_organism}
@@ -34,8 +38,8 @@ echo $the_organism > $workdir/changed/${the_organism}/significant_genes_metaboli
 echo $the_organism > $workdir/high/${the_organism}/significant_genes_metabolics_only.txt
 
 #run regular mode
-python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $high_vector -w $workdir/high/${the_organism}/ >> $workdir/high/${the_organism}/significant_genes.txt
-python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $changed_vector -w $workdir/changed/${the_organism}/ >> $workdir/changed/${the_organism}/significant_genes.txt
+python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $high_vector -w $workdir/high/${the_organism}/ --workers $workers --seed $seed >> $workdir/high/${the_organism}/significant_genes.txt
+python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $changed_vector -w $workdir/changed/${the_organism}/ --workers $workers --seed $seed >> $workdir/changed/${the_organism}/significant_genes.txt
 #run metabolic only mode
-python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $high_vector -w $workdir/high/${the_organism}/ --metabolic >> $workdir/high/${the_organism}/significant_genes_metabolic_only.txt
-python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $changed_vector -w $workdir/changed/${the_organism}/ --metabolic >> $workdir/changed/${the_organism}/significant_genes_metabolics_only.txt
+python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $high_vector -w $workdir/high/${the_organism}/ --workers $workers --seed $seed --metabolic >> $workdir/high/${the_organism}/significant_genes_metabolic_only.txt
+python $BINDIR/bin/Clustering/enrichment.py -d $reference_db -k $pathways -l $changed_vector -w $workdir/changed/${the_organism}/ --workers $workers --seed $seed --metabolic >> $workdir/changed/${the_organism}/significant_genes_metabolics_only.txt
@@ -14,7 +14,7 @@ def correct_multiple_hypotheses(p_value_dict, alpha=0.05):
 	#initialize adjusted p values dict
 	padjust_dict = {}
 	#run multiple hypothesis correction in python using the Benjamini-Hochberg method
-	truths, padjust, correctedp1, correctedp2 = multipletests(p_value_dict.values(), alpha*2, method = 'fdr_bh')
+	truths, padjust, correctedp1, correctedp2 = multipletests(list(p_value_dict.values()), alpha*2, method = 'fdr_bh')
 	#define p_adjust dict
 	for index, pathway in enumerate(p_value_dict.keys()):
 		padjust_dict[pathway] = padjust[index]
@@ -4,6 +4,7 @@
 This script recieves a list of clusters and Table S2, and assess if any cluster is enriched in any properties
 """
 
+from __future__ import print_function
 import sys, os
 import argparse
 import csv
@@ -11,6 +12,7 @@ import numpy as np
 from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 import itertools
+import instrumentation
 
 class Patient(object):
     """
@@ -47,6 +49,14 @@ def process_command_line(argv):
         '-c', '--clusters',
         help='Clusters for enrichment, output of metabolic_clustering.py or go_clustering.py.')
     
+    parser.add_argument(
+        '--profile', action='store_true', default=False,
+        help='Write cProfile stats of each stage next to the timing report.')
+
+    parser.add_argument(
+        '--trace_memory', action='store_true', default=False,
+        help='Record peak traced memory of each stage in the timing report, slows the run.')
+
     parser.add_argument(# customized description; put --help last
         '-h', '--help', action='help',
         help='Show this help message and exit.')
@@ -180,7 +190,7 @@ def cluster_enrichment(clusters, database, patients):
                     t = general_dict[possibility] - x
                     #how many outside the cluster did not come from the tissue
                     n = general[category] -(x + y + t)
-                    if cluster == "15" and method == "gmm_numeric" and category == "conditions" and possibility == "adult icu": print x, y, t, n
+                    if cluster == "15" and method == "gmm_numeric" and category == "conditions" and possibility == "adult icu": print(x, y, t, n)
                     continue
                     #run fisher's exact test
                     od, p = fisher_exact(np.array(([x,y],[t,n])), alternative="greater")
@@ -266,14 +276,16 @@ def write_to_file(outfile, enriched_clusters):
 def main(argv=None):
     #process command line
     settings = process_command_line(argv)
-    #parse clusters
-    clusters, patients = parse_clusters(settings.clusters)
-    #parse database properties of relevant patients
-    database = parse_database(settings.database, patients)
-    #check enrichment
-    enriched_clusters = cluster_enrichment(clusters, database, patients)
-    #correct for multiple hypotheses
-    enriched_clusters = correct_clusters(enriched_clusters)
+    #record stages next to the outfile
+    with instrumentation.recording(os.path.splitext(settings.outfile)[0] + "_report.json", settings.profile, settings.trace_memory):
+        #parse clusters
+        with instrumentation.stage("parse_clusters"): clusters, patients = parse_clusters(settings.clusters)
+        #parse database properties of relevant patients
+        with instrumentation.stage("parse_database", patients=len(patients)): database = parse_database(settings.database, patients)
+        #check enrichment
+        with instrumentation.stage("cluster_enrichment"): enriched_clusters = cluster_enrichment(clusters, database, patients)
+        #correct for multiple hypotheses
+        with instrumentation.stage("correct_clusters"): enriched_clusters = correct_clusters(enriched_clusters)
     exit()
     #write to file
     write_to_file(settings.outfile, enriched_clusters)
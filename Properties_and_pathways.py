@@ -8,6 +8,7 @@ Also stringent files with clusters with treatments and not references
 import sys, os
 import argparse
 import errno
+import instrumentation
 from Assess_clusters_for_multiple_organisms import parse_clusters
 
 class Cluster(object):
@@ -47,6 +48,14 @@ def process_command_line(argv):
 		'-w', '--workdir', default="./temp/",
 		help='Workdir where results will be written.')
 	
+	parser.add_argument(
+		'--profile', action='store_true', default=False,
+		help='Write cProfile stats of each stage next to the timing report.')
+
+	parser.add_argument(
+		'--trace_memory', action='store_true', default=False,
+		help='Record peak traced memory of each stage in the timing report, slows the run.')
+	
 	parser.add_argument(# customized description; put --help last
 		'-h', '--help', action='help',
 		help='Show this help message and exit.')
@@ -142,14 +151,16 @@ def main(argv=None):
 	settings = process_command_line(argv)
 	#create workdir
 	mkdir(settings.workdir)
-	#parse clusters
-	clusters, pathways = parse_clusters(settings.clusters, {})
-	#parse properties
-	properties = parse_properties(settings.cluster_properties)
-	#get cluster objects
-	cluster_objects, stringent_cluster_objects, super_stringent_cluster_objects = get_cluster_objects(pathways, properties)
-	#write to files
-	write_to_files(settings.workdir, cluster_objects, stringent_cluster_objects, super_stringent_cluster_objects)
+	#record stages in workdir
+	with instrumentation.recording(os.path.join(settings.workdir, "properties_and_pathways_report.json"), settings.profile, settings.trace_memory):
+		#parse clusters
+		with instrumentation.stage("parse_clusters"): clusters, pathways = parse_clusters(settings.clusters, {})
+		#parse properties
+		with instrumentation.stage("parse_properties"): properties = parse_properties(settings.cluster_properties)
+		#get cluster objects
+		with instrumentation.stage("get_cluster_objects"): cluster_objects, stringent_cluster_objects, super_stringent_cluster_objects = get_cluster_objects(pathways, properties)
+		#write to files
+		with instrumentation.stage("write_to_files"): write_to_files(settings.workdir, cluster_objects, stringent_cluster_objects, super_stringent_cluster_objects)
 	
 if __name__ == "__main__":
 		exit(main())
\ No newline at end of file
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Assign new patients of a single species to the clusters of an earlier clustering run without refitting
+Models saved by metabolic_clustering in the clustering directory map the pathway vectors of new patients to their clusters, gmm also gives the probability of each cluster.
+Models are of the numeric vectors of affected genes per pathway, binary vectors are not clustered so they have no models.
+New patients are added to their clusters in Clusters.txt, patients assigned to a gmm component without patients of the cohort are unassigned and are not added.
+"""
+
+import sys, os
+import argparse
+import numpy as np
+import metabolic_clustering
+import write_metabolic_pathways
+import reference_bundle
+import pathway_dict
+import instrumentation
+
+def process_command_line(argv):
+	"""
+	Return an args list
+	`argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+	"""
+	if argv is None:
+		argv = sys.argv[1:]
+
+	# initialize the parser object:
+	parser = argparse.ArgumentParser(description='Process input.', add_help=False)
+
+	#define options here
+	parser.add_argument(
+		'-w', '--workdir', default="./temp/",
+		help='Workdir of the clustering run, models and Clusters.txt are in its clustering directory.')
+
+	parser.add_argument(
+		'-l', '--lost_genes_files', nargs='+',
+		help='Lists of genes that underwent loss of function from each new patient.')
+
+	parser.add_argument(
+		'-d', '--reference_directory',
+		help='Reference directory with NCBI files.')
+
+	parser.add_argument(
+		'-k', '--kegg_file',
+		help='Kegg list of pathways and genes involved in pathway, format is org.list.')
+
+	parser.add_argument(
+		'-c', '--models', default=[], nargs='+',
+		help='Saved models to assign to, such as kmeans_numeric or gmm_numeric, default is all saved models.')
+
+	parser.add_argument(
+		'-p', '--pathway_descriptions', default= "/home/hosts/disk20/metabolic_pathways/map_title.tab",
+		help='Kegg list of pathways and their descriptions.')
+
+	parser.add_argument(
+		'--dry_run', action='store_true', default=False,
+		help='Print assignments without adding them to Clusters.txt.')
+
+	parser.add_argument(# customized description; put --help last
+		'-h', '--help', action='help',
+		help='Show this help message and exit.')
+
+	settings = parser.parse_args(argv)
+
+	return settings
+
+def read_new_patients(lost_genes_files, reference_directory, kegg_file, descriptions_file):
+	"""
+	Count how many genes of each pathway were affected in each new patient, pathways are named by their descriptions like in clustering.py
+	Cohort files of write_metabolic_pathways are not changed
+	"""
+	bundle = reference_bundle.load_bundle(reference_directory, kegg_file, descriptions_file)
+	clustering_genes_dict = write_metabolic_pathways.count_lost(lost_genes_files, bundle.pathways(), bundle.metabolic_proteins())[4]
+	#convert pathways to descriptions
+	converter = pathway_dict.Converter(descriptions_file)
+	#return
+	return dict((patient, dict((converter.convert_pathways(str(pathway)), value) for pathway, value in clustering_genes_dict[patient].items())) for patient in clustering_genes_dict)
+
+def assign_patients(metabolic_dir, patients_dict, names, dry_run=False):
+	"""
+	Assign patients to the clusters of each saved model and add them to Clusters.txt, return dict of model name:list of (patient, cluster number, probability)
+	Cluster number is UNASSIGNED for patients of clusters that are not in Clusters.txt
+	"""
+	results = {}
+	for name in names:
+		with instrumentation.stage("assign %s" % name, patients=len(patients_dict)) as details:
+			model = metabolic_clustering.load_model(os.path.join(metabolic_clustering.models_directory(metabolic_dir), "%s.npz" % name))
+			matrix, patients, unknown = metabolic_clustering.to_model_matrix(patients_dict, model["keys"])
+			if unknown: sys.stderr.write("%s: %s affected pathways of new patients are not in the model and are ignored\n" % (name, unknown))
+			labels, probabilities = metabolic_clustering.assign(model, matrix)
+			#clusters are numbered by their order in Clusters.txt
+			cluster_numbers = model["cluster_numbers"]
+			results[name] = [(patient, int(cluster_numbers[label]), probabilities[n, label]) for n, (patient, label) in enumerate(zip(patients, labels.tolist()))]
+			assigned = [i[:2] for i in results[name] if i[1] != metabolic_clustering.UNASSIGNED]
+			details["unassigned"] = len(results[name]) - len(assigned)
+			if not dry_run: details["added"] = len(metabolic_clustering.append_to_clusters(os.path.join(metabolic_dir, "Clusters.txt"), name, assigned))
+	#return
+	return results
+
+def main(argv=None):
+	#process command line
+	settings = process_command_line(argv)
+	metabolic_dir = os.path.join(settings.workdir, "clustering")
+	names = settings.models or metabolic_clustering.saved_models(metabolic_dir)
+	if not names: raise Exception("No saved models in %s, run clustering first" % metabolic_dir)
+	#record stages
+	with instrumentation.recording(os.path.join(metabolic_dir, "assign_patients_report.json")):
+		with instrumentation.stage("read_new_patients", patients=len(settings.lost_genes_files)):
+			patients_dict = read_new_patients(settings.lost_genes_files, settings.reference_directory, settings.kegg_file, settings.pathway_descriptions)
+		results = assign_patients(metabolic_dir, patients_dict, names, settings.dry_run)
+	#output to user
+	for name in names:
+		for patient, cluster_number, probability in results[name]:
+			if cluster_number == metabolic_clustering.UNASSIGNED: print("%s\t%s\tunassigned\t%.3f" % (patient, name, probability))
+			else: print("%s\t%s\tCluster_%s\t%.3f" % (patient, name, cluster_number, probability))
+	return 0
+
+if __name__ == "__main__":
+		exit(main())
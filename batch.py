@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+Run Clustering.sh, Enrichment.sh and Cluster_properties.sh for many organisms at once
+The stages of all organisms are a dependency graph that is run on a pool of processes, and the output tree is the same as the one of the shell scripts
+"""
+
+import sys, os
+import argparse
+import glob
+import shutil
+import traceback
+import multiprocessing
+try: import queue
+except ImportError: import Queue as queue
+import reference_bundle
+import instrumentation
+import write_metabolic_pathways
+import clustering
+import metabolic_clustering
+import enrichment
+import Get_cluster_properties
+import Properties_and_pathways
+
+#loss types and the name of their lost genes files
+LOSS_TYPES = [("high", "high_lost_genes_no_repeats.txt"), ("changed", "changed_genes_no_repeats.txt")]
+#clustering methods of Clustering.sh in the order they append to Clusters.txt, hierarchical clustering writes no clusters
+CLUSTERING_METHODS = ["kmeans", "gmm", "spectral"]
+#stages that can be run
+STAGES = ["clustering", "enrichment", "properties"]
+
+def process_command_line(argv):
+	"""
+	Return an args list
+	`argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+	"""
+	if argv is None:
+		argv = sys.argv[1:]
+
+	# initialize the parser object:
+	parser = argparse.ArgumentParser(description='Process input.', add_help=False)
+
+	#define options here
+	parser.add_argument(
+		'-w', '--workdir', default="./temp/",
+		help='Workdir where results will be written, same as workdir of the shell scripts.')
+
+	parser.add_argument(
+		'-o', '--organism', nargs=3, action='append', default=[], metavar=('ORGANISM', 'REFERENCE', 'KEGG'),
+		help='Organism dir with results of Within Host Adaptation pipeline, reference directory with NCBI files and Kegg .list file of the organism, can be given many times.')
+
+	parser.add_argument(
+		'-f', '--organisms_file',
+		help='Tab delimited file with organism dir, reference directory and Kegg .list file in each line.')
+
+	parser.add_argument(
+		'-s', '--stages', nargs='+', default=STAGES, choices=STAGES,
+		help='Stages to run, properties are only run if table is given.')
+
+	parser.add_argument(
+		'-c', '--clustering_methods', nargs='+', default=CLUSTERING_METHODS, choices=CLUSTERING_METHODS,
+		help='Clustering methods to run, Clusters.txt keeps the order of Clustering.sh.')
+
+	parser.add_argument(
+		'--exact', action='store_true', default=False,
+		help='Run enrichment with exact analytic p-values instead of simulations.')
+
+	parser.add_argument(
+		'--seed', type=int, default=10,
+		help='Seed of the enrichment simulations like in Enrichment.sh, seeded null distributions are cached in the workdir.')
+
+	parser.add_argument(
+		'-t', '--table',
+		help='Table S1 from Gatt and Margalit 2020 for cluster properties, or from results of Within Host Adaptation pipeline.')
+
+	parser.add_argument(
+		'-p', '--pathway_descriptions', default= "/home/hosts/disk20/metabolic_pathways/map_title.tab",
+		help='Kegg list of pathways and their descriptions.')
+
+	parser.add_argument(
+		'-n', '--processes', type=int, default=multiprocessing.cpu_count(),
+		help='Number of processes running stages.')
+
+	parser.add_argument(
+		'--profile', action='store_true', default=False,
+		help='Write cProfile stats of each stage next to the timing report.')
+
+	parser.add_argument(
+		'--trace_memory', action='store_true', default=False,
+		help='Record peak traced memory of each stage in the timing report, slows the run.')
+
+	parser.add_argument(# customized description; put --help last
+		'-h', '--help', action='help',
+		help='Show this help message and exit.')
+
+	settings = parser.parse_args(argv)
+
+	return settings
+
+def parse_organisms(organisms_file):
+	"""
+	Parse tab delimited file of organism dir, reference directory and kegg file
+	"""
+	organisms = []
+	with open(organisms_file) as fl: content = fl.readlines()
+	for line in content:
+		split_line = line.strip().split("\t")
+		if not split_line[0] or split_line[0].startswith("#"): continue
+		organisms.append(split_line[:3])
+	#return
+	return organisms
+
+def lost_genes_files(organism, lost_genes_file):
+	"""
+	Lost genes files of all patients of organism, patients without the file are skipped like in the shell scripts
+	"""
+	files = []
+	for patient in sorted(glob.glob(os.path.join(organism, "trial_*_patient_*/"))):
+		if [i for i in os.listdir(patient) if lost_genes_file in i and "rereading" not in i]: files.append(os.path.join(patient, lost_genes_file))
+	#return
+	return files
+
+def load_reference(reference_directory, kegg_file, descriptions_file):
+	"""
+	Build reference bundle so later stages only memory map it
+	"""
+	reference_bundle.load_bundle(reference_directory, kegg_file, descriptions_file)
+
+def write_pathways(workdir, files, reference_directory, kegg_file, descriptions_file):
+	"""
+	Count affected pathways once for all stages of an organism and loss type
+	"""
+	arguements = argparse.Namespace(workdir=workdir, lost_genes_files=files, reference_directory=reference_directory, kegg_file=kegg_file, pathway_descriptions=descriptions_file, skip=False, incremental=True)
+	write_metabolic_pathways.main(arguements)
+
+def cluster_method(workdir, files, reference_directory, kegg_file, descriptions_file, method, part_dir):
+	"""
+	Run clustering.py with one method, Clusters.txt is written to part_dir
+	"""
+	settings = clustering.process_command_line(["-d", reference_directory, "-k", kegg_file, "-l"] + files + ["-c", method, "-w", workdir, "-p", descriptions_file])
+	#clusters of an earlier run that did not finish are removed
+	shutil.rmtree(part_dir, ignore_errors=True)
+	write_metabolic_pathways.mkdir(os.path.dirname(part_dir))
+	#metabolic_clustering exits after writing clusters
+	try: clustering.cluster_patients(settings, part_dir)
+	except SystemExit: pass
+
+def merge_clusters(clustering_dir, part_dirs):
+	"""
+	Append Clusters.txt of each method to Clusters.txt in the order of Clustering.sh, and move their saved models to the models directory
+	Other outputs of the methods, like plots, stay in their part directories
+	"""
+	with open(os.path.join(clustering_dir, "Clusters.txt"), "a") as outfl:
+		for part_dir in part_dirs:
+			part_file = os.path.join(part_dir, "Clusters.txt")
+			if os.path.isfile(part_file):
+				with open(part_file) as fl: outfl.write(fl.read())
+				os.remove(part_file)
+	models_dir = metabolic_clustering.models_directory(clustering_dir)
+	for part_dir in part_dirs:
+		for name in metabolic_clustering.saved_models(part_dir):
+			write_metabolic_pathways.mkdir(models_dir)
+			os.rename(os.path.join(metabolic_clustering.models_directory(part_dir), "%s.npz" % name), os.path.join(models_dir, "%s.npz" % name))
+	#directories that are left empty are removed
+	for directory in [metabolic_clustering.models_directory(part_dir) for part_dir in part_dirs] + part_dirs + [os.path.dirname(part_dirs[0])]:
+		try: os.rmdir(directory)
+		except OSError: pass
+
+def run_enrichment(workdir, files, reference_directory, kegg_file, descriptions_file, metabolic, outfile, exact=False, seed=10):
+	"""
+	Run enrichment.py and append its output to outfile
+	"""
+	argv = ["-d", reference_directory, "-k", kegg_file, "-l"] + files + ["-w", workdir, "-p", descriptions_file, "--seed", str(seed)]
+	if metabolic: argv.append("--metabolic")
+	if exact: argv.append("--exact")
+	stdout = sys.stdout
+	with open(outfile, "a") as outfl:
+		sys.stdout = outfl
+		try: enrichment.main(argv)
+		except SystemExit: pass
+		finally: sys.stdout = stdout
+
+def cluster_properties(clusters, table):
+	"""
+	Run Get_cluster_properties.py and Properties_and_pathways.py on Clusters.txt like Cluster_properties.sh
+	"""
+	outfile = clusters.replace(".txt", "_properties.txt")
+	outdir = os.path.join(os.path.dirname(clusters), "intersection/")
+	for module, argv in [(Get_cluster_properties, ["-db", table, "-c", clusters, "-o", outfile]), (Properties_and_pathways, ["-c", clusters, "-p", outfile, "-w", outdir])]:
+		#the second script runs even if the first fails, like in the shell
+		try: module.main(argv)
+		except SystemExit: pass
+		except Exception: sys.stderr.write(traceback.format_exc())
+
+def build_graph(organisms, workdir, stages, table, descriptions_file, methods=CLUSTERING_METHODS, exact=False, seed=10):
+	"""
+	Build dict of task name:(function, arguments, list of tasks it depends on) for all organisms
+	"""
+	graph = {}
+	#methods append to Clusters.txt in the order of Clustering.sh
+	methods = [method for method in CLUSTERING_METHODS if method in methods]
+	for organism, reference_directory, kegg_file in organisms:
+		the_organism = os.path.basename(os.path.normpath(organism))
+		#reference is shared by all stages of all organisms using it
+		reference_task = "reference %s %s" % (os.path.abspath(reference_directory), os.path.abspath(kegg_file))
+		graph[reference_task] = (load_reference, (reference_directory, kegg_file, descriptions_file), [])
+		for loss_type, lost_genes_file in LOSS_TYPES:
+			files = lost_genes_files(organism, lost_genes_file)
+			if not files: continue
+			#same workdir strings as the shell scripts
+			organism_dir = os.path.join(workdir, loss_type, the_organism)
+			clustering_dir = os.path.join(organism_dir, "clustering")
+			write_metabolic_pathways.mkdir(os.path.join(workdir, loss_type))
+			write_metabolic_pathways.mkdir(organism_dir)
+			write_metabolic_pathways.mkdir(clustering_dir)
+			task = "%s %s" % (loss_type, the_organism)
+			graph["pathways %s" % task] = (write_pathways, (organism_dir + "/", files, reference_directory, kegg_file, descriptions_file), [reference_task])
+			#clustering, methods run in parallel and are merged in order
+			if "clustering" in stages:
+				part_dirs = [os.path.join(clustering_dir, ".parts", method) for method in methods]
+				for method, part_dir in zip(methods, part_dirs):
+					graph["clustering %s %s" % (method, task)] = (cluster_method, (organism_dir, files, reference_directory, kegg_file, descriptions_file, method, part_dir), ["pathways %s" % task])
+				graph["clusters %s" % task] = (merge_clusters, (clustering_dir, part_dirs), ["clustering %s %s" % (method, task) for method in methods])
+			#enrichment, regular and metabolic modes rewrite the same pathway files so they run one after the other
+			if "enrichment" in stages:
+				for name in ["significant_genes.txt", "significant_genes_metabolics_only.txt"]:
+					with open(os.path.join(organism_dir, name), "w") as outfl: outfl.write(the_organism + "\n")
+				#Enrichment.sh appends metabolic results of high loss to significant_genes_metabolic_only.txt
+				if loss_type == "high": metabolic_outfile = os.path.join(organism_dir, "significant_genes_metabolic_only.txt")
+				else: metabolic_outfile = os.path.join(organism_dir, "significant_genes_metabolics_only.txt")
+				graph["enrichment %s" % task] = (run_enrichment, (organism_dir + "/", files, reference_directory, kegg_file, descriptions_file, False, os.path.join(organism_dir, "significant_genes.txt"), exact, seed), ["pathways %s" % task])
+				graph["metabolic enrichment %s" % task] = (run_enrichment, (organism_dir + "/", files, reference_directory, kegg_file, descriptions_file, True, metabolic_outfile, exact, seed), ["enrichment %s" % task])
+			#properties of clusters
+			if "properties" in stages and "clustering" in stages and table:
+				graph["properties %s" % task] = (cluster_properties, (os.path.join(clustering_dir, "Clusters.txt"), table), ["clusters %s" % task])
+	#return
+	return graph
+
+def run_task(name, function, arguments, profile_dir=None, trace=False):
+	"""
+	Run task in a pool process, return name, traceback if it failed and records of its stages
+	"""
+	error = None
+	with instrumentation.recording(profile=profile_dir is not None, trace=trace, profile_dir=profile_dir) as stage_records:
+		with instrumentation.stage(name):
+			try: function(*arguments)
+			except BaseException: error = traceback.format_exc()
+	#return
+	return name, error, stage_records
+
+def run_graph(graph, processes, profile_dir=None, trace=False):
+	"""
+	Run tasks of graph on a pool of processes, a task starts when all tasks it depends on finished
+	Like in the shell scripts a failed task does not stop the ones after it, return names of failed tasks and records of all stages
+	A task that crashes outside run_task, or whose result can not be sent back, stops the run
+	"""
+	finished = queue.Queue()
+	pool = multiprocessing.Pool(max(1, processes))
+	waiting = dict((name, set(graph[name][2])) for name in graph)
+	dependents = dict((name, []) for name in graph)
+	for name in graph:
+		for dependency in graph[name][2]: dependents[dependency].append(name)
+	running = {}
+	failed = []
+	stage_records = []
+	try:
+		while waiting or running:
+			#submit ready tasks
+			for name in sorted([name for name in waiting if not waiting[name]]):
+				del waiting[name]
+				running[name] = pool.apply_async(run_task, (name, graph[name][0], graph[name][1], profile_dir, trace), callback=finished.put)
+			#wait for a task to finish, results that failed do not reach the callback
+			try: name, error, task_records = finished.get(timeout=1)
+			except queue.Empty:
+				for name in running:
+					if running[name].ready() and not running[name].successful():
+						try: running[name].get()
+						except Exception as exc: raise Exception("%s crashed, stopping the run: %r" % (name, exc))
+				continue
+			del running[name]
+			stage_records.extend(task_records)
+			if error:
+				sys.stderr.write("%s failed:\n%s" % (name, error))
+				failed.append(name)
+			for dependent in dependents[name]: waiting[dependent].discard(name)
+	except BaseException:
+		pool.terminate()
+		raise
+	else: pool.close()
+	finally: pool.join()
+	#return
+	return failed, stage_records
+
+def main(argv=None):
+	#process command line
+	settings = process_command_line(argv)
+	organisms = list(settings.organism)
+	if settings.organisms_file: organisms += parse_organisms(settings.organisms_file)
+	#build and run graph
+	write_metabolic_pathways.mkdir(settings.workdir)
+	graph = build_graph(organisms, settings.workdir, settings.stages, settings.table, settings.pathway_descriptions, settings.clustering_methods, settings.exact, settings.seed)
+	if settings.profile: profile_dir = os.path.join(settings.workdir, "batch_report_profiles")
+	else: profile_dir = None
+	failed, stage_records = run_graph(graph, settings.processes, profile_dir, settings.trace_memory)
+	instrumentation.write_report(os.path.join(settings.workdir, "batch_report.json"), stage_records)
+	#return
+	return int(bool(failed))
+
+if __name__ == "__main__":
+		exit(main())
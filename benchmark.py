@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+Benchmark pipeline stages on synthetic cohorts of different sizes and compare with earlier results
+Stages are write_metabolic_pathways, enrichment.py in each of its modes, metabolic_clustering with each method and Get_cluster_properties.
+Results are written as JSON, a run given a baseline results file reports stages that became slower.
+"""
+
+import sys, os
+import argparse
+import json
+import time
+import shutil
+import platform
+import numpy as np
+import synthetic_cohort
+import instrumentation
+import reference_bundle
+import write_metabolic_pathways
+import enrichment
+import clustering
+import metabolic_clustering
+import Get_cluster_properties
+
+#stages that can be run
+STAGES = ["write_metabolic_pathways", "enrichment", "clustering", "properties"]
+#modes of enrichment.py that are timed, simulations is the default mode
+ENRICHMENT_MODES = ["simulations", "adaptive", "exact"]
+
+def process_command_line(argv):
+	"""
+	Return an args list
+	`argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+	"""
+	if argv is None:
+		argv = sys.argv[1:]
+
+	# initialize the parser object:
+	parser = argparse.ArgumentParser(description='Process input.', add_help=False)
+
+	#define options here
+	parser.add_argument(
+		'-w', '--workdir', default="./benchmark/",
+		help='Workdir for synthetic cohorts and results, cohorts are reused between runs.')
+
+	parser.add_argument(
+		'-n', '--patients', type=int, nargs='+', default=[100, 1000],
+		help='Numbers of patients of the cohorts.')
+
+	parser.add_argument(
+		'-g', '--genes', type=int, default=3000,
+		help='Number of genes in the reference.')
+
+	parser.add_argument(
+		'-P', '--pathways', type=int, default=120,
+		help='Number of KEGG pathways.')
+
+	parser.add_argument(
+		'-s', '--stages', nargs='+', default=STAGES, choices=STAGES,
+		help='Stages to benchmark, properties need clustering.')
+
+	parser.add_argument(
+		'-c', '--clustering_methods', nargs='+', default=["kmeans", "gmm", "spectral"],
+		help='Clustering methods to benchmark.')
+
+	parser.add_argument(
+		'-e', '--enrichment_modes', nargs='+', default=ENRICHMENT_MODES, choices=ENRICHMENT_MODES,
+		help='Modes of enrichment.py to benchmark.')
+
+	parser.add_argument(
+		'--simulations', type=int, default=1000,
+		help='Number of simulations of enrichment.')
+
+	parser.add_argument(
+		'--adaptive', type=int, default=10, metavar='H',
+		help='Exceedances after which a pathway stops simulating in adaptive mode.')
+
+	parser.add_argument(
+		'--workers', type=int, default=1,
+		help='Number of processes running enrichment simulations.')
+
+	parser.add_argument(
+		'--seed', type=int, default=0,
+		help='Seed of the synthetic cohorts and of the simulations.')
+
+	parser.add_argument(
+		'-o', '--outfile', default=None,
+		help='Results file, default is benchmark_<time>.json in workdir.')
+
+	parser.add_argument(
+		'-b', '--baseline', default=None,
+		help='Results file of an earlier run to compare with.')
+
+	parser.add_argument(
+		'--tolerance', type=float, default=0.2,
+		help='Stages slower than the baseline by more than this fraction are reported as regressions.')
+
+	parser.add_argument(# customized description; put --help last
+		'-h', '--help', action='help',
+		help='Show this help message and exit.')
+
+	settings = parser.parse_args(argv)
+
+	return settings
+
+def cohort(workdir, patients, genes, pathways, seed):
+	"""
+	Get manifest of a synthetic cohort, writing the cohort if it does not exist
+	"""
+	outdir = os.path.join(workdir, "cohort_%d_patients_%d_genes_%d_pathways_%d" % (patients, genes, pathways, seed))
+	manifest = synthetic_cohort.read_cohort(outdir)
+	if manifest is None:
+		shutil.rmtree(outdir, ignore_errors=True)
+		manifest = synthetic_cohort.generate(outdir, patients=patients, genes=genes, pathways=pathways, seed=seed)
+	#return
+	return manifest
+
+def silenced(function, *arguments):
+	"""
+	Run function without its output and without exiting
+	"""
+	stdout = sys.stdout
+	with open(os.devnull, "w") as devnull:
+		sys.stdout = devnull
+		try: return function(*arguments)
+		except SystemExit: pass
+		finally: sys.stdout = stdout
+
+def enrichment_arguments(files, workdir, lost_genes_files, mode, settings):
+	"""
+	Command line of enrichment.py in mode, the null distribution cache is disabled so every run simulates
+	"""
+	argv = ["-d", files["reference_directory"], "-k", files["kegg_file"], "-l"] + lost_genes_files + ["-w", workdir, "-p", files["pathway_descriptions"],
+		"--seed", str(settings.seed), "--simulations", str(settings.simulations), "--workers", str(settings.workers), "--cache_size", "0"]
+	if mode == "adaptive": argv += ["--adaptive", str(settings.adaptive)]
+	elif mode == "exact": argv.append("--exact")
+	#return
+	return argv
+
+def benchmark_cohort(manifest, workdir, settings):
+	"""
+	Run stages on a cohort, return records of the stages
+	"""
+	files = manifest["files"]
+	lost_genes_files = [os.path.join(files["organism"], patient, "high_lost_genes_no_repeats.txt") for patient in sorted(os.listdir(files["organism"]))]
+	#every run starts from scratch
+	shutil.rmtree(workdir, ignore_errors=True)
+	clustering_dir = os.path.join(workdir, "clustering")
+	write_metabolic_pathways.mkdir(workdir)
+	arguements = argparse.Namespace(workdir=workdir + "/", lost_genes_files=lost_genes_files, reference_directory=files["reference_directory"], kegg_file=files["kegg_file"], pathway_descriptions=files["pathway_descriptions"], skip=False, incremental=False)
+	with instrumentation.recording() as stage_records:
+		#reference is parsed once before the stages, like in batch.py
+		reference_bundle.load_bundle(files["reference_directory"], files["kegg_file"], files["pathway_descriptions"])
+		#stages need pathway files, they are always written
+		with instrumentation.stage("write_metabolic_pathways"):
+			write_metabolic_pathways.main(arguements)
+		if "enrichment" in settings.stages:
+			for mode in settings.enrichment_modes:
+				with instrumentation.stage("enrichment %s" % mode, simulations=settings.simulations, workers=settings.workers):
+					silenced(enrichment.main, enrichment_arguments(files, arguements.workdir, lost_genes_files, mode, settings))
+		if "clustering" in settings.stages:
+			clustering_patients_dict, clustering_genes_dict = clustering.read_metabolic_pathways(lost_genes_files, arguements.workdir, files["pathway_descriptions"])
+			write_metabolic_pathways.mkdir(clustering_dir)
+			for method in settings.clustering_methods:
+				with instrumentation.stage("metabolic_clustering %s" % method):
+					silenced(metabolic_clustering.main, clustering_patients_dict, clustering_genes_dict, clustering_dir, 2, [method])
+			if "properties" in settings.stages:
+				with instrumentation.stage("Get_cluster_properties"):
+					silenced(Get_cluster_properties.main, ["-db", files["table"], "-c", os.path.join(clustering_dir, "Clusters.txt"), "-o", os.path.join(clustering_dir, "Clusters_properties.txt")])
+	#return
+	return stage_records
+
+def stage_times(results, depth=2):
+	"""
+	Dict of (patients, genes, pathways, stage):wall time of results, for stages up to depth levels deep, repeated stages are summed
+	"""
+	times = {}
+	for scale in results["scales"]:
+		for record in scale["stages"]:
+			if record["stage"].count("/") >= depth: continue
+			key = (scale["patients"], scale["genes"], scale["pathways"], record["stage"])
+			times[key] = times.get(key, 0) + record["wall"]
+	#return
+	return times
+
+def compare(results, baseline, tolerance):
+	"""
+	Print wall time of each stage next to the baseline, return stages that are slower by more than tolerance
+	"""
+	current_times = stage_times(results)
+	baseline_times = stage_times(baseline)
+	regressions = []
+	print("patients\tgenes\tpathways\tstage\tbaseline\tcurrent\tratio")
+	for key in sorted(current_times):
+		if key not in baseline_times: continue
+		ratio = current_times[key] / max(baseline_times[key], 1e-9)
+		line = "%s\t%s\t%s\t%s\t%.4f\t%.4f\t%.2f" % (key + (baseline_times[key], current_times[key], ratio))
+		#very short stages are noise
+		if ratio > 1 + tolerance and current_times[key] - baseline_times[key] > 0.05:
+			regressions.append(key)
+			line += "\tslower"
+		print(line)
+	#return
+	return regressions
+
+def main(argv=None):
+	#process command line
+	settings = process_command_line(argv)
+	write_metabolic_pathways.mkdir(settings.workdir)
+	results = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, "machine": platform.platform(), "argv": sys.argv, "scales": []}
+	#benchmark each scale
+	for patients in settings.patients:
+		manifest = cohort(settings.workdir, patients, settings.genes, settings.pathways, settings.seed)
+		stage_records = benchmark_cohort(manifest, os.path.join(settings.workdir, "run_%d_patients" % patients), settings)
+		results["scales"].append({"patients": patients, "genes": settings.genes, "pathways": settings.pathways, "stages": stage_records})
+		for record in stage_records:
+			if "/" not in record["stage"]: print("%s\t%s\t%.4f" % (patients, record["stage"], record["wall"]))
+	#write results
+	if settings.outfile: outfile = settings.outfile
+	else: outfile = os.path.join(settings.workdir, "benchmark_%s.json" % time.strftime("%Y%m%d_%H%M%S"))
+	with open(outfile, "w") as outfl: json.dump(results, outfl, indent=1, default=str)
+	#compare
+	if settings.baseline:
+		with open(settings.baseline) as fl: baseline = json.load(fl)
+		if compare(results, baseline, settings.tolerance): return 1
+	return 0
+
+if __name__ == "__main__":
+		exit(main())
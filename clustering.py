@@ -9,6 +9,7 @@ import argparse
 import metabolic_clustering
 import write_metabolic_pathways
 import pathway_dict
+import instrumentation
 
 def process_command_line(argv):
 	"""
@@ -49,12 +50,55 @@ def process_command_line(argv):
 	parser.add_argument(
 		'-p', '--pathway_descriptions', default= "/home/hosts/disk20/metabolic_pathways/map_title.tab",
 		help='Kegg list of pathways and their descriptions.')
+
+	parser.add_argument(
+		'--plot', action='store_true', default=False,
+		help='Plot PCA, clusters and hierarchical clustering, plotting libraries are only loaded with this option.')
+
+	parser.add_argument(
+		'--workers', type=int, default=1,
+		help='Number of processes fitting the numbers of clusters that are compared, BLAS threads are split between them.')
+
+	parser.add_argument(
+		'--silhouette_sample', type=int, default=0,
+		help='Estimate silhouettes from this many random patients instead of all pairwise distances, for large cohorts. 0 uses all patients.')
+
+	parser.add_argument(
+		'--spectral_k', default="silhouette", choices=["silhouette", "eigengap"],
+		help='Choose number of spectral clusters by silhouette or by the largest gap between eigenvalues of the Laplacian.')
+
+	parser.add_argument(
+		'--spectral_neighbors', type=int, default=0,
+		help='Build the spectral affinity from this many nearest neighbours of each patient as a sparse matrix, for large cohorts. 0 uses the dense RBF affinity of all patients.')
+
+	parser.add_argument(
+		'--gmm_init', default="random", choices=["random", "kmeans", "warm"],
+		help='Start gmm from 42 random restarts, once from kmeans centers, or once from the model of one cluster less.')
+
+	parser.add_argument(
+		'--covariance_type', default="full", choices=["full", "tied", "diag", "spherical"],
+		help='Covariance of gmm components, diag and spherical are faster and better conditioned with many pathways.')
+
+	parser.add_argument(
+		'--criterion', default="silhouette", choices=metabolic_clustering.CRITERIA,
+		help='Choose number of clusters by silhouette, which is quadratic in patients, or by calinski_harabasz, davies_bouldin, simplified_silhouette or bic (gmm only), which are linear.')
+
+	parser.add_argument(
+		'--profile', action='store_true', default=False,
+		help='Write cProfile stats of each stage next to the timing report.')
+
+	parser.add_argument(
+		'--trace_memory', action='store_true', default=False,
+		help='Record peak traced memory of each stage in the timing report, slows the run.')
 	
 	parser.add_argument(# customized description; put --help last
 		'-h', '--help', action='help',
 		help='Show this help message and exit.')
 	
 	settings = parser.parse_args(argv)
+	#bic is only defined for gmm, fail before any method writes results
+	other_methods = [i for i in settings.clustering_methods if i.lower() not in ["gmm", "hierarchical"]]
+	if settings.criterion == "bic" and other_methods: parser.error("--criterion bic needs gmm clustering, not %s" % ", ".join(other_methods))
 	
 	return settings
 
@@ -67,6 +111,19 @@ def read_metabolic_pathways(lost_genes_files, workdir, descriptions_file):
 	#initialize
 	clustering_patients_dict = {}
 	clustering_genes_dict = {}
+	#read cohort store in one read if all patients are in it
+	store = write_metabolic_pathways.read_store(workdir)
+	if store is not None:
+		patient_rows = dict((str(patient), n) for n, patient in enumerate(store["patients"]))
+		patients = [os.path.basename(os.path.dirname(patient_lost_file)) for patient_lost_file in lost_genes_files]
+		if all([patient in patient_rows for patient in patients]):
+			#convert each pathway once
+			pathways = [converter.convert_pathways(str(pathway)) for pathway in store["pathways"]]
+			for patient in patients:
+				clustering_patients_dict[patient] = dict(zip(pathways, store["binary"][patient_rows[patient]].tolist()))
+				clustering_genes_dict[patient] = dict(zip(pathways, store["full"][patient_rows[patient]].tolist()))
+			return clustering_patients_dict, clustering_genes_dict
+	#otherwise read per patient files
 	#get patient workdir
 	name = os.path.basename(os.path.dirname(os.path.dirname(workdir)))
 	#get patients results
@@ -93,21 +150,32 @@ def read_metabolic_pathways(lost_genes_files, workdir, descriptions_file):
 def main(argv=None):
 	#process command line
 	settings = process_command_line(argv)
-	#count how many times each pathway was affected in two ways: number of patients and number of genes
-	#run write_metabolic_pathways with skip
-	arguements = argparse.Namespace(workdir=settings.workdir, lost_genes_files=settings.lost_genes_files, reference_directory=settings.reference_directory, kegg_file=settings.kegg_file, skip=True)
-	write_metabolic_pathways.main(arguements)
+	#record stages, runs of different methods share the workdir
+	report_file = os.path.join(settings.workdir, "clustering", "clustering_%s_report.json" % "_".join(settings.clustering_methods))
+	with instrumentation.recording(report_file, settings.profile, settings.trace_memory):
+		#count how many times each pathway was affected in two ways: number of patients and number of genes
+		#run write_metabolic_pathways with skip
+		with instrumentation.stage("write_metabolic_pathways"):
+			arguements = argparse.Namespace(workdir=settings.workdir, lost_genes_files=settings.lost_genes_files, reference_directory=settings.reference_directory, kegg_file=settings.kegg_file, pathway_descriptions=settings.pathway_descriptions, skip=True, incremental=True)
+			write_metabolic_pathways.main(arguements)
+		#cluster
+		cluster_patients(settings, os.path.join(settings.workdir,"clustering"))
+
+def cluster_patients(settings, metabolic_dir):
+	"""
+	Cluster patients by pathways written by write_metabolic_pathways to workdir, clusters are appended to Clusters.txt in metabolic_dir
+	"""
 	#read results
-	clustering_patients_dict, clustering_genes_dict = read_metabolic_pathways(settings.lost_genes_files, settings.workdir, settings.pathway_descriptions)
+	with instrumentation.stage("read_metabolic_pathways"):
+		clustering_patients_dict, clustering_genes_dict = read_metabolic_pathways(settings.lost_genes_files, settings.workdir, settings.pathway_descriptions)
 	if not sum([1 for i in clustering_patients_dict if clustering_patients_dict[i]]): raise Exception("No metabolic pathways affected for organsim %s" % os.path.basename(os.path.dirname(os.path.dirname(settings.lost_genes_files[0]))))
 	#create directory
-	metabolic_dir = os.path.join(settings.workdir,"clustering")
 	write_metabolic_pathways.mkdir(metabolic_dir)
 	#clustering
 	if settings.clustering_methods != []:
 		if settings.dimensions <= 2.5: dimensions = 2
 		else: dimensions = 3
-		metabolic_clustering.main(clustering_patients_dict, clustering_genes_dict, metabolic_dir=metabolic_dir, D=dimensions, clustering_methods=settings.clustering_methods)
+		metabolic_clustering.main(clustering_patients_dict, clustering_genes_dict, metabolic_dir=metabolic_dir, D=dimensions, clustering_methods=settings.clustering_methods, plot=settings.plot, workers=settings.workers, silhouette_sample=settings.silhouette_sample, spectral_k=settings.spectral_k, gmm_init=settings.gmm_init, covariance_type=settings.covariance_type, criterion=settings.criterion, spectral_neighbors=settings.spectral_neighbors)
 
 if __name__ == "__main__":
 		exit(main())
@@ -4,19 +4,24 @@
 Investigate metabolic enrichment in organism
 """
 
+from __future__ import print_function
 import sys, os
 import argparse
 import errno
-import create_pathways
 import write_metabolic_pathways
 import pathway_dict
-from Bio import SeqIO
-import gzip as gz
+import reference_bundle
+import instrumentation
+from kegg_to_NCBI import proteins_list
 import random
+import copy
+import hashlib
+import multiprocessing
 import numpy as np
+from scipy import sparse
+import scipy.stats as stats
 from statsmodels.stats.multitest import multipletests
 import itertools
-import metabolic_clustering
 
 def process_command_line(argv):
 	"""
@@ -62,6 +67,50 @@ def process_command_line(argv):
 		'-p', '--pathway_descriptions', default= "/home/hosts/disk20/metabolic_pathways/map_title.tab",
 		help='Kegg list of pathways and their descriptions.')
 
+	parser.add_argument(
+		'--seed', type=int, default=None,
+		help='Random seed for the simulations, results are reproducible for the same seed and number of shards.')
+
+	parser.add_argument(
+		'--simulations', type=int, default=100000,
+		help='Number of simulations, the most that are run for a pathway in adaptive mode.')
+
+	parser.add_argument(
+		'--workers', type=int, default=1,
+		help='Number of processes running simulations.')
+
+	parser.add_argument(
+		'--shards', type=int, default=None,
+		help='Number of independently seeded simulation shards, default is one per worker.')
+
+	parser.add_argument(
+		'--adaptive', type=int, default=0, metavar='H',
+		help='Stop simulating a pathway once H simulations reach its observed value (sequential p-values), 0 runs all simulations for all pathways.')
+
+	parser.add_argument(
+		'--exact', action='store_true', default=False,
+		help='Calculate p-values from the exact null distribution instead of simulating.')
+
+	parser.add_argument(
+		'--resolution', type=float, default=0.01,
+		help='Grid step for the gene damage distribution in exact mode.')
+
+	parser.add_argument(
+		'--cache_dir', default=None,
+		help='Directory for cached null distributions of seeded runs, default is null_cache in workdir.')
+
+	parser.add_argument(
+		'--cache_size', type=float, default=1024,
+		help='Maximal size of the null distribution cache in MB, 0 disables the cache.')
+
+	parser.add_argument(
+		'--profile', action='store_true', default=False,
+		help='Write cProfile stats of each stage next to the timing report.')
+
+	parser.add_argument(
+		'--trace_memory', action='store_true', default=False,
+		help='Record peak traced memory of each stage in the timing report, slows the run.')
+
 	parser.add_argument(# customized description; put --help last
 		'-h', '--help', action='help',
 		help='Show this help message and exit.')
@@ -70,53 +119,483 @@ def process_command_line(argv):
 	
 	return settings
 
-def proteins_list(protein_file):
-	#get names of proteins from protein file
-	with gz.open(protein_file) as fl:
-		genes_list = [i.id for i in list(SeqIO.parse(fl, "fasta"))] # i.id.split(".")[0]
+def python_random_state(seed=None):
+	"""
+	Get a numpy RandomState holding the same Mersenne Twister state as python's random module, seeded with seed or taken from the global random module
+	"""
+	#get python state
+	if seed is None: version, internal_state, gauss_next = random.getstate()
+	else: version, internal_state, gauss_next = random.Random(seed).getstate()
+	#copy to numpy generator
+	random_state = np.random.RandomState()
+	random_state.set_state(("MT19937", np.array(internal_state[:-1], dtype=np.uint32), internal_state[-1]))
+	#return
+	return random_state
+
+def advance_python_random(random_state):
+	"""
+	Copy the state of a numpy RandomState back to the global random module, as if random.choice was called for each draw
+	"""
+	name, keys, position = random_state.get_state()[:3]
+	version, internal_state, gauss_next = random.getstate()
+	random.setstate((version, tuple(int(i) for i in keys) + (int(position),), gauss_next))
+
+def draw_choices(random_state, size, number_of_choices):
+	"""
+	Draw size indices in the same way random.choice draws from a sequence of length number_of_choices
+	"""
+	#nothing to draw, or nothing to draw from like random.choice of an empty sequence
+	if size == 0: return np.zeros(0, dtype=np.int64)
+	if number_of_choices == 0: raise IndexError("Cannot choose from an empty sequence")
+	#python 2 random.choice is seq[int(random() * len(seq))], random() is built from two 32 bit words
+	if sys.version_info[0] < 3:
+		words = random_state.randint(0, 2**32, size=2*size, dtype=np.uint32)
+		uniform = ((words[0::2] >> 5) * 67108864.0 + (words[1::2] >> 6)) * (1.0 / 9007199254740992.0)
+		return (uniform * number_of_choices).astype(np.int64)
+	#python 3 random.choice rejects getrandbits(k) >= len(seq), never draw more words than python would
+	shift = 32 - int(number_of_choices).bit_length()
+	indices = np.empty(size, dtype=np.int64)
+	filled = 0
+	while filled < size:
+		words = random_state.randint(0, 2**32, size=size - filled, dtype=np.uint32) >> shift
+		accepted = words[words < number_of_choices]
+		indices[filled:filled + len(accepted)] = accepted
+		filled += len(accepted)
+	#return
+	return indices
+
+def pathway_incidence(gene_list, pathways, gene_pathway_dict):
+	"""
+	Create sparse gene x pathway matrix with the number of times each gene in gene_list appears in each pathway
+	"""
+	#pathway columns
+	pathway_index = dict((pathway, n) for n, pathway in enumerate(pathways))
+	rows = []
+	columns = []
+	#iterate through genes
+	for n, gene in enumerate(gene_list):
+		if gene not in gene_pathway_dict: continue
+		for pathway in gene_pathway_dict[gene]:
+			rows.append(n)
+			columns.append(pathway_index[pathway])
+	#duplicates are summed
+	incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(gene_list), len(pathway_index)))
+	incidence.sum_duplicates()
 	#return
-	return genes_list
+	return incidence
 
-def simulate_pathways(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations=100000):
+def loss_arrays(gene_loss_vector):
 	"""
-	Simualte gene loss in similar numbers to patients and see how many times the pathways are affected
+	Get fractions of all draws and number of draws of each patient from a LossVector or a list of lists
 	"""
-	background_patient_distribution = {}
-	background_genes_distribution = {}
-	#initialize dicts
-	for pathway in pathways:
-		background_patient_distribution[pathway] = [0 for i in xrange(number_of_simulations)]
-		background_genes_distribution[pathway] = [0 for i in xrange(number_of_simulations)]
+	if isinstance(gene_loss_vector, write_metabolic_pathways.LossVector): return np.asarray(gene_loss_vector.values, dtype=np.float64), gene_loss_vector.lengths()
+	fractions = np.array([float(fraction) for patient_vector in gene_loss_vector for fraction in patient_vector], dtype=np.float64)
+	#return
+	return fractions, np.array([len(patient_vector) for patient_vector in gene_loss_vector], dtype=np.int64)
+
+def simulation_blocks(incidence, gene_loss_vector, number_of_simulations, random_state, block_draws=2**21):
+	"""
+	Simulate gene loss in blocks of simulations, yield number of patients and gene damage per pathway for each block
+	"""
+	number_of_genes, number_of_pathways = incidence.shape
+	#flatten gene loss vector, draws are ordered by simulation, patient and gene like random.choice calls of a loop over them
+	fractions, lengths = loss_arrays(gene_loss_vector)
+	draw_patients = np.repeat(np.arange(len(lengths)), lengths)
+	number_of_draws = len(fractions)
+	number_of_patients = len(lengths)
+	#genes that are not in any pathway do not matter after they are drawn
+	in_pathway = np.diff(incidence.indptr) > 0
+	#define block size
+	block_size = max(1, min(number_of_simulations, block_draws // max(number_of_draws, 1)))
 	#start simulations
-	for i in xrange(number_of_simulations):
-		#simulation totals
-		simulation = []
+	for start in range(0, number_of_simulations, block_size):
+		size = min(block_size, number_of_simulations - start)
 		#choose lost genes at random
-		for patient_vector in gene_loss_vector:
-			patient_lost_genes = []
-			for fraction in patient_vector:
-				gene = random.choice(gene_list)
-				patient_lost_genes.append((gene,fraction))
-			#append to simulation totals
-			simulation.append(patient_lost_genes)
-		#count how many times pathways were affected in this simulation
-		for patient_vector in simulation:
-			#flag symbolizing gene in pathways affected already
-			patient_pathway_flag_dict = {}
-			#iterate through genes
-			for gene in patient_vector:
-				#check if gene in pathway
-				if gene[0] not in gene_pathway_dict: continue
-				for pathway in gene_pathway_dict[gene[0]]:
-					#add gene damage
-					background_genes_distribution[pathway][i] += float(gene[1])
-					#add to patient if not counted yet
-					if pathway not in patient_pathway_flag_dict:
-						background_patient_distribution[pathway][i] += 1
-						patient_pathway_flag_dict[pathway] = 1
+		genes = draw_choices(random_state, size * number_of_draws, number_of_genes)
+		draws = np.nonzero(in_pathway[genes])[0]
+		genes = genes[draws]
+		simulations = draws // max(number_of_draws, 1)
+		columns = draws % max(number_of_draws, 1)
+		#gene damage: simulation x gene damage matrix times gene x pathway incidence
+		damage = sparse.csr_matrix((fractions[columns], (simulations, genes)), shape=(size, number_of_genes))
+		genes_block = np.asarray((damage * incidence).todense())
+		#patients: (simulation, patient) x gene matrix, a pathway is affected once per patient
+		rows = simulations * number_of_patients + draw_patients[columns]
+		affected = sparse.csr_matrix((np.ones(len(rows)), (rows, genes)), shape=(size * number_of_patients, number_of_genes)) * incidence
+		affected_rows = np.repeat(np.arange(affected.shape[0]), np.diff(affected.indptr))
+		nonzero = affected.data > 0
+		patients_block = np.bincount((affected_rows[nonzero] // max(number_of_patients, 1)) * number_of_pathways + affected.indices[nonzero], minlength=size * number_of_pathways).reshape(size, number_of_pathways)
+		yield patients_block, genes_block
+
+class NullDistribution(object):
+	"""
+	Simulated null distributions of all pathways, kept sorted in typed arrays
+	"""
+	def __init__(self, pathways, patient_distribution, genes_distribution, is_sorted=False):
+		"""
+		Initialize object from pathway x simulation arrays
+		"""
+		self.pathways = list(pathways)
+		self.number_of_simulations = patient_distribution.shape[1]
+		#smallest type that holds the number of patients
+		patient_type = np.min_scalar_type(int(patient_distribution.max()) if patient_distribution.size else 0)
+		if is_sorted:
+			self.patient_distribution = patient_distribution.astype(patient_type, copy=False)
+			self.genes_distribution = genes_distribution
+		else:
+			self.patient_distribution = np.sort(patient_distribution.astype(patient_type), axis=1)
+			self.genes_distribution = np.sort(genes_distribution, axis=1)
+
+	def save(self, path):
+		"""
+		Save sorted distributions to npz file, written to a temporary file first so readers never see a partial file
+		"""
+		temporary_path = "%s.%s.tmp" % (path, os.getpid())
+		with open(temporary_path, "wb") as outfl:
+			np.savez(outfl, pathways=np.array(self.pathways, dtype=np.str_), patient_distribution=self.patient_distribution, genes_distribution=self.genes_distribution)
+		os.rename(temporary_path, path)
+
+	def exceedances(self, distribution, observed):
+		"""
+		Count simulations at least as high as the observed value of each pathway
+		"""
+		return np.array([len(row) - np.searchsorted(row, value, side="left") for row, value in zip(distribution, observed)], dtype=np.int64)
+
+	def p_values(self, pathway_patients_dict, pathway_genes_dict):
+		"""
+		Get p-values of observed pathway values
+		"""
+		patient_counts = self.exceedances(self.patient_distribution, [float(pathway_patients_dict[pathway]) for pathway in self.pathways])
+		genes_counts = self.exceedances(self.genes_distribution, [float(pathway_genes_dict[pathway]) for pathway in self.pathways])
+		#return
+		return dict(zip(self.pathways, patient_counts / float(self.number_of_simulations))), dict(zip(self.pathways, genes_counts / float(self.number_of_simulations)))
+
+class ExceedanceCounter(object):
+	"""
+	Streaming count of simulations at least as high as the observed value of each pathway, nothing else is kept
+	"""
+	def __init__(self, pathways, pathway_patients_dict, pathway_genes_dict):
+		"""
+		Initialize object with observed values
+		"""
+		self.pathways = list(pathways)
+		self.observed_patients = np.array([float(pathway_patients_dict[pathway]) for pathway in self.pathways])
+		self.observed_genes = np.array([float(pathway_genes_dict[pathway]) for pathway in self.pathways])
+		self.patient_counts = np.zeros(len(self.pathways), dtype=np.int64)
+		self.genes_counts = np.zeros(len(self.pathways), dtype=np.int64)
+		self.number_of_simulations = 0
+
+	def update(self, patients_block, genes_block):
+		"""
+		Add simulation x pathway block of simulations
+		"""
+		self.patient_counts += (patients_block >= self.observed_patients).sum(axis=0)
+		self.genes_counts += (genes_block >= self.observed_genes).sum(axis=0)
+		self.number_of_simulations += len(patients_block)
+
+	def merge(self, other):
+		"""
+		Add counts of another counter with the same observed values
+		"""
+		self.patient_counts += other.patient_counts
+		self.genes_counts += other.genes_counts
+		self.number_of_simulations += other.number_of_simulations
+
+	def p_values(self):
+		"""
+		Get p-values of observed pathway values
+		"""
+		return dict(zip(self.pathways, self.patient_counts / float(self.number_of_simulations))), dict(zip(self.pathways, self.genes_counts / float(self.number_of_simulations)))
+
+def simulate_distributions(incidence, gene_loss_vector, number_of_simulations, random_state, counter=None):
+	"""
+	Run simulations and return pathway x simulation arrays of affected patients and gene damage,
+	or only update counter with the simulations if given
+	"""
+	#stream to counter
+	if counter is not None:
+		for patients_block, genes_block in simulation_blocks(incidence, gene_loss_vector, number_of_simulations, random_state):
+			counter.update(patients_block, genes_block)
+		return counter
+	#initialize distributions
+	patient_distribution = np.zeros((incidence.shape[1], number_of_simulations), dtype=np.int32)
+	genes_distribution = np.zeros((incidence.shape[1], number_of_simulations), dtype=np.float64)
+	#start simulations
+	start = 0
+	for patients_block, genes_block in simulation_blocks(incidence, gene_loss_vector, number_of_simulations, random_state):
+		patient_distribution[:, start:start + len(patients_block)] = patients_block.T
+		genes_distribution[:, start:start + len(genes_block)] = genes_block.T
+		start += len(patients_block)
+	#return
+	return patient_distribution, genes_distribution
+
+def simulate_shard(arguments):
+	"""
+	Run a shard of simulations with its own seed, called from a process pool
+	"""
+	incidence, gene_loss_vector, number_of_simulations, seed, counter = arguments
+	return simulate_distributions(incidence, gene_loss_vector, number_of_simulations, python_random_state(seed), counter)
+
+def shard_seeds(seed, shards):
+	"""
+	Derive an independent seed for each shard, a single shard uses the seed itself
+	"""
+	if shards == 1: return [seed]
+	#without a seed the random module decides
+	if seed is None: seed_generator = random
+	else: seed_generator = random.Random(seed)
+	#return
+	return [seed_generator.getrandbits(32) for i in range(shards)]
+
+def run_simulations(incidence, gene_loss_vector, number_of_simulations=100000, seed=None, workers=1, shards=None, counter=None):
+	"""
+	Run simulations, split to independently seeded shards run on workers processes if there are several shards.
+	Results are identical for the same seed and number of shards regardless of the number of workers.
+	Return pathway x simulation arrays, or counter updated with all simulations if given.
+	"""
+	#one shard per worker unless stated otherwise
+	if shards is None: shards = workers
+	shards = max(1, min(shards, number_of_simulations))
+	if shards == 1:
+		random_state = python_random_state(seed)
+		results = simulate_distributions(incidence, gene_loss_vector, number_of_simulations, random_state, counter)
+		if seed is None: advance_python_random(random_state)
+		return results
+	#split simulations between shards
+	sizes = [number_of_simulations // shards + (1 if n < number_of_simulations % shards else 0) for n in range(shards)]
+	arguments = [(incidence, gene_loss_vector, size, shard_seed, copy.deepcopy(counter)) for size, shard_seed in zip(sizes, shard_seeds(seed, shards))]
+	if workers > 1:
+		pool = multiprocessing.Pool(min(workers, shards))
+		try: results = pool.map(simulate_shard, arguments)
+		finally:
+			pool.close()
+			pool.join()
+	else: results = [simulate_shard(i) for i in arguments]
+	#merge shards in order
+	if counter is not None:
+		for shard_counter in results: counter.merge(shard_counter)
+		return counter
+	#return
+	return np.hstack([i[0] for i in results]), np.hstack([i[1] for i in results])
+
+def simulate_pathways_vectorized(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations=100000, seed=None, workers=1, shards=None):
+	"""
+	Simulate gene loss in similar numbers to patients and count how many times the pathways are affected, in numpy batches
+	Genes are drawn as random.choice(gene_list) for each simulation, patient and lost gene, so the same random seed draws the same genes as the original python loop
+	Without a seed the state of the random module is used and advanced, with a seed it is left untouched
+	"""
+	#gene x pathway matrix
+	pathway_list = list(pathways)
+	incidence = pathway_incidence(gene_list, pathway_list, gene_pathway_dict)
+	patient_distribution, genes_distribution = run_simulations(incidence, gene_loss_vector, number_of_simulations, seed, workers, shards)
+	#split to pathways
+	background_patient_distribution = dict(zip(pathway_list, patient_distribution))
+	background_genes_distribution = dict(zip(pathway_list, genes_distribution))
 	#return
 	return background_patient_distribution, background_genes_distribution
 
+def simulate_null(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations=100000, seed=None, workers=1, shards=None, observed=None):
+	"""
+	Simulate the null distribution of all pathways as a NullDistribution,
+	or as an ExceedanceCounter if observed (pathway_patients_dict, pathway_genes_dict) is given
+	"""
+	#gene x pathway matrix
+	pathway_list = list(pathways)
+	incidence = pathway_incidence(gene_list, pathway_list, gene_pathway_dict)
+	#streaming counts
+	if observed is not None:
+		return run_simulations(incidence, gene_loss_vector, number_of_simulations, seed, workers, shards, ExceedanceCounter(pathway_list, observed[0], observed[1]))
+	#sorted distributions
+	patient_distribution, genes_distribution = run_simulations(incidence, gene_loss_vector, number_of_simulations, seed, workers, shards)
+	#return
+	return NullDistribution(pathway_list, patient_distribution, genes_distribution)
+
+def load_null_distribution(path):
+	"""
+	Load NullDistribution saved by NullDistribution.save
+	"""
+	with np.load(path) as null_file:
+		return NullDistribution([str(i) for i in null_file["pathways"]], null_file["patient_distribution"], null_file["genes_distribution"], is_sorted=True)
+
+def null_cache_key(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations, seed, shards):
+	"""
+	Hash everything the simulated null depends on: gene universe, pathway incidence, gene loss vector, number of simulations, seed and shards
+	"""
+	pathway_list = list(pathways)
+	incidence = pathway_incidence(gene_list, pathway_list, gene_pathway_dict)
+	key = hashlib.sha1()
+	key.update("\n".join(gene_list).encode("utf-8"))
+	key.update("\n".join(pathway_list).encode("utf-8"))
+	for array in [incidence.indptr, incidence.indices, incidence.data]: key.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+	fractions, lengths = loss_arrays(gene_loss_vector)
+	key.update(np.asarray(lengths, dtype=np.int64).tobytes())
+	key.update(fractions.tobytes())
+	key.update(("%s %s %s" % (number_of_simulations, seed, shards)).encode("utf-8"))
+	#return
+	return key.hexdigest()
+
+def evict_null_cache(cache_dir, max_size):
+	"""
+	Remove least recently used cached distributions until the cache is at most max_size bytes
+	"""
+	cached = [os.path.join(cache_dir, i) for i in os.listdir(cache_dir) if i.endswith(".npz")]
+	cached = sorted([(os.path.getmtime(i), os.path.getsize(i), i) for i in cached])
+	total = sum([i[1] for i in cached])
+	#oldest first
+	for mtime, size, path in cached:
+		if total <= max_size: break
+		try: os.remove(path)
+		except OSError: continue
+		total -= size
+
+def cached_null(gene_list, gene_loss_vector, pathways, gene_pathway_dict, cache_dir, max_size, number_of_simulations=100000, seed=None, workers=1, shards=None):
+	"""
+	Get NullDistribution from cache_dir if the same null was simulated before, otherwise simulate and cache it
+	"""
+	#effective number of shards is part of the key
+	if shards is None: shards = workers
+	shards = max(1, min(shards, number_of_simulations))
+	key = null_cache_key(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations, seed, shards)
+	path = os.path.join(cache_dir, "%s.npz" % key)
+	#load if exists, mark as used
+	if os.path.isfile(path):
+		os.utime(path, None)
+		return load_null_distribution(path)
+	#simulate and cache
+	null_distribution = simulate_null(gene_list, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations, seed, workers, shards)
+	write_metabolic_pathways.mkdir(cache_dir)
+	null_distribution.save(path)
+	evict_null_cache(cache_dir, max_size)
+	#return
+	return null_distribution
+
+def adaptive_p_vals(gene_list, gene_loss_vector, pathways, gene_pathway_dict, pathway_patients_dict, pathway_genes_dict, number_of_simulations=100000, exceedances=10, seed=None, first_block=1000):
+	"""
+	Sequential Monte Carlo p-values (Besag and Clifford 1991). Each pathway statistic is simulated until exceedances simulations
+	reach its observed value, giving p = exceedances / simulations used, or until number_of_simulations are used, giving
+	p = (exceedances + 1) / (simulations + 1), so no p-value is 0.
+	Pathways whose both statistics stopped are left out of the incidence products of later blocks, and simulation ends once all pathways stopped.
+	Until then every block still draws lost genes over all genes, so the cost of drawing is not reduced.
+	Return p-values and the number of simulations used for each p-value.
+	"""
+	#gene x pathway matrix
+	pathway_list = list(pathways)
+	incidence = pathway_incidence(gene_list, pathway_list, gene_pathway_dict)
+	random_state = python_random_state(seed)
+	#observed values and exceedance counters per statistic, rows are patients and genes
+	observed = np.array([[float(pathway_patients_dict[pathway]) for pathway in pathway_list], [float(pathway_genes_dict[pathway]) for pathway in pathway_list]])
+	counts = np.zeros(observed.shape, dtype=np.int64)
+	used = np.zeros(observed.shape, dtype=np.int64)
+	stopped = np.zeros(observed.shape, dtype=bool)
+	#simulate in growing blocks
+	done = 0
+	block = first_block
+	while done < number_of_simulations:
+		active = np.nonzero(~stopped.all(axis=0))[0]
+		if len(active) == 0: break
+		size = min(block, number_of_simulations - done)
+		patient_distribution, genes_distribution = simulate_distributions(incidence[:, active], gene_loss_vector, size, random_state)
+		#iterate through statistics
+		for n, distribution in enumerate([patient_distribution, genes_distribution]):
+			running = ~stopped[n, active]
+			exceeded = np.cumsum(distribution[running] >= observed[n, active[running]][:, np.newaxis], axis=1) + counts[n, active[running]][:, np.newaxis]
+			#simulation at which the statistic reached its exceedances
+			reached = exceeded >= exceedances
+			stop = reached.any(axis=1)
+			columns = active[running]
+			counts[n, columns] = np.where(stop, exceedances, exceeded[:, -1])
+			used[n, columns] = np.where(stop, done + reached.argmax(axis=1) + 1, done + size)
+			stopped[n, columns] = stop
+		done += size
+		block *= 2
+	#calculate p_values, statistics that did not stop count the observed value as a simulation
+	p_vals = np.where(stopped, counts.astype(np.float64) / used, (counts + 1.0) / (used + 1))
+	patient_p_vals = dict(zip(pathway_list, p_vals[0]))
+	genes_p_vals = dict(zip(pathway_list, p_vals[1]))
+	patient_simulations = dict(zip(pathway_list, used[0]))
+	genes_simulations = dict(zip(pathway_list, used[1]))
+	#return
+	return patient_p_vals, genes_p_vals, patient_simulations, genes_simulations
+
+def poisson_binomial_tail(hit_probabilities, observed):
+	"""
+	Exact probability that at least observed of independent patients are hit, patients are given as {hit probability: number of patients}
+	"""
+	#convolve binomial distribution of each group of patients with the same probability
+	pmf = np.ones(1)
+	for probability in hit_probabilities:
+		number = hit_probabilities[probability]
+		pmf = np.convolve(pmf, stats.binom.pmf(np.arange(number + 1), number, probability))
+	#tail
+	threshold = int(np.ceil(observed))
+	if threshold <= 0: return 1.0
+	#return
+	return min(1.0, float(pmf[threshold:].sum()))
+
+def compound_tail(damage_pmfs, observed, resolution):
+	"""
+	Probability that the summed damage of independent draws is at least observed, draws are given as a list of
+	(pmf of damage on a grid of step resolution, number of draws). Tail mass beyond the Hoeffding bound for 1e-300 is ignored.
+	"""
+	#mean and hoeffding bound for the sum
+	mean = sum([number * np.dot(np.arange(len(pmf)), pmf) for pmf, number in damage_pmfs])
+	squared_ranges = sum([number * (len(pmf) - 1) ** 2 for pmf, number in damage_pmfs])
+	threshold = int(np.ceil(round(observed / resolution, 6)))
+	full_length = int(sum([number * (len(pmf) - 1) for pmf, number in damage_pmfs])) + 1
+	length = min(full_length, max(int(np.ceil(mean + np.sqrt(squared_ranges * 690.0 / 2))) + 2, threshold + 1))
+	if threshold <= 0: return 1.0
+	if threshold >= length: return 0.0
+	#distribution of the sum is the product of powers of the transforms
+	spectrum = np.ones(length // 2 + 1, dtype=np.complex128)
+	for pmf, number in damage_pmfs:
+		spectrum *= np.fft.rfft(pmf, length) ** number
+	pmf = np.clip(np.fft.irfft(spectrum, length), 0, None)
+	#return
+	return min(1.0, float(pmf[threshold:].sum()))
+
+def exact_p_vals(gene_list, gene_loss_vector, pathways, gene_pathway_dict, pathway_patients_dict, pathway_genes_dict, resolution=0.01):
+	"""
+	Calculate p-values from the exact null of simulate_pathways_vectorized instead of simulating.
+	Each lost gene is a uniform draw from gene_list, so a patient with n lost genes is hit by a pathway with probability
+	1 - (1 - q)^n where q is the fraction of gene_list in the pathway, and the number of patients is Poisson-binomial.
+	Gene damage is the sum of the lost fractions times the number of times the drawn gene is in the pathway,
+	its distribution is computed on a grid of step resolution, lost fractions are rounded to the grid so there are at most 1/resolution + 1 of them.
+	"""
+	#gene x pathway matrix
+	pathway_list = list(pathways)
+	incidence = pathway_incidence(gene_list, pathway_list, gene_pathway_dict).tocsc()
+	number_of_genes = float(len(gene_list))
+	#number of patients with each number of lost genes
+	all_fractions, lengths = loss_arrays(gene_loss_vector)
+	patient_sizes = np.bincount(lengths, minlength=1)
+	#number of draws with each fraction, in grid steps
+	steps, step_counts = np.unique(np.round(all_fractions / resolution).astype(np.int64), return_counts=True)
+	patient_p_vals = {}
+	genes_p_vals = {}
+	#iterate through pathways
+	for n, pathway in enumerate(pathway_list):
+		#times genes are in the pathway and probability of drawing them
+		values, value_counts = np.unique(incidence.data[incidence.indptr[n]:incidence.indptr[n + 1]], return_counts=True)
+		value_probabilities = value_counts / number_of_genes
+		hit_probability = value_probabilities.sum()
+		#patients p-value
+		hit_probabilities = {}
+		for size in np.nonzero(patient_sizes)[0]:
+			if size == 0: continue
+			probability = 1 - (1 - hit_probability) ** size
+			hit_probabilities[probability] = hit_probabilities.get(probability, 0) + int(patient_sizes[size])
+		patient_p_vals[pathway] = poisson_binomial_tail(hit_probabilities, float(pathway_patients_dict[pathway]))
+		#genes p-value
+		damage_pmfs = []
+		for step, number in zip(steps, step_counts):
+			indices = np.round(step * values).astype(np.int64)
+			pmf = np.bincount(indices, weights=value_probabilities, minlength=1)
+			pmf[0] += 1 - hit_probability
+			damage_pmfs.append((pmf, int(number)))
+		genes_p_vals[pathway] = compound_tail(damage_pmfs, float(pathway_genes_dict[pathway]), resolution)
+	#return
+	return patient_p_vals, genes_p_vals
+
 def get_p_vals(pathway_patients_dict, pathway_genes_dict, background_patient_distribution, background_genes_distribution):
 	"""
 	Calculate a p-value for each pathway based on its distribution
@@ -129,16 +608,18 @@ def get_p_vals(pathway_patients_dict, pathway_genes_dict, background_patient_dis
 		#get experiment
 		number = pathway_patients_dict[pathway]
 		#get background
-		affected_at_least = sum([1 for i in background_patient_distribution[pathway] if i >= float(number)])
+		background = np.asarray(background_patient_distribution[pathway])
+		affected_at_least = np.count_nonzero(background >= float(number))
 		#calculate p_value
-		patient_p_vals[pathway] = float(affected_at_least) / len(background_patient_distribution[pathway])
+		patient_p_vals[pathway] = float(affected_at_least) / len(background)
 		#continue to genes p-value
 		#get experiment
 		number = pathway_genes_dict[pathway]
 		#get background
-		affected_at_least = sum([1 for i in background_genes_distribution[pathway] if i >= float(number)])
+		background = np.asarray(background_genes_distribution[pathway])
+		affected_at_least = np.count_nonzero(background >= float(number))
 		#calculate p_value
-		genes_p_vals[pathway] = float(affected_at_least) / len(background_genes_distribution[pathway])
+		genes_p_vals[pathway] = float(affected_at_least) / len(background)
 	#return results
 	return patient_p_vals, genes_p_vals
 
@@ -148,7 +629,7 @@ def correct_multiple_hypotheses(p_value_dict, alpha):
 	#initialize adjusted p values dict
 	padjust_dict = {}
 	#run multiple hypothesis correction in python using the Benjamini-Hochberg method
-	truths, padjust, correctedp1, correctedp2 = multipletests(p_value_dict.values(), alpha*2, method = 'fdr_bh')
+	truths, padjust, correctedp1, correctedp2 = multipletests(list(p_value_dict.values()), alpha*2, method = 'fdr_bh')
 	#define p_adjust dict
 	for index, pathway in enumerate(p_value_dict.keys()):
 		padjust_dict[pathway] = padjust[index]
@@ -179,17 +660,8 @@ def read_metabolic_pathways(lost_genes_files, workdir, metabolic=False):
 	for line in content:
 		split_line = line.strip().split()
 		pathway_genes_dict[split_line[0]] = float(split_line[1])
-	#get gene loss vector
-	if metabolic: gene_loss_vector_file = os.path.join(workdir,"metabolic_gene_loss_vector.txt")
-	else: gene_loss_vector_file = os.path.join(workdir,"gene_loss_vector.txt")
-	gene_loss_vector = []
-	with open(gene_loss_vector_file ) as fl: content = fl.readlines()
-	for line in content:
-		split_line = line.strip().replace("[","").replace("]","").split(", ")
-		if not split_line[0]:
-			gene_loss_vector.append([])
-			continue
-		gene_loss_vector.append([float(i) for i in split_line])
+	#get gene loss vector, memory mapped
+	gene_loss_vector = write_metabolic_pathways.read_loss_vector(workdir, metabolic)
 	
 	#return
 	return pathway_patients_dict, pathway_genes_dict, gene_loss_vector
@@ -213,49 +685,75 @@ def switch_dict(the_dict):
 def main(argv=None):
 	#process command line
 	settings = process_command_line(argv)
-	#list file in reference directory
-	onlyfiles = [os.path.join(settings.reference_directory, f) for f in os.listdir(settings.reference_directory) if os.path.isfile(os.path.join(settings.reference_directory, f))]
-	#get ncbi files
-	cds_file = [i for i in onlyfiles if i.endswith("_cds_from_genomic.fna.gz")][0]
-	rna_file = [i for i in onlyfiles if i.endswith("_rna_from_genomic.fna.gz")][0]
-	protein_file = [i for i in onlyfiles if i.endswith("_protein.faa.gz")][0]
+	#record stages, regular and metabolic runs share the workdir
+	if settings.metabolic: report_file = os.path.join(settings.workdir, "enrichment_metabolic_report.json")
+	else: report_file = os.path.join(settings.workdir, "enrichment_report.json")
+	with instrumentation.recording(report_file, settings.profile, settings.trace_memory):
+		find_enriched_pathways(settings)
+
+def find_enriched_pathways(settings):
+	"""
+	Find pathways affected in more patients or genes than expected by chance and print them
+	"""
+	#get reference, parsed once per reference directory
+	bundle = reference_bundle.load_bundle(settings.reference_directory, settings.kegg_file, settings.pathway_descriptions)
 	#get gene list
-	genes_list = proteins_list(protein_file)
+	genes_list = bundle.protein_list()
 	#get pathways
-	if settings.locus_file: pathways, cds_dict = create_pathways.main([settings.kegg_file, cds_file, rna_file, settings.locus_file])
-	else: pathways, cds_dict = create_pathways.main([settings.kegg_file, cds_file, rna_file])
+	pathways = bundle.pathways()
 	#get gene: pathway dict
 	gene_pathway_dict = switch_dict(pathways)
 	#get list of metabolic proteins
-	pathway_proteins = pathways.values()
-	metabolic_proteins = list(set(itertools.chain.from_iterable(pathway_proteins)))
+	metabolic_proteins = bundle.metabolic_proteins()
+	descriptions = bundle.descriptions()
 	#count how many times each pathway was affected in two ways: number of patients and number of genes
 	#run write_metabolic_pathways with skip
-	arguements = argparse.Namespace(workdir=settings.workdir, lost_genes_files=settings.lost_genes_files, reference_directory=settings.reference_directory, kegg_file=settings.kegg_file, locus_file=settings.locus_file, skip=False)
-	write_metabolic_pathways.main(arguements)
+	with instrumentation.stage("write_metabolic_pathways"):
+		arguements = argparse.Namespace(workdir=settings.workdir, lost_genes_files=settings.lost_genes_files, reference_directory=settings.reference_directory, kegg_file=settings.kegg_file, locus_file=settings.locus_file, pathway_descriptions=settings.pathway_descriptions, skip=False, incremental=True)
+		write_metabolic_pathways.main(arguements)
 	#read results
-	pathway_patients_dict, pathway_genes_dict, gene_loss_vector = read_metabolic_pathways(settings.lost_genes_files, settings.workdir, settings.metabolic)
-	#simulated background distribution
-	if not settings.metabolic: background_patient_distribution, background_genes_distribution = simulate_pathways(genes_list, gene_loss_vector, pathways, gene_pathway_dict)
-	else: background_patient_distribution, background_genes_distribution = simulate_pathways(metabolic_proteins, gene_loss_vector, pathways, gene_pathway_dict)
-	#get p-values for all pathways
-        #print pathway_patients_dict
-        #exit()
-	patient_p_vals, genes_p_vals = get_p_vals(pathway_patients_dict, pathway_genes_dict, background_patient_distribution, background_genes_distribution)
-        #print patient_p_vals
-        #exit()
+	with instrumentation.stage("read_metabolic_pathways"):
+		pathway_patients_dict, pathway_genes_dict, gene_loss_vector = read_metabolic_pathways(settings.lost_genes_files, settings.workdir, settings.metabolic)
+	#simulation mode
+	if not settings.metabolic: simulation_genes = genes_list
+	else: simulation_genes = metabolic_proteins
+	#exact null
+	if settings.exact:
+		with instrumentation.stage("exact_p_vals", pathways=len(pathways)):
+			patient_p_vals, genes_p_vals = exact_p_vals(simulation_genes, gene_loss_vector, pathways, gene_pathway_dict, pathway_patients_dict, pathway_genes_dict, resolution=settings.resolution)
+	#sequential p-values, report number of simulations used
+	elif settings.adaptive:
+		with instrumentation.stage("adaptive_p_vals", pathways=len(pathways)):
+			patient_p_vals, genes_p_vals, patient_simulations, genes_simulations = adaptive_p_vals(simulation_genes, gene_loss_vector, pathways, gene_pathway_dict, pathway_patients_dict, pathway_genes_dict, number_of_simulations=settings.simulations, exceedances=settings.adaptive, seed=settings.seed)
+	#seeded nulls are reproducible and can be cached
+	elif settings.seed is not None and settings.cache_size > 0:
+		if settings.cache_dir: cache_dir = settings.cache_dir
+		else: cache_dir = os.path.join(settings.workdir, "null_cache")
+		with instrumentation.stage("simulate_pathways", simulations=settings.simulations, workers=settings.workers, cached=True):
+			null_distribution = cached_null(simulation_genes, gene_loss_vector, pathways, gene_pathway_dict, cache_dir, settings.cache_size * 2**20, number_of_simulations=settings.simulations, seed=settings.seed, workers=settings.workers, shards=settings.shards)
+		with instrumentation.stage("get_p_vals"):
+			patient_p_vals, genes_p_vals = null_distribution.p_values(pathway_patients_dict, pathway_genes_dict)
+	else:
+		#count simulations reaching the observed values, the distributions themselves are not kept
+		with instrumentation.stage("simulate_pathways", simulations=settings.simulations, workers=settings.workers, cached=False):
+			counter = simulate_null(simulation_genes, gene_loss_vector, pathways, gene_pathway_dict, number_of_simulations=settings.simulations, seed=settings.seed, workers=settings.workers, shards=settings.shards, observed=(pathway_patients_dict, pathway_genes_dict))
+		#get p-values for all pathways
+		with instrumentation.stage("get_p_vals"):
+			patient_p_vals, genes_p_vals = counter.p_values()
 	#correct for multiple hypotheses
 	corrected_patient_p_vals = correct_multiple_hypotheses(patient_p_vals, settings.alpha)
 	corrected_genes_p_vals = correct_multiple_hypotheses(genes_p_vals, settings.alpha)
 	#oputput significnat pathways
-	print "patients"
+	print("patients")
 	for pathway in corrected_patient_p_vals:
 		if corrected_patient_p_vals[pathway] <= 2*settings.alpha:
-			print pathway_dict.main([pathway, settings.pathway_descriptions]), corrected_patient_p_vals[pathway]
-	print "genes"
+			if settings.adaptive and not settings.exact: print([descriptions[pathway]], corrected_patient_p_vals[pathway], patient_simulations[pathway])
+			else: print([descriptions[pathway]], corrected_patient_p_vals[pathway])
+	print("genes")
 	for pathway in corrected_genes_p_vals:
 		if corrected_genes_p_vals[pathway] <= 2*settings.alpha:
-			print pathway_dict.main([pathway, settings.pathway_descriptions]), corrected_genes_p_vals[pathway]
+			if settings.adaptive and not settings.exact: print([descriptions[pathway]], corrected_genes_p_vals[pathway], genes_simulations[pathway])
+			else: print([descriptions[pathway]], corrected_genes_p_vals[pathway])
 
 if __name__ == "__main__":
 		exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Timing and memory instrumentation of pipeline stages
+Stages are named context managers that record wall time, CPU time and peak RSS, and optionally peak traced memory and cProfile stats.
+Peak RSS is the peak of the whole process so far, a stage also records how much it raised that peak.
+Entry points record their stages and write them as a JSON report next to their outputs.
+"""
+
+import sys, os
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+try: import resource
+except ImportError: resource = None
+try: import tracemalloc
+except ImportError: tracemalloc = None
+
+#records of all finished stages of this process
+records = []
+#names of running stages
+running = []
+#options of the outermost recording
+options = {"profile_dir": None, "trace_memory": False}
+#profiler of the running stage, cProfile can not be nested
+active_profiler = [None]
+#peak traced memory of running stages, children are measured separately and added to their parents
+traced_peaks = []
+
+def peak_rss():
+	"""
+	Peak resident set size of this process since it started in KB, None if unknown
+	"""
+	if resource is None: return None
+	maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	#macOS reports bytes
+	if sys.platform == "darwin": maximum //= 1024
+	#return
+	return maximum
+
+def cpu_time():
+	"""
+	User and system CPU time of this process
+	"""
+	if hasattr(time, "process_time"): return time.process_time()
+	times = os.times()
+	return times[0] + times[1]
+
+def wall_time():
+	"""
+	Monotonic wall clock when available
+	"""
+	if hasattr(time, "perf_counter"): return time.perf_counter()
+	return time.time()
+
+def trace_memory():
+	"""
+	Check if traced memory is recorded
+	"""
+	return options["trace_memory"] and tracemalloc is not None
+
+def profile_file(profile_dir, name):
+	"""
+	cProfile stats file of a stage
+	"""
+	return os.path.join(profile_dir, "%s.prof" % "".join([i if i.isalnum() or i in "-_=." else "_" for i in name]))
+
+@contextmanager
+def stage(name, **details):
+	"""
+	Record a stage, nested stages are named by their path of stage names, details are written to the report
+	"""
+	running.append(str(name))
+	path = "/".join(running)
+	#traced memory
+	if trace_memory():
+		if traced_peaks and hasattr(tracemalloc, "reset_peak"):
+			traced_peaks[-1] = max(traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+		traced_peaks.append(0)
+	#profile outermost profiled stage
+	profiler = None
+	if options["profile_dir"] and active_profiler[0] is None:
+		profiler = cProfile.Profile()
+		active_profiler[0] = profiler
+		profiler.enable()
+	rss_start = peak_rss()
+	wall_start = wall_time()
+	cpu_start = cpu_time()
+	try:
+		yield details
+	finally:
+		record = {"stage": path, "wall": wall_time() - wall_start, "cpu": cpu_time() - cpu_start, "process_peak_rss_kb": peak_rss()}
+		#peak is cumulative, the stage raised it by the difference
+		if rss_start is not None: record["peak_rss_growth_kb"] = record["process_peak_rss_kb"] - rss_start
+		if profiler is not None:
+			profiler.disable()
+			active_profiler[0] = None
+			if not os.path.isdir(options["profile_dir"]): os.makedirs(options["profile_dir"])
+			profiler.dump_stats(profile_file(options["profile_dir"], path))
+		if trace_memory() and traced_peaks:
+			traced_peak = max(traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+			record["traced_peak"] = traced_peak
+			if traced_peaks: traced_peaks[-1] = max(traced_peaks[-1], traced_peak)
+			if hasattr(tracemalloc, "reset_peak"): tracemalloc.reset_peak()
+		if details: record["details"] = details
+		records.append(record)
+		running.pop()
+
+def detach():
+	"""
+	Forget stages and options inherited from the parent process, called when a pool process starts
+	"""
+	del records[:]
+	del running[:]
+	del traced_peaks[:]
+	active_profiler[0] = None
+	options["profile_dir"] = None
+	options["trace_memory"] = False
+
+def extend(stage_records):
+	"""
+	Add records of stages run in pool processes, they are named as stages nested in the running stage
+	"""
+	for record in stage_records:
+		record = dict(record)
+		record["stage"] = "/".join(running + [record["stage"]])
+		records.append(record)
+
+@contextmanager
+def recording(report_file=None, profile=False, trace=False, profile_dir=None):
+	"""
+	Record stages of an entry point and write them to report_file, the yielded list is filled with the records when done
+	cProfile stats of each outermost stage are written to profile_dir, by default a directory next to the report, if profile is True
+	"""
+	start = len(records)
+	result = []
+	#options are set by the outermost recording
+	outermost = not running and options["profile_dir"] is None and not options["trace_memory"]
+	if outermost:
+		if profile and profile_dir: options["profile_dir"] = profile_dir
+		elif profile and report_file: options["profile_dir"] = os.path.splitext(report_file)[0] + "_profiles"
+		options["trace_memory"] = trace
+		if trace_memory() and not tracemalloc.is_tracing(): tracemalloc.start()
+	try:
+		yield result
+	finally:
+		result.extend(records[start:])
+		if outermost:
+			if trace_memory(): tracemalloc.stop()
+			options["profile_dir"] = None
+			options["trace_memory"] = False
+			#records are only kept until the outermost recording is done
+			del records[start:]
+		if report_file: write_report(report_file, result)
+
+def write_report(report_file, stage_records):
+	"""
+	Write stage records as JSON, a report that can not be written does not fail the run
+	"""
+	report = {"argv": sys.argv, "pid": os.getpid(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": stage_records}
+	try:
+		directory = os.path.dirname(report_file)
+		if directory and not os.path.isdir(directory): os.makedirs(directory)
+		with open(report_file, "w") as outfl: json.dump(report, outfl, indent=1, default=str)
+	except (OSError, IOError) as exc: sys.stderr.write("Could not write report %s: %s\n" % (report_file, exc))
@@ -8,7 +8,8 @@ Also needs to recieve the KEGG and the cds_from_genomic file
 """
 
 import os,sys
-from Bio import SeqIO
+import re
+import itertools
 import gzip as gz
 import warnings
 
@@ -29,30 +30,63 @@ def parse_kegg(kegg_file):
     #return
     return kegg_dict
 
+#header lines and locus tag fields of fasta files
+HEADER_PATTERN = re.compile(b"^>([^\n]*)", re.M)
+LOCUS_TAG_PATTERN = re.compile(r"\S*locus_tag=\S*")
+
+def fasta_headers(fasta_file, block_size=2**22):
+    """
+    Stream the header lines of a gzipped fasta file (without ">"), reading large blocks and never building sequences
+    """
+    remainder = b""
+    with gz.open(fasta_file, "rb") as fl:
+        while True:
+            block = fl.read(block_size)
+            if not block: break
+            #blocks are cut after the last full line, the rest waits for the next block
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            remainder = block[end:]
+            for header in HEADER_PATTERN.findall(block, 0, end):
+                yield decode_header(header)
+    #last line
+    for header in HEADER_PATTERN.findall(remainder):
+        yield decode_header(header)
+
+def decode_header(header):
+    """
+    Header bytes to str, stripped like SeqIO titles
+    """
+    if sys.version_info[0] >= 3: header = header.decode("latin-1")
+    return header.rstrip()
+
 def parse_cds(cds_file, rna_file):
     """
     Parse kegg to dict
     """
     #initialzie dict
     cds_dict = {}
-    #parse file
-    with gz.open(cds_file) as fl: genes = list(SeqIO.parse(fl,"fasta"))
-    with gz.open(rna_file) as fl: genes += list(SeqIO.parse(fl,"fasta"))
-    #iterate through genes
-    for gene in genes:
-        description = gene.description.split()
-        if "locus_tag" not in gene.description:
-            #warnings.warn("No locus tag in CDS file %s" % gene.description)
+    #iterate through gene headers
+    for description in itertools.chain(fasta_headers(cds_file), fasta_headers(rna_file)):
+        if "locus_tag" not in description:
+            #warnings.warn("No locus tag in CDS file %s" % description)
             continue
-        if "cds" in description[0]: protein_name = description[0].split("cds_")[1].rsplit("_",1)[0]#.split(".")[0]
-        if "rna" in description[0]: protein_name = description[0].split("rna_")[1].rsplit("_",1)[0]#.split(".")[0]
+        name = description.split(None, 1)[0]
+        if "cds" in name: protein_name = name.split("cds_")[1].rsplit("_",1)[0]#.split(".")[0]
+        if "rna" in name: protein_name = name.split("rna_")[1].rsplit("_",1)[0]#.split(".")[0]
         #gene_id = [i for i in description if "GeneID" in i][0].replace("[","").replace("]","").split(":")[1]
-        locus_tag = [i for i in description if "locus_tag=" in i][0].replace("[","").replace("]","").split("=")[1]
+        locus_tag = LOCUS_TAG_PATTERN.search(description).group(0).replace("[","").replace("]","").split("=")[1]
         #cds_dict[gene_id] = protein_name
         cds_dict[locus_tag] = protein_name
     #return
     return cds_dict
 
+def proteins_list(protein_file):
+    """
+    Get names of proteins from protein file
+    """
+    return [header.split(None, 1)[0] for header in fasta_headers(protein_file) if header] # i.id.split(".")[0]
+
 def main(args):
     #get input
     input = args[0]
@@ -7,16 +7,45 @@ Clustering patients by metabolic pathways that were affected during their
 import sys, os
 import numpy as np
 import itertools
+import multiprocessing
+import tempfile
+import shutil
 #Clustering utilities from sklearn
 from sklearn.cluster import KMeans, SpectralClustering
 from sklearn.mixture import GaussianMixture
-from sklearn.metrics import silhouette_samples, silhouette_score
+from sklearn.metrics import silhouette_samples, silhouette_score, calinski_harabasz_score, davies_bouldin_score
 import scipy.stats as stats
+from scipy.spatial.distance import pdist, cdist
+from scipy import sparse
+from scipy.sparse.csgraph import laplacian
+from scipy.linalg import eigh
+from sklearn.metrics.pairwise import rbf_kernel, euclidean_distances
 #Plotting and clustering personal scripts
 import spectral_clustering
-from metabolic_plotting import plot_pca, plot_clusters, clustering_pathways_by_jaccard
 #general utilities
 from FDR import correct_multiple_hypotheses
+import instrumentation
+
+#distances of pool processes, by file
+loaded_distances = {}
+#criteria choosing the number of clusters, silhouette is quadratic in patients and the others are linear
+CRITERIA = ["silhouette", "calinski_harabasz", "davies_bouldin", "simplified_silhouette", "bic"]
+#fitted parameters of GaussianMixture that predict probabilities
+GMM_PARAMETERS = ["weights_", "means_", "covariances_", "precisions_cholesky_"]
+#smallest absolute eigenvalue of the random walk matrix of spectral components that new patients are embedded in
+MIN_WALK_EIGENVALUE = 0.1
+#cluster number of clusters of a model without patients of the cohort, they are not in Clusters.txt
+UNASSIGNED = 0
+#variables read by BLAS and OpenMP libraries for their number of threads when they are loaded
+BLAS_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def plotting():
+	"""
+	Import metabolic_plotting when a plot is made, it loads matplotlib, seaborn and pandas which take seconds
+	"""
+	import metabolic_plotting
+	#return
+	return metabolic_plotting
 
 def convert_to_lists(clustering_patients_dict):
 	#convert patients dict to format of dict[patient] = list_of_pathways
@@ -28,95 +57,413 @@ def convert_to_lists(clustering_patients_dict):
 	#return
 	return jaccard_dict
 
-def convert_to_binary_vectors(clustering_patients_dict):
-	#convert patients dict to format of dict[patient] = vector_of_0s_and_1s_corresponding_to_pathways
-	binary_dict = {}
-	#get sorted pathways
-	all_keys = []
-	for patient in clustering_patients_dict:
-		all_keys += [i for i in clustering_patients_dict[patient].keys() if clustering_patients_dict[patient][i] != 0]
-	sorted_keys = sorted(set(all_keys))
-	#created vector for each patient
-	for patient in clustering_patients_dict:
-		#initialize
-		binary_dict[patient] = []
-		#add all pathways
-		for i in sorted_keys:
-			if i in clustering_patients_dict[patient] and clustering_patients_dict[patient][i] != 0: binary_dict[patient].append(clustering_patients_dict[patient][i])
-			else: binary_dict[patient].append(0)
-		#another possiblity is just using the keys that everyone has! Maybe that's more fair
-		#binary_dict[patient] = [clustering_patients_dict[patient][i] for i in sorted_keys]
-		if 1 not in binary_dict[patient]: del binary_dict[patient]
-	#return
-	return binary_dict,sorted_keys
-
-def convert_to_vectors(clustering_genes_dict):
-	#convert patients dict to format of dict[patient] = vector_of_floats_corresponding_to_pathways
-	vector_dict = {}
-	#get sorted pathways
-	all_keys = []
-	for patient in clustering_genes_dict:
-		all_keys += [i for i in clustering_genes_dict[patient].keys() if clustering_genes_dict[patient][i] != 0]
-	sorted_keys = sorted(set(all_keys))
-	#sorted_keys = sorted(clustering_genes_dict[patient].keys())
-	#created vector for each patient
-	for patient in clustering_genes_dict:
-		#initialize
-		vector_dict[patient] = []
-		#add all pathways
-		for i in sorted_keys:
-			if i in clustering_genes_dict[patient] and clustering_genes_dict[patient][i] != 0: vector_dict[patient].append(clustering_genes_dict[patient][i])
-			else: vector_dict[patient].append(0)
-		#vector_dict[patient] = [clustering_genes_dict[patient][i] for i in sorted_keys]
-		if len(set(vector_dict[patient])) == 1: del vector_dict[patient]
-	#keys
-	clear_keys = [i for i in sorted_keys]
-	#return
-	return vector_dict,clear_keys
-
-def clustering_pathways_by_vectors(vector_array, max_num, method='kmeans', k=0):
+def convert_to_matrix(patients_dict, binary=False):
 	"""
-	Cluster numeric or binary vector by either kmeans or gmm clustering method
+	Sparse patient x pathway CSR matrix of the nonzero values of patients_dict, return it with the patients of its rows and the sorted pathways of its columns
+	Pathways are those with a nonzero value in any patient, binary patients without a 1 and numeric patients with one value in all pathways are removed
 	"""
-	#limit to 100 clusters
-	max_num = min(max_num, 50)
-	#check different numbers of clusters to choose best
-	range_n_clusters = list(range(2,max_num + 1))
-	#initialize bic if that's what we're gonna use
-	best = np.infty
-	#initialize list oof bics or silhouettes of the different models
-	measures = []
-	#cluster
-	for n_clusters in range_n_clusters:
+	patients = list(patients_dict)
+	sorted_keys = sorted(set([pathway for patient in patients for pathway in patients_dict[patient] if patients_dict[patient][pathway] != 0]))
+	key_index = dict((key, n) for n, key in enumerate(sorted_keys))
+	indptr = [0]
+	indices = []
+	values = []
+	for patient in patients:
+		row = sorted([(key_index[pathway], value) for pathway, value in patients_dict[patient].items() if value != 0])
+		indices += [i[0] for i in row]
+		values += [i[1] for i in row]
+		indptr.append(len(indices))
+	if not values: values = np.zeros(0)
+	matrix = sparse.csr_matrix((np.array(values), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)), shape=(len(patients), len(sorted_keys)))
+	#remove binary patients without a 1 and numeric patients with one value in all pathways
+	if binary: keep = np.asarray((matrix == 1).sum(axis=1)).ravel() > 0
+	elif sorted_keys: keep = matrix.min(axis=1).toarray().ravel() != matrix.max(axis=1).toarray().ravel()
+	else: keep = np.ones(len(patients), dtype=bool)
+	#return
+	return matrix[np.flatnonzero(keep)], [patient for patient, kept in zip(patients, keep) if kept], sorted_keys
+
+def to_dense(vector_array):
+	"""
+	Dense array of a sparse matrix, for algorithms that do not take sparse matrices
+	"""
+	if sparse.issparse(vector_array): return vector_array.toarray()
+	#return
+	return vector_array
+
+def row_distances(vector_array, rows):
+	"""
+	Euclidean distances from rows of vector_array to all rows
+	"""
+	if sparse.issparse(vector_array): return euclidean_distances(vector_array[rows], vector_array)
+	#return
+	return cdist(vector_array[rows], vector_array)
+
+def condensed_distances(vector_array, block_size=1024):
+	"""
+	Condensed euclidean distances between rows of vector_array as float32, same order as scipy pdist
+	Sparse matrices are compared in blocks of rows without making them dense
+	"""
+	if not sparse.issparse(vector_array): return pdist(np.asarray(vector_array, dtype=np.float64)).astype(np.float32)
+	n = vector_array.shape[0]
+	distances = np.empty(n * (n - 1) // 2, dtype=np.float32)
+	for start in range(0, n, block_size):
+		block = row_distances(vector_array, np.arange(start, min(n, start + block_size)))
+		for i in range(start, min(n, start + block_size)):
+			offset = n * i - i * (i + 1) // 2
+			distances[offset:offset + n - i - 1] = block[i - start, i + 1:]
+	#return
+	return distances
+
+def distance_rows(distances, n, rows):
+	"""
+	Rows of the square distance matrix of n samples from condensed distances
+	"""
+	rows = np.asarray(rows)[:, None]
+	columns = np.arange(n)[None, :]
+	low = np.minimum(rows, columns)
+	high = np.maximum(rows, columns)
+	#index of pair low < high in the condensed matrix, the diagonal is zero
+	block = np.asarray(distances[n * low - low * (low + 1) // 2 + high - low - 1], dtype=np.float64)
+	block[low == high] = 0
+	#return
+	return block
+
+def load_distances(distances):
+	"""
+	Memory map condensed distances written to a file, arrays are returned as they are
+	"""
+	if not isinstance(distances, str): return distances
+	if distances not in loaded_distances: loaded_distances[distances] = np.load(distances, mmap_mode="r")
+	#return
+	return loaded_distances[distances]
+
+def encode_labels(cluster_labels):
+	"""
+	Labels as 0..k-1 and sizes of the clusters, like silhouette_score there must be 2 to n-1 clusters
+	"""
+	classes, labels = np.unique(cluster_labels, return_inverse=True)
+	if not 1 < len(classes) < len(labels): raise ValueError("Number of labels is %d. Valid values are 2 to n_samples - 1 (inclusive)" % len(classes))
+	#return
+	return labels, np.bincount(labels).astype(np.float64)
+
+def silhouette_values(block, row_labels, labels, counts):
+	"""
+	Silhouette of samples from their distances to all samples, as in sklearn silhouette_samples
+	"""
+	#sums of distances to each cluster
+	one_hot = np.zeros((len(labels), len(counts)))
+	one_hot[np.arange(len(labels)), labels] = 1
+	sums = block.dot(one_hot)
+	rows = np.arange(len(row_labels))
+	own_sizes = counts[row_labels]
+	intra = sums[rows, row_labels] / np.maximum(own_sizes - 1, 1)
+	means = sums / counts
+	means[rows, row_labels] = np.inf
+	inter = means.min(axis=1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		values = (inter - intra) / np.maximum(intra, inter)
+	#samples alone in their cluster have silhouette 0
+	values[own_sizes == 1] = 0
+	#return
+	return np.nan_to_num(values)
+
+def distance_silhouette(distances, cluster_labels, block_size=1024):
+	"""
+	Mean silhouette from condensed distances, rows of the square matrix are made in blocks
+	"""
+	labels, counts = encode_labels(cluster_labels)
+	n = len(labels)
+	total = 0.0
+	for start in range(0, n, block_size):
+		rows = np.arange(start, min(n, start + block_size))
+		total += silhouette_values(distance_rows(distances, n, rows), labels[rows], labels, counts).sum()
+	#return
+	return total / n
+
+def sampled_silhouette(vector_array, cluster_labels, sample_size, seed, block_size=1024):
+	"""
+	Mean silhouette of a random sample of samples, distances are only calculated from the sample
+	Return the estimate and its 95% confidence interval
+	"""
+	labels, counts = encode_labels(cluster_labels)
+	n = len(labels)
+	sample = np.sort(np.random.RandomState(seed).choice(n, min(sample_size, n), replace=False))
+	values = []
+	for start in range(0, len(sample), block_size):
+		rows = sample[start:start + block_size]
+		values.append(silhouette_values(row_distances(vector_array, rows), labels[rows], labels, counts))
+	values = np.concatenate(values)
+	mean = values.mean()
+	#standard error with finite population correction, a sample of all samples is exact
+	if len(values) > 1 and n > 1: error = 1.96 * values.std(ddof=1) / np.sqrt(len(values)) * np.sqrt(float(n - len(values)) / (n - 1))
+	else: error = 0.0
+	#return
+	return mean, (mean - error, mean + error)
+
+def simplified_silhouette(vector_array, cluster_labels, block_size=4096):
+	"""
+	Mean silhouette with distances to cluster centroids instead of mean distances to cluster members, linear in samples
+	"""
+	labels, counts = encode_labels(cluster_labels)
+	one_hot = np.zeros((len(labels), len(counts)))
+	one_hot[np.arange(len(labels)), labels] = 1
+	#sparse matrices give dense sums
+	centroids = np.asarray(vector_array.T.dot(one_hot)).T / counts[:, None]
+	total = 0.0
+	for start in range(0, len(labels), block_size):
+		row_labels = labels[start:start + block_size]
+		rows = np.arange(len(row_labels))
+		centroid_distances = cdist(to_dense(vector_array[start:start + block_size]), centroids)
+		intra = centroid_distances[rows, row_labels]
+		centroid_distances[rows, row_labels] = np.inf
+		inter = centroid_distances.min(axis=1)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			values = (inter - intra) / np.maximum(intra, inter)
+		#samples alone in their cluster have silhouette 0
+		values[counts[row_labels] == 1] = 0
+		total += np.nan_to_num(values).sum()
+	#return
+	return total / len(labels)
+
+def criterion_measure(vector_array, cluster_labels, criterion, model, distances, silhouette_sample, seed, details):
+	"""
+	Value of criterion for the clusters, written to details, return it as a measure where lower is better
+	"""
+	if criterion == "silhouette":
+		value = silhouette(vector_array, cluster_labels, distances, silhouette_sample, seed, details)
+		measure = -value
+	elif criterion == "calinski_harabasz":
+		value = calinski_harabasz_score(to_dense(vector_array), cluster_labels)
+		measure = -value
+	elif criterion == "davies_bouldin":
+		value = davies_bouldin_score(to_dense(vector_array), cluster_labels)
+		measure = value
+	elif criterion == "simplified_silhouette":
+		value = simplified_silhouette(vector_array, cluster_labels)
+		measure = -value
+	elif criterion == "bic":
+		if not hasattr(model, "bic"): raise Exception("BIC criterion needs gmm clustering")
+		value = model.bic(vector_array)
+		measure = value
+	else: raise Exception("Unknown criterion %s" % criterion)
+	details[criterion] = value
+	#return
+	return measure
+
+def spectral_embedding(vector_array, n_components, gamma=1.0, n_neighbors=0, seed=10):
+	"""
+	Eigenvalues and embedding of the n_components smallest eigenvectors of the normalized Laplacian of the RBF affinity, as in sklearn SpectralClustering
+	The leading k columns of the embedding are the embedding of k clusters, so it is calculated once for all numbers of clusters
+	If n_neighbors the affinity is the sparse locally scaled affinity of the n_neighbors nearest neighbours and only the leading eigenvectors are found, for large cohorts
+	"""
+	if n_neighbors:
+		affinity = spectral_clustering.knn_affinity(vector_array, n_neighbors)
+		eigenvalues, eigenvectors = spectral_clustering.sparse_spectral_embedding(affinity, n_components, seed)
+		n_components = len(eigenvalues)
+		degrees = np.asarray(affinity.sum(axis=1)).ravel()
+		degrees[degrees == 0] = 1
+		degrees = np.sqrt(degrees)
+	else:
+		affinity = rbf_kernel(vector_array, gamma=gamma)
+		normalized_laplacian, degrees = laplacian(affinity, normed=True, return_diag=True)
+		n_components = min(n_components, len(affinity))
+		try: eigenvalues, eigenvectors = eigh(normalized_laplacian, subset_by_index=[0, n_components - 1])
+		#older scipy
+		except TypeError: eigenvalues, eigenvectors = eigh(normalized_laplacian, eigvals=(0, n_components - 1))
+	embedding = eigenvectors / degrees[:, None]
+	#sign of each eigenvector is set so its largest absolute value is positive
+	signs = np.sign(embedding[np.argmax(np.abs(embedding), axis=0), np.arange(n_components)])
+	signs[signs == 0] = 1
+	#return
+	return eigenvalues, embedding * signs
+
+def spectral_labels(embedding, n_clusters, seed, n_init=42):
+	"""
+	Cluster the leading n_clusters columns of the spectral embedding with kmeans
+	"""
+	return KMeans(n_clusters=n_clusters, n_init=n_init, random_state=seed).fit_predict(embedding[:, :n_clusters])
+
+def eigengap_k(eigenvalues, max_num):
+	"""
+	Number of clusters from 2 to max_num before the largest gap between consecutive smallest eigenvalues of the Laplacian
+	"""
+	gaps = np.diff(eigenvalues[:max_num + 1])
+	#gaps[k - 1] follows the k smallest eigenvalues
+	return int(np.argmax(gaps[1:max_num])) + 2
+
+def limit_blas_threads(threads):
+	"""
+	Limit number of BLAS and OpenMP threads of this process so pool processes do not oversubscribe the CPUs
+	BLAS is already loaded with numpy, so its thread pools are limited in place with threadpoolctl if it is installed (it needs python 3)
+	Without it the environment variables are set, which only limit libraries loaded after this
+	"""
+	for variable in BLAS_VARIABLES: os.environ[variable] = str(threads)
+	try: from threadpoolctl import threadpool_limits
+	except ImportError: return
+	threadpool_limits(limits=threads)
+
+def init_worker(threads):
+	"""
+	Initialize pool process of the k sweep
+	"""
+	instrumentation.detach()
+	limit_blas_threads(threads)
+
+def silhouette(vector_array, cluster_labels, distances, silhouette_sample, seed, details):
+	"""
+	Mean silhouette from precomputed condensed distances, or estimated from a sample if there are no distances
+	"""
+	if distances is not None: return distance_silhouette(load_distances(distances), cluster_labels)
+	mean, interval = sampled_silhouette(vector_array, cluster_labels, silhouette_sample, seed)
+	details["silhouette_interval"] = interval
+	#return
+	return mean
+
+def gaussian_mixture(vector_array, n_clusters, seed, covariance_type="full", init="random", means_init=None):
+	"""
+	Fit GaussianMixture of n_clusters components
+	init random runs 42 seeded restarts, kmeans starts once from kmeans centers of the same number of clusters and warm starts once from means_init
+	"""
+	if init == "random": return GaussianMixture(n_components=n_clusters, max_iter=1000, n_init=42, covariance_type=covariance_type, random_state=seed).fit(vector_array)
+	if init == "kmeans" or means_init is None: means_init = KMeans(n_clusters=n_clusters, random_state=seed).fit(vector_array).cluster_centers_
+	#return
+	return GaussianMixture(n_components=n_clusters, max_iter=1000, n_init=1, covariance_type=covariance_type, means_init=means_init, random_state=seed).fit(vector_array)
+
+def split_means(vector_array, means):
+	"""
+	Means of one more component for a warm start, the new mean is the sample farthest from its nearest mean
+	"""
+	farthest = cdist(vector_array, means).min(axis=1).argmax()
+	#return
+	return np.vstack((means, vector_array[farthest]))
+
+def fit_k(vector_array, n_clusters, method, seed, distances=None, silhouette_sample=0, embedding=None, gmm_options=None, criterion="silhouette"):
+	"""
+	Cluster vector_array to n_clusters, return labels, measure of criterion where lower is better and the model of the clusters
+	Models are seeded with seed so each k gives the same clusters in any process
+	Silhouette is calculated from condensed distances, or from a sample of silhouette_sample samples if distances are None
+	Spectral clustering uses the spectral embedding calculated once for all numbers of clusters
+	gmm_options are the arguments of gaussian_mixture
+	"""
+	if gmm_options is None: gmm_options = {}
+	model = None
+	with instrumentation.stage("k=%d" % n_clusters, k=n_clusters) as details:
 		if method == "kmeans":
-			clusterer = KMeans(n_clusters=n_clusters, random_state=10)
-			cluster_labels = clusterer.fit_predict(vector_array)
-			measure = silhouette_score(vector_array, cluster_labels)*-1
+			model = KMeans(n_clusters=n_clusters, random_state=seed)
+			cluster_labels = model.fit_predict(vector_array)
 			#print("For n_clusters =", n_clusters, "The average silhouette_score is :", -measure)
 		elif method == "gmm":
-			clusterer = GaussianMixture(n_components=n_clusters, max_iter=1000, n_init=42, covariance_type='full').fit(vector_array)
-			cluster_labels = clusterer.predict(vector_array)
-			measure2 = clusterer.bic(vector_array)
-			#measure = clusterer.aic(vector_array)
-			measure = silhouette_score(vector_array, cluster_labels)*-1
-			print(method, n_clusters, measure2, measure)
+			model = gaussian_mixture(vector_array, n_clusters, seed, gmm_options.get("covariance_type", "full"), gmm_options.get("init", "random"), gmm_options.get("means_init"))
+			cluster_labels = model.predict(vector_array)
+			details["bic"] = model.bic(vector_array)
+			#measure = model.aic(vector_array)
 			#print("For n_clusters =", n_clusters, "The BIC score is :", measure)
 		elif method == "spectral":
 			#np.save("va.npy", vector_array)
 			#exit()
-			cluster_labels = SpectralClustering(n_clusters=n_clusters, n_init=42).fit_predict(vector_array)
+			cluster_labels = spectral_labels(embedding, n_clusters, seed)
 			#measure = clusterer.bic(vector_array)
 			#measure = clusterer.aic(vector_array)
-			measure = silhouette_score(vector_array, cluster_labels)*-1
 			#print("For n_clusters =", n_clusters, "The BIC score is :", measure)
+		#lower BIC is better like negative silhouette
+		if criterion == "bic" and method == "gmm": measure = details["bic"]
+		else: measure = criterion_measure(vector_array, cluster_labels, criterion, model, distances, silhouette_sample, seed, details)
+	#return
+	return cluster_labels, measure, model, details
 
+def fit_k_worker(arguments):
+	"""
+	Run fit_k in a pool process, return its results and records of its stage
+	"""
+	with instrumentation.recording() as stage_records:
+		results = fit_k(*arguments)
+	#return
+	return results, stage_records
+
+def fit_range(vector_array, range_n_clusters, method, seed, workers=1, distances=None, silhouette_sample=0, embedding=None, gmm_options=None, criterion="silhouette"):
+	"""
+	Run fit_k for each number of clusters, on workers processes if more than one, results are in range_n_clusters order
+	Pool processes memory map the distances from a file in shared memory instead of receiving a copy
+	Warm started gmm starts each number of clusters from the previous one so it runs in this process
+	"""
+	workers = min(workers, len(range_n_clusters))
+	if method == "gmm" and gmm_options and gmm_options.get("init") == "warm":
+		results = []
+		for n_clusters in range_n_clusters:
+			if results: gmm_options = dict(gmm_options, means_init=split_means(vector_array, results[-1][2].means_))
+			results.append(fit_k(vector_array, n_clusters, method, seed, distances, silhouette_sample, embedding, gmm_options, criterion))
+		return results
+	if workers <= 1: return [fit_k(vector_array, n_clusters, method, seed, distances, silhouette_sample, embedding, gmm_options, criterion) for n_clusters in range_n_clusters]
+	if os.path.isdir("/dev/shm"): temporary_dir = tempfile.mkdtemp(dir="/dev/shm")
+	else: temporary_dir = tempfile.mkdtemp()
+	try:
+		if distances is not None:
+			distances_file = os.path.join(temporary_dir, "distances.npy")
+			np.save(distances_file, distances)
+		else: distances_file = None
+		arguments = [(vector_array, n_clusters, method, seed, distances_file, silhouette_sample, embedding, gmm_options, criterion) for n_clusters in range_n_clusters]
+		#BLAS threads are split between the processes
+		pool = multiprocessing.Pool(workers, init_worker, (max(1, multiprocessing.cpu_count() // workers),))
+		#larger numbers of clusters are slower so they are started first
+		try: worker_results = pool.map(fit_k_worker, arguments[::-1], chunksize=1)[::-1]
+		finally:
+			pool.close()
+			pool.join()
+	finally: shutil.rmtree(temporary_dir, ignore_errors=True)
+	results = []
+	for k_results, stage_records in worker_results:
+		instrumentation.extend(stage_records)
+		results.append(k_results)
+	#return
+	return results
+
+def clustering_pathways_by_vectors(vector_array, max_num, method='kmeans', k=0, workers=1, seed=10, silhouette_sample=0, spectral_k="silhouette", gmm_init="random", covariance_type="full", criterion="silhouette", model=None, spectral_neighbors=0):
+	"""
+	Cluster numeric or binary vector by either kmeans or gmm clustering method
+	Numbers of clusters are checked on workers processes, results are the same for any number of workers
+	vector_array may be a sparse matrix, kmeans, spectral affinities and silhouettes use it as it is and gmm makes it dense
+	Silhouettes of all numbers of clusters use distances calculated once, or are estimated from silhouette_sample samples if it is smaller than the cohort
+	Number of clusters is chosen by criterion, silhouette or one of the linear criteria calinski_harabasz, davies_bouldin, simplified_silhouette and bic of gmm
+	Spectral number of clusters is chosen by criterion, or by the largest eigengap if spectral_k is eigengap
+	Spectral affinity is the sparse affinity of the spectral_neighbors nearest neighbours if spectral_neighbors, otherwise the dense RBF affinity
+	gmm starts from 42 random restarts, kmeans centers or the previous number of clusters (gmm_init random, kmeans or warm)
+	If model is a dict it is filled with the arrays of the chosen model, see model_arrays
+	"""
+	if criterion == "bic" and method != "gmm": raise Exception("BIC criterion needs gmm clustering, not %s" % method)
+	if method == "gmm": vector_array = to_dense(vector_array)
+	#limit to 100 clusters
+	max_num = min(max_num, 50)
+	#check different numbers of clusters to choose best
+	range_n_clusters = list(range(2,max_num + 1))
+	#spectral embedding is calculated once for all numbers of clusters
+	embedding = None
+	if method == "spectral":
+		with instrumentation.stage("spectral_embedding", samples=vector_array.shape[0]) as details:
+			eigenvalues, embedding = spectral_embedding(vector_array, max(max_num, k) + 1, n_neighbors=spectral_neighbors, seed=seed)
+			if spectral_k == "eigengap":
+				range_n_clusters = [eigengap_k(eigenvalues, max_num)]
+				details["eigengap_k"] = range_n_clusters[0]
+				print("eigengap number of clusters: %s" % range_n_clusters[0])
+	#initialize bic if that's what we're gonna use
+	best = np.inf
+	gmm_options = {"init": gmm_init, "covariance_type": covariance_type}
+	#initialize list oof bics or silhouettes of the different models
+	measures = []
+	#distances do not change between numbers of clusters
+	if criterion != "silhouette" or (silhouette_sample and silhouette_sample < vector_array.shape[0]): distances = None
+	else:
+		with instrumentation.stage("distances", samples=vector_array.shape[0]): distances = condensed_distances(vector_array)
+	#cluster
+	for n_clusters, results in zip(range_n_clusters, fit_range(vector_array, range_n_clusters, method, seed, workers, distances, silhouette_sample, embedding, gmm_options, criterion)):
+		cluster_labels, measure, clusterer, details = results
 		#add to list
 		measures.append(measure)
-		
+	
 		if measures[-1] < best:
 			best = measures[-1]
 			if method != "spectral": best_model = clusterer
 			best_labels = cluster_labels
+			best_k = n_clusters
 
 	#get n_cluster that are not much worse, up to 5% measure difference
 	#intialzie
@@ -132,14 +479,15 @@ def clustering_pathways_by_vectors(vector_array, max_num, method='kmeans', k=0):
 	
 	#cluster
 	if k != 0:
+		best_k = k
 		if method == "kmeans":
 			best_model = KMeans(n_clusters=k, random_state=0).fit(vector_array)
 			best_labels = best_model.predict(vector_array)
 		elif method == "gmm":
-			best_model = GaussianMixture(n_components=k, max_iter=1000, n_init=42, covariance_type='full').fit(vector_array)
+			best_model = gaussian_mixture(vector_array, k, seed, covariance_type, gmm_init)
 			best_labels = best_model.predict(vector_array)
 		elif method == "spectral":
-			best_labels = SpectralClustering(n_clusters=k, n_init=42).fit_perdict(vector_array)
+			best_labels = spectral_labels(embedding, k, seed)
 		
 	
 	#Predict probabilities		
@@ -148,18 +496,142 @@ def clustering_pathways_by_vectors(vector_array, max_num, method='kmeans', k=0):
 		#print probs.round(2)
 	else:
 		probs = 0
+	#keep model for assigning new patients
+	if model is not None:
+		if method == "spectral": model.update(model_arrays(method, None, best_labels, vector_array, embedding[:, :best_k], eigenvalues[:best_k], n_neighbors=spectral_neighbors))
+		else: model.update(model_arrays(method, best_model, best_labels, vector_array))
 	#return
 	return best_labels, probs
 
-def to_array(a_dict):
-	#initialize
-	array = 0
-	#iterate
-	for i in a_dict.keys():
-		if type(array) == int: array = np.array(list(a_dict[i]))
-		else: array = np.vstack((array, a_dict[i]))
+def model_arrays(method, fitted_model, labels, vector_array, embedding=None, eigenvalues=None, gamma=1.0, n_neighbors=0):
+	"""
+	Arrays that assign new patients to the clusters of a fitted model: kmeans centers, gmm parameters, or the spectral embedding of the cohort with its eigenvalues and the centers of its clusters
+	Features of the cohort are kept for spectral clustering, new patients are embedded by their RBF affinity to the cohort, or take the cluster of their nearest patient if the affinity was of n_neighbors nearest neighbours
+	"""
+	arrays = {"method": np.array(method), "labels": np.asarray(labels)}
+	if method == "kmeans": arrays["centers"] = fitted_model.cluster_centers_
+	elif method == "gmm":
+		arrays["covariance_type"] = np.array(fitted_model.covariance_type)
+		for name in GMM_PARAMETERS: arrays[name] = getattr(fitted_model, name)
+	elif method == "spectral":
+		arrays["features"] = to_dense(vector_array)
+		arrays["embedding"] = embedding
+		arrays["eigenvalues"] = eigenvalues
+		arrays["gamma"] = np.array(gamma)
+		arrays["n_neighbors"] = np.array(n_neighbors)
+		arrays["centers"] = np.array([embedding[labels == label].mean(axis=0) for label in range(embedding.shape[1])])
+	else: raise Exception("Unknown clustering method %s" % method)
+	#return
+	return arrays
+
+def conditioned_components(model):
+	"""
+	Mask of spectral components whose Nystrom extension is stable, eigenvalues of the random walk matrix near 0 multiply errors of new samples
+	"""
+	#eigenvalues of the random walk matrix are one minus those of the normalized Laplacian
+	return np.abs(1 - model["eigenvalues"]) >= MIN_WALK_EIGENVALUE
+
+def embed_new(model, vector_array, components):
+	"""
+	Spectral embedding of new samples in the components of the cohort embedding, by the Nystrom extension of the random walk eigenvectors
+	The extension of a sample left out of the cohort is its embedding in the cohort
+	"""
+	affinity = rbf_kernel(vector_array, model["features"], gamma=float(model["gamma"]))
+	degrees = affinity.sum(axis=1)
+	degrees[degrees == 0] = 1
 	#return
-	return array
+	return affinity.dot(model["embedding"][:, components]) / degrees[:, None] / (1 - model["eigenvalues"][components])
+
+def spectral_assign(model, vector_array):
+	"""
+	Labels of samples in the spectral clusters of the cohort
+	Samples equal to a cohort patient get its label, others the nearest center of the stable components of their embedding,
+	or the label of the nearest patient if only the first, constant component is stable or the embedding is of a nearest neighbours affinity
+	"""
+	distances = cdist(vector_array, model["features"], "sqeuclidean")
+	nearest = distances.argmin(axis=1)
+	labels = model["labels"][nearest]
+	components = conditioned_components(model)
+	new = np.flatnonzero(distances[np.arange(len(nearest)), nearest] > 1e-12)
+	if len(new) and components[1:].any() and not int(model.get("n_neighbors", 0)):
+		labels[new] = cdist(embed_new(model, vector_array[new], components), model["centers"][:, components], "sqeuclidean").argmin(axis=1)
+	#return
+	return labels
+
+def assign(model, vector_array):
+	"""
+	Assign samples to the clusters of a saved model, return labels and the gmm probabilities of each cluster, probabilities of other methods are 1 for the assigned cluster
+	Columns of vector_array are the keys of the model
+	"""
+	vector_array = to_dense(vector_array)
+	method = str(model["method"])
+	if method == "kmeans": labels = cdist(vector_array, model["centers"], "sqeuclidean").argmin(axis=1)
+	elif method == "spectral": labels = spectral_assign(model, vector_array)
+	elif method == "gmm":
+		mixture = GaussianMixture(n_components=len(model["weights_"]), covariance_type=str(model["covariance_type"]))
+		for name in GMM_PARAMETERS: setattr(mixture, name, model[name])
+		probabilities = mixture.predict_proba(vector_array)
+		return probabilities.argmax(axis=1), probabilities
+	else: raise Exception("Unknown clustering method %s" % method)
+	probabilities = np.zeros((len(labels), len(model["centers"])))
+	probabilities[np.arange(len(labels)), labels] = 1
+	#return
+	return labels, probabilities
+
+def models_directory(metabolic_dir):
+	"""
+	Directory of the saved models of a clustering directory
+	"""
+	return os.path.join(metabolic_dir, "models")
+
+def reproduced_labels(model, vector_array):
+	"""
+	Fraction of the cohort that assign puts in the clusters it was fitted to
+	"""
+	return np.mean(assign(model, vector_array)[0] == model["labels"])
+
+def save_model(metabolic_dir, name, arrays, keys, patients):
+	"""
+	Save arrays of a model as models/<name>.npz with the pathway order of its columns, the patients and the number in Clusters.txt of each of its clusters
+	Models are written to a temporary file and renamed, so a saved model is complete
+	Only numeric models are saved, main does not cluster binary vectors
+	"""
+	directory = models_directory(metabolic_dir)
+	if not os.path.isdir(directory): os.makedirs(directory)
+	arrays = dict(arrays, name=np.array(name), keys=np.array([u"%s" % i for i in keys]), patients=np.array([u"%s" % i for i in patients]), cluster_numbers=cluster_numbers(arrays))
+	temporary_path = os.path.join(directory, "%s.npz.%s.tmp" % (name, os.getpid()))
+	with open(temporary_path, "wb") as outfl: np.savez(outfl, **arrays)
+	os.rename(temporary_path, os.path.join(directory, "%s.npz" % name))
+
+def load_model(model_file):
+	"""
+	Load dict of arrays of a saved model
+	"""
+	with np.load(model_file) as data: return dict((name, data[name]) for name in data.files)
+
+def saved_models(metabolic_dir):
+	"""
+	Names of the models saved in a clustering directory
+	"""
+	directory = models_directory(metabolic_dir)
+	if not os.path.isdir(directory): return []
+	#return
+	return sorted([i[:-len(".npz")] for i in os.listdir(directory) if i.endswith(".npz")])
+
+def to_model_matrix(patients_dict, keys):
+	"""
+	Dense patient x pathway matrix of patients_dict with the pathway columns of a model, return it with the patients of its rows and the number of affected pathways the model does not know
+	"""
+	patients = list(patients_dict)
+	key_index = dict((str(key), n) for n, key in enumerate(keys))
+	matrix = np.zeros((len(patients), len(keys)))
+	unknown = 0
+	for row, patient in enumerate(patients):
+		for pathway, value in patients_dict[patient].items():
+			if pathway in key_index: matrix[row, key_index[pathway]] = value
+			elif value != 0: unknown += 1
+	#return
+	return matrix, patients, unknown
 
 def external_to_labels(labels, patient_list):
 	"""
@@ -179,9 +651,10 @@ def external_to_labels(labels, patient_list):
 	return new_labels
 	
 
-def clustering(metabolic_dir, array, a_dict, keys, label, patient_list, clustering_method="kmeans", D=3):
+def clustering(metabolic_dir, array, a_dict, keys, label, patient_list, clustering_method="kmeans", D=3, plot=False, workers=1, silhouette_sample=0, spectral_k="silhouette", gmm_init="random", covariance_type="full", criterion="silhouette", model=None, spectral_neighbors=0):
 	"""
-	Cluster array kmeans and plot PCA and heatmaps
+	Cluster array kmeans and plot PCA and heatmaps if plot
+	model is filled with the arrays of the chosen model if it is a dict
 	"""
 	#initialize name for external labels
 	name = "%s_%s" % (clustering_method, label)
@@ -200,27 +673,28 @@ def clustering(metabolic_dir, array, a_dict, keys, label, patient_list, clusteri
 		#if no external labels provided, run clustering
 		if type(labels) != np.ndarray:
 			#cluster
-			labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method)
+			labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method, workers=workers, silhouette_sample=silhouette_sample, spectral_k=spectral_k, gmm_init=gmm_init, covariance_type=covariance_type, criterion=criterion, model=model, spectral_neighbors=spectral_neighbors)
 		#probabilities are not calculated by kmeans
 		probabilities = 0
 	elif clustering_method == "gmm":
 		clustering_label = "GaussianMixture"
 		#if no external labels provided, run clustering
-		if type(labels) != np.ndarray: labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method)
+		if type(labels) != np.ndarray: labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method, workers=workers, silhouette_sample=silhouette_sample, spectral_k=spectral_k, gmm_init=gmm_init, covariance_type=covariance_type, criterion=criterion, model=model, spectral_neighbors=spectral_neighbors)
 	elif clustering_method == "spectral":
 		clustering_label = "Spectral"
 		#if no external labels provided, run clustering
 		#if type(labels) != np.ndarray: labels = spectral_clustering.spectral_clustering(array, len(a_dict) - 1, 2, True, metric=metric)
-		if type(labels) != np.ndarray: labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method)
+		if type(labels) != np.ndarray: labels, probabilities = clustering_pathways_by_vectors(array, len(a_dict) - 1, clustering_method, workers=workers, silhouette_sample=silhouette_sample, spectral_k=spectral_k, gmm_init=gmm_init, covariance_type=covariance_type, criterion=criterion, model=model, spectral_neighbors=spectral_neighbors)
 		#probabilities are not calculated by spectral clustering
 		probabilities = 0
-	#pca
-	outfile = os.path.join(metabolic_dir,"%s_%s_PCA.pdf" % (clustering_label, label))
-	print("plotting")
-	#plot_pca(outfile, a_dict.keys(), array, labels, probabilities, D, mode)
-	#plot clusters
-	outfile_clustering = os.path.join(metabolic_dir,"%s_%s_clustering.pdf" % (clustering_label, label))
-	#plot_clusters(labels, array, keys, patient_list, outfile=outfile_clustering, method=mode, metric=metric)
+	if plot:
+		with instrumentation.stage("plot"):
+			#pca
+			outfile = os.path.join(metabolic_dir,"%s_%s_PCA.pdf" % (clustering_label, label))
+			plotting().plot_pca(outfile, list(a_dict), to_dense(array), labels, probabilities, D, mode)
+			#plot clusters
+			outfile_clustering = os.path.join(metabolic_dir,"%s_%s_clustering.pdf" % (clustering_label, label))
+			plotting().plot_clusters(labels, to_dense(array), keys, patient_list, outfile=outfile_clustering, method=mode, metric=metric)
 	#return
 	return labels
 
@@ -274,10 +748,8 @@ def get_cluster_pathways_stat(cluster, clustering_genes_dict):
             #not_cluster_not_pathway = len(clustering_genes_dict) - len(cluster) - noncluster_pathway_dict[pathway]
             #oddsratio, pvalue = stats.fisher_exact([[cluster_pathway, cluster_not_pathway], [not_cluster_pathway, not_cluster_not_pathway]], alternative='greater')
             #pdict[pathway] = pvalue
-            print(pathway, cluster_pathway_dict[pathway], noncluster_pathway_dict[pathway], len(set(cluster_pathway_dict[pathway])), cluster_pathway_dict[pathway][0])
             if len(set(cluster_pathway_dict[pathway])) == 1 and cluster_pathway_dict[pathway][0] == 0.0: continue
             pdict[pathway] = stats.mannwhitneyu(cluster_pathway_dict[pathway], noncluster_pathway_dict[pathway], alternative='greater')[1]
-        print(pdict)
         #correct
         pdict = correct_multiple_hypotheses(pdict)
         #final pathways
@@ -285,6 +757,22 @@ def get_cluster_pathways_stat(cluster, clustering_genes_dict):
         #return
         return pathways
 
+def cluster_order(labels):
+	"""
+	Labels in the order their clusters are written to Clusters.txt as Cluster_1, Cluster_2 and so on
+	"""
+	return list(set(labels))
+
+def cluster_numbers(model):
+	"""
+	Number in Clusters.txt of each cluster of a model, gmm components or centers that no patient of the cohort was assigned to are UNASSIGNED
+	"""
+	if str(model["method"]) == "gmm": numbers = np.zeros(len(model["weights_"]), dtype=np.int64) + UNASSIGNED
+	else: numbers = np.zeros(len(model["centers"]), dtype=np.int64) + UNASSIGNED
+	for n, label in enumerate(cluster_order(model["labels"].tolist())): numbers[label] = n + 1
+	#return
+	return numbers
+
 def write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_genes_dict, THRESHOLD=0.6):
 	"""
 	Write results to file
@@ -296,8 +784,7 @@ def write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_g
 			clusters = []
 			cluster_pathways = []
 			#which cluster are we looking at
-			for cluster_name in set(all_labels[method]):
-				print(cluster_name)
+			for cluster_name in cluster_order(all_labels[method]):
 				#initializepatients in cluster
 				cluster = []
 				#iterate through all patients
@@ -308,7 +795,9 @@ def write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_g
 				clusters.append(cluster)
 				#get cluster pathways
 				#pathways = get_cluster_pathways(cluster, clustering_genes_dict, maximum, THRESHOLD)
-				pathways = get_cluster_pathways_stat(cluster, clustering_genes_dict)
+				with instrumentation.stage("get_cluster_pathways_stat", method=method, cluster=cluster_name, patients=len(cluster)) as details:
+					pathways = get_cluster_pathways_stat(cluster, clustering_genes_dict)
+					details["pathways"] = len(pathways)
 				cluster_pathways.append(pathways)
 			#now we have the clusters for the label and we can write them to the file
 			#write clustering method
@@ -333,7 +822,35 @@ def write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_g
 				#write line
 				outfl.write(pathway_line)
 
-def main(clustering_patients_dict, clustering_genes_dict, metabolic_dir, D=2, clustering_methods=['kmeans']):
+def append_to_clusters(clusters_file, name, assignments):
+	"""
+	Add patients to clusters of the last results of method name in Clusters.txt, assignments are (patient, cluster number) pairs
+	Patients already in a cluster of the method are not added again, return the patients that were added
+	"""
+	with open(clusters_file) as fl: lines = fl.read().splitlines()
+	starts = [n for n, line in enumerate(lines) if line == name]
+	if not starts: raise Exception("No %s clusters in %s" % (name, clusters_file))
+	#clusters of the method are the lines after its name
+	cluster_lines = {}
+	n = starts[-1] + 1
+	while n < len(lines) and (lines[n].startswith("Cluster_") or lines[n].startswith("Pathways_")):
+		if lines[n].startswith("Cluster_"): cluster_lines[int(lines[n].split("\t")[0][len("Cluster_"):])] = n
+		n += 1
+	present = set([patient for n in cluster_lines.values() for patient in lines[n].split("\t")[1:]])
+	added = []
+	for patient, cluster_number in assignments:
+		if patient in present: continue
+		lines[cluster_lines[cluster_number]] += "\t%s" % patient
+		present.add(patient)
+		added.append(patient)
+	#replace file at once
+	temporary_path = "%s.%s.tmp" % (clusters_file, os.getpid())
+	with open(temporary_path, "w") as outfl: outfl.write("".join([line + "\n" for line in lines]))
+	os.rename(temporary_path, clusters_file)
+	#return
+	return added
+
+def main(clustering_patients_dict, clustering_genes_dict, metabolic_dir, D=2, clustering_methods=['kmeans'], plot=False, workers=1, silhouette_sample=0, spectral_k="silhouette", gmm_init="random", covariance_type="full", criterion="silhouette", spectral_neighbors=0):
 	#remove excluded
 	excluded = []
 	for i in excluded:
@@ -342,62 +859,40 @@ def main(clustering_patients_dict, clustering_genes_dict, metabolic_dir, D=2, cl
 	#run clsutering in different methods
 	clustering_methods = [i.lower() for i in clustering_methods]
 	#prepare data
-	#binary 0,1 vector for pathways
-	binary_dict, binary_keys = convert_to_binary_vectors(clustering_patients_dict)
-	#numeric vector of floats for pathways
-	vector_dict, vector_keys = convert_to_vectors(clustering_genes_dict)
-	#define arrays
-	vector_array = to_array(vector_dict)
-	binary_array = to_array(binary_dict)
-	patient_list = vector_dict.keys()
+	with instrumentation.stage("prepare_vectors"):
+		#binary 0,1 sparse matrix of pathways
+		binary_array, binary_patients, binary_keys = convert_to_matrix(clustering_patients_dict, binary=True)
+		#numeric sparse matrix of floats for pathways
+		vector_array, vector_patients, vector_keys = convert_to_matrix(clustering_genes_dict)
+	patient_list = vector_patients
 	#initialize labels
 	all_labels = {}
 	#cluster by jaccard index in hierarchical clustering
 	if "hierarchical" in clustering_methods:
 		outfile_jaccard = os.path.join(metabolic_dir,"Heirarchical_Jaccard.pdf")
 		jaccard_dict = convert_to_lists(clustering_patients_dict)
-		#clustering_pathways_by_jaccard(jaccard_dict, outfile_jaccard)
+		if plot: plotting().clustering_pathways_by_jaccard(jaccard_dict, outfile_jaccard)
 	#cluster all others
-	for array, a_dict, keys, label in zip([vector_array, binary_array], [vector_dict, binary_dict], [vector_keys, binary_keys], ["numeric", "binary"]):
+	for array, a_dict, keys, label in zip([vector_array, binary_array], [vector_patients, binary_patients], [vector_keys, binary_keys], ["numeric", "binary"]):
 		#iterate through methods
 		for clustering_method in [i for i in clustering_methods if i != "hierarchical"]:
 			if label == "binary": continue
 			#run
-			all_labels["%s_%s" % (clustering_method, label)] = clustering(metabolic_dir, array, a_dict, keys, label, patient_list, clustering_method, D)
+			name = "%s_%s" % (clustering_method, label)
+			with instrumentation.stage(name, patients=len(a_dict)) as details:
+				model = {}
+				all_labels[name] = clustering(metabolic_dir, array, a_dict, keys, label, patient_list, clustering_method, D, plot, workers, silhouette_sample, spectral_k, gmm_init, covariance_type, criterion, model, spectral_neighbors)
+				#keep model so new patients are assigned without refitting, assigning the cohort must give its clusters
+				if model:
+					details["reproduced_labels"] = reproduced_labels(model, array)
+					if details["reproduced_labels"] < 1: sys.stderr.write("%s: saved model assigns %.3f of the cohort to its clusters\n" % (name, details["reproduced_labels"]))
+					save_model(metabolic_dir, name, model, keys, a_dict)
 	#get maximum
-	maximum = max(list(itertools.chain.from_iterable(vector_array.tolist())))
+	maximum = vector_array.max()
 	#output results to file
-	write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_genes_dict)
+	with instrumentation.stage("write_results"):
+		write_results(metabolic_dir, all_labels, patient_list, maximum, clustering_genes_dict)
 	exit()
-	with open(os.path.join(metabolic_dir,"Numeric_array.csv"),"w") as outfl:
-		#add header
-		line = ""
-		for i in vector_keys:
-			line += "\t%s" % i
-		line += "\n"
-		outfl.write(line)
-		#add patients
-		for patient in vector_dict:
-			line = patient
-			for i in vector_dict[patient]:
-				line += "\t%s" % i
-			line += "\n"
-			outfl.write(line)
-	
-	with open(os.path.join(metabolic_dir,"Binary_array.csv"),"w") as outfl:
-		#add header
-		line = ""
-		for i in binary_keys:
-			line += "\t%s" % i
-		line += "\n"
-		outfl.write(line)
-		#add patients
-		for patient in binary_dict:
-			line = patient
-			for i in binary_dict[patient]:
-				line += "\t%s" % i
-			line += "\n"
-			outfl.write(line)		
 
 if __name__ == "__main__":
 		exit(main())
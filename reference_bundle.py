@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Reference bundle: everything the scripts need from a reference directory and a KEGG pathways file, parsed once and saved next to the reference.
+The bundle holds the locus_tag to protein map, the protein list, the pathway to gene incidence in CSR format and the pathway descriptions.
+It is loaded with memory mapping and rebuilt when any of its source files changes.
+"""
+
+import os,sys
+import json
+import hashlib
+import numpy as np
+from scipy import sparse
+import create_pathways
+import pathway_dict
+import instrumentation
+from kegg_to_NCBI import parse_cds, proteins_list
+
+#change when the saved arrays change
+BUNDLE_VERSION = 1
+#bundles loaded in this process
+loaded_bundles = {}
+
+class ReferenceBundle(object):
+    """
+    Parsed reference of an organism, arrays may be memory mapped
+    """
+    def __init__(self, arrays):
+        """
+        Initialize object from dict of arrays
+        """
+        self.locus_tags = arrays["locus_tags"]
+        self.locus_proteins = arrays["locus_proteins"]
+        self.proteins = arrays["proteins"]
+        self.pathway_ids = arrays["pathway_ids"]
+        self.pathway_genes = arrays["pathway_genes"]
+        self.indptr = arrays["indptr"]
+        self.indices = arrays["indices"]
+        self.description_ids = arrays["description_ids"]
+        self.description_names = arrays["description_names"]
+        #python objects are created on first use
+        self._pathways = None
+        self._cds_dict = None
+        self._descriptions = None
+
+    def protein_list(self):
+        """
+        Get list of protein names in protein file order
+        """
+        return [str(i) for i in self.proteins]
+
+    def metabolic_proteins(self):
+        """
+        Get list of genes in any pathway, in order of first appearance
+        """
+        return [str(i) for i in self.pathway_genes]
+
+    def pathways(self):
+        """
+        Get dict of pathway:list of genes, same as create_pathways.main
+        """
+        if self._pathways is None:
+            genes = self.metabolic_proteins()
+            indices = self.indices.tolist()
+            indptr = self.indptr.tolist()
+            self._pathways = {}
+            for n, pathway in enumerate(self.pathway_ids):
+                self._pathways[str(pathway)] = [genes[i] for i in indices[indptr[n]:indptr[n + 1]]]
+        return self._pathways
+
+    def cds_dict(self):
+        """
+        Get dict of locus_tag:protein name, same as kegg_to_NCBI.parse_cds
+        """
+        if self._cds_dict is None: self._cds_dict = dict(zip([str(i) for i in self.locus_tags], [str(i) for i in self.locus_proteins]))
+        return self._cds_dict
+
+    def descriptions(self):
+        """
+        Get dict of pathway:description, same as pathway_dict.parse_descriptions
+        """
+        if self._descriptions is None: self._descriptions = dict(zip([str(i) for i in self.description_ids], [str(i) for i in self.description_names]))
+        return self._descriptions
+
+    def incidence(self):
+        """
+        Get sparse pathway x gene matrix counting how many times each gene of pathway_genes is listed in each pathway
+        """
+        matrix = sparse.csr_matrix((np.ones(len(self.indices)), np.asarray(self.indices), np.asarray(self.indptr)), shape=(len(self.pathway_ids), len(self.pathway_genes)))
+        matrix.sum_duplicates()
+        return matrix
+
+def reference_files(reference_directory):
+    """
+    Get cds, rna and protein NCBI files from reference directory
+    """
+    #list file in reference directory
+    onlyfiles = [os.path.join(reference_directory, f) for f in os.listdir(reference_directory) if os.path.isfile(os.path.join(reference_directory, f))]
+    #get ncbi files
+    cds_file = [i for i in onlyfiles if i.endswith("_cds_from_genomic.fna.gz")][0]
+    rna_file = [i for i in onlyfiles if i.endswith("_rna_from_genomic.fna.gz")][0]
+    protein_file = [i for i in onlyfiles if i.endswith("_protein.faa.gz")][0]
+    #return
+    return cds_file, rna_file, protein_file
+
+def source_stamps(sources):
+    """
+    Get path, size and modification time of source files, missing files are stamped as None
+    """
+    stamps = []
+    for source in sources:
+        if source and os.path.isfile(source):
+            stat = os.stat(source)
+            stamps.append([os.path.abspath(source), stat.st_size, stat.st_mtime])
+        else: stamps.append([source, None, None])
+    return stamps
+
+def string_array(strings):
+    """
+    Fixed width unicode array that can be memory mapped
+    """
+    if not strings: return np.zeros(0, dtype="U1")
+    return np.array([u"%s" % i for i in strings])
+
+def build_arrays(reference_directory, kegg_file, descriptions_file=None):
+    """
+    Parse reference files into bundle arrays
+    """
+    cds_file, rna_file, protein_file = reference_files(reference_directory)
+    #parse
+    pathways, cds_dict = create_pathways.main([kegg_file, cds_file, rna_file])
+    proteins = proteins_list(protein_file)
+    if descriptions_file and os.path.isfile(descriptions_file): descriptions = pathway_dict.parse_descriptions(descriptions_file)
+    else: descriptions = {}
+    #pathway incidence in CSR format, genes indexed in order of first appearance
+    gene_index = {}
+    indptr = [0]
+    indices = []
+    for pathway in pathways:
+        for gene in pathways[pathway]:
+            if gene not in gene_index: gene_index[gene] = len(gene_index)
+            indices.append(gene_index[gene])
+        indptr.append(len(indices))
+    pathway_genes = sorted(gene_index, key=gene_index.get)
+    locus_tags = list(cds_dict)
+    description_ids = list(descriptions)
+    #return
+    return {"locus_tags": string_array(locus_tags), "locus_proteins": string_array([cds_dict[i] for i in locus_tags]), "proteins": string_array(proteins),
+            "pathway_ids": string_array(list(pathways)), "pathway_genes": string_array(pathway_genes),
+            "indptr": np.array(indptr, dtype=np.int64), "indices": np.array(indices, dtype=np.int64),
+            "description_ids": string_array(description_ids), "description_names": string_array([descriptions[i] for i in description_ids])}
+
+def bundle_directory(reference_directory, kegg_file, descriptions_file=None):
+    """
+    Directory of the bundle of a reference directory, KEGG file and descriptions file
+    """
+    key = hashlib.sha1(("%s\n%s" % (os.path.abspath(kegg_file), os.path.abspath(descriptions_file) if descriptions_file else "")).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(reference_directory, "reference_bundle", key)
+
+def save_bundle(directory, arrays, stamps):
+    """
+    Write arrays as .npy files and the manifest last, so a bundle with a manifest is complete
+    """
+    if not os.path.isdir(directory): os.makedirs(directory)
+    for name in arrays:
+        np.save(os.path.join(directory, "%s.npy" % name), arrays[name])
+    temporary_path = os.path.join(directory, "manifest.json.%s.tmp" % os.getpid())
+    with open(temporary_path, "w") as outfl:
+        json.dump({"version": BUNDLE_VERSION, "sources": stamps, "arrays": sorted(arrays)}, outfl)
+    os.rename(temporary_path, os.path.join(directory, "manifest.json"))
+
+def read_bundle(directory, stamps):
+    """
+    Memory map bundle arrays if the bundle exists and its sources did not change, otherwise return None
+    """
+    manifest_file = os.path.join(directory, "manifest.json")
+    if not os.path.isfile(manifest_file): return None
+    with open(manifest_file) as fl: manifest = json.load(fl)
+    if manifest["version"] != BUNDLE_VERSION or manifest["sources"] != json.loads(json.dumps(stamps)): return None
+    #return
+    return dict((name, np.load(os.path.join(directory, "%s.npy" % name), mmap_mode="r")) for name in manifest["arrays"])
+
+def load_bundle(reference_directory, kegg_file, descriptions_file=None):
+    """
+    Get ReferenceBundle of a reference directory and KEGG file, building it if it does not exist or is outdated
+    """
+    #sources the bundle depends on
+    stamps = source_stamps(list(reference_files(reference_directory)) + [kegg_file, descriptions_file])
+    key = json.dumps(stamps)
+    if key in loaded_bundles: return loaded_bundles[key]
+    #load or build
+    with instrumentation.stage("reference", reference_directory=reference_directory) as details:
+        directory = bundle_directory(reference_directory, kegg_file, descriptions_file)
+        arrays = read_bundle(directory, stamps)
+        details["built"] = arrays is None
+        if arrays is None:
+            arrays = build_arrays(reference_directory, kegg_file, descriptions_file)
+            #reference directory may be read only, the bundle is then only kept in memory
+            try: save_bundle(directory, arrays, stamps)
+            except (OSError, IOError): pass
+    bundle = ReferenceBundle(arrays)
+    loaded_bundles[key] = bundle
+    #return
+    return bundle
+
+def main(args):
+    #build bundle from the command line: reference directory, kegg file and optionally descriptions file
+    reference_directory = args[0]
+    kegg_file = args[1]
+    if len(args) > 2: descriptions_file = args[2]
+    else: descriptions_file = None
+    load_bundle(reference_directory, kegg_file, descriptions_file)
+    #return
+    return bundle_directory(reference_directory, kegg_file, descriptions_file)
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
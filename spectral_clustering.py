@@ -1,16 +1,16 @@
 import numpy as np
 
-import itertools
 from scipy.spatial.distance import squareform, pdist
 from scipy.linalg import eigh
 from scipy.optimize import linear_sum_assignment
+from scipy import sparse
+from scipy.sparse.linalg import eigsh, lobpcg, ArpackNoConvergence
 
 from sklearn.cluster import KMeans
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_array
 from sklearn.metrics import silhouette_samples, silhouette_score
 
-from matplotlib import pyplot as plt
-from matplotlib import cm
-
 def fit_labels(Y, Y_predicted):
 		labels = list(set(Y) | set(Y_predicted))
 		label_count = len(labels)
@@ -37,28 +37,83 @@ def fit_labels(Y, Y_predicted):
 		return Y_fit
 
 
-def spectral_clustering(X, max_num, k=0, verbose=False, metric='eucledian'):
-
-	# Dist matrix
-	S = squareform(pdist(X,metric=metric))
-	sigma = np.percentile(S, 5)
-	if sigma == 0: sigma = min([i for i in list(itertools.chain.from_iterable(S)) if i != 0])
-	# Affinity matrix
-	A = np.exp(- (S ** 2) / (2 * sigma ** 2))
-	
-	np.fill_diagonal(A, 0)
-
-	m, n = A.shape
-	
-	# Compute laplacian
-	I = np.identity(m)
-	
-	D = I / (A.sum(axis=1) ** 0.5)
-	#print A.sum(axis=1) ** 0.5
-	L = I - D.dot(A).dot(D)
-	
-	# Solve spectral decompositon
-	eigen_val, eigen_vec = eigh(L)
+def knn_affinity(X, n_neighbors, metric='euclidean', scale_neighbor=7):
+	# Sparse symmetric affinity of the n_neighbors nearest neighbours of each sample, with local scaling:
+	# sigma of a sample is the distance to its scale_neighbor-th neighbour and A_ij = exp(-d_ij^2 / (sigma_i * sigma_j))
+	# sparse matrices are searched as they are with euclidean distances
+	X = check_array(X, accept_sparse="csr")
+	# jaccard is defined on dense boolean vectors
+	if metric == 'jaccard':
+		if sparse.issparse(X): X = X.toarray()
+		X = X.astype(bool)
+	m = X.shape[0]
+	n_neighbors = min(n_neighbors, m - 1)
+	# the first neighbour is the sample itself
+	distances, indices = NearestNeighbors(n_neighbors=n_neighbors + 1, metric=metric).fit(X).kneighbors(X)
+	distances = distances[:, 1:]
+	indices = indices[:, 1:]
+	# local scale, duplicate samples have scale 0 and use the smallest distance that is not 0
+	sigma = distances[:, min(scale_neighbor, n_neighbors) - 1].copy()
+	if (sigma == 0).any():
+		positive = distances[distances != 0]
+		sigma[sigma == 0] = positive.min() if len(positive) else 1.0
+	rows = np.repeat(np.arange(m), n_neighbors)
+	columns = indices.ravel()
+	values = np.exp(- (distances.ravel() ** 2) / (sigma[rows] * sigma[columns]))
+	A = sparse.csr_matrix((values, (rows, columns)), shape=(m, m))
+	# symmetric, a pair is connected if either sample is a neighbour of the other
+	A = A.maximum(A.T)
+	A.setdiag(0)
+	A.eliminate_zeros()
+	return A
+
+def sparse_spectral_embedding(A, n_components, random_state=None):
+	# Eigenvectors of the n_components smallest eigenvalues of the normalized laplacian I - D^-1/2 A D^-1/2,
+	# they are the largest eigenvalues of D^-1/2 A D^-1/2 which are found iteratively
+	m = A.shape[0]
+	degrees = np.asarray(A.sum(axis=1)).ravel()
+	degrees[degrees == 0] = 1
+	D = sparse.diags(1 / np.sqrt(degrees))
+	M = (D.dot(A).dot(D)).tocsr()
+	n_components = min(n_components, m - 1)
+	v0 = np.random.RandomState(random_state).uniform(-1, 1, m)
+	try:
+		eigen_val, eigen_vec = eigsh(M, k=n_components, which='LA', v0=v0)
+	except ArpackNoConvergence:
+		# LOBPCG from a random block
+		eigen_val, eigen_vec = lobpcg(M, np.random.RandomState(random_state).normal(size=(m, n_components)), largest=True, maxiter=2000)
+	# ascending eigenvalues of the laplacian
+	order = np.argsort(-eigen_val)
+	return 1 - eigen_val[order], eigen_vec[:, order]
+
+def spectral_clustering(X, max_num, k=0, verbose=False, metric='euclidean', n_neighbors=0, random_state=None):
+	# n_neighbors > 0 uses a sparse k-nearest-neighbour affinity and only the leading eigenvectors,
+	# memory grows with n_neighbors per sample instead of the square of the number of samples
+
+	if n_neighbors:
+		A = knn_affinity(X, n_neighbors, metric=metric)
+		eigen_val, eigen_vec = sparse_spectral_embedding(A, max(k, max_num), random_state)
+	else:
+		# Dist matrix
+		S = squareform(pdist(X,metric=metric))
+		sigma = np.percentile(S, 5)
+		if sigma == 0: sigma = S[S != 0].min()
+		# Affinity matrix
+		A = np.exp(- (S ** 2) / (2 * sigma ** 2))
+		
+		np.fill_diagonal(A, 0)
+
+		m, n = A.shape
+		
+		# Compute laplacian
+		I = np.identity(m)
+		
+		D = I / (A.sum(axis=1) ** 0.5)
+		#print A.sum(axis=1) ** 0.5
+		L = I - D.dot(A).dot(D)
+		
+		# Solve spectral decompositon
+		eigen_val, eigen_vec = eigh(L)
 	best = None
 	if verbose:
 		#plt.figure()
@@ -76,6 +131,9 @@ def spectral_clustering(X, max_num, k=0, verbose=False, metric='eucledian'):
 
 
 def sillhouette(X, max_num):
+	#matplotlib is only loaded for the silhouette plots
+	from matplotlib import pyplot as plt
+	from matplotlib import cm
 
 	range_n_clusters = list(range(2, max_num + 1))
 	silhouette_avgs = []
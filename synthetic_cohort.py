@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+Write a synthetic cohort in the format of the Within Host Adaptation pipeline results, for benchmarks and for reproducing problems without patient data
+The cohort has an NCBI style reference, a KEGG .list file, map_title.tab, lost genes files of each patient and a Table S1 with patient properties.
+Patients belong to hidden groups that lose genes of their own pathways more often, so clustering has something to find.
+"""
+
+import sys, os
+import argparse
+import gzip
+import json
+import numpy as np
+
+#written last, a cohort with a manifest is complete
+MANIFEST = "cohort.json"
+#vocabularies of Table S1
+TISSUES = ["Blood", "Sputum", "Nasal", "Skin", "Bone", "Urine", "Wound"]
+TREATMENTS = ["Vancomycin", "Daptomycin", "Rifampicin", "Oxacillin", "Linezolid", "Gentamicin"]
+CONDITIONS = ["Cystic fibrosis", "Adult ICU", "Endocarditis", "Osteomyelitis", "Carriage", "Bacteremia"]
+REFERENCES = ["Synthetic et al. 2020", "Synthetic et al. 2021", "Synthetic and Example 2019"]
+#fractions of a gene that were lost
+FRACTIONS = [1.0, 1.0, 1.0, 0.75, 0.5, 0.5, 0.25, 0.1]
+
+def process_command_line(argv):
+	"""
+	Return an args list
+	`argv` is a list of arguments, or `None` for ``sys.argv[1:]``.
+	"""
+	if argv is None:
+		argv = sys.argv[1:]
+
+	# initialize the parser object:
+	parser = argparse.ArgumentParser(description='Process input.', add_help=False)
+
+	#define options here
+	parser.add_argument(
+		'-o', '--outdir', default="./synthetic/",
+		help='Directory where the cohort will be written.')
+
+	parser.add_argument(
+		'-n', '--patients', type=int, default=100,
+		help='Number of patients.')
+
+	parser.add_argument(
+		'-g', '--genes', type=int, default=3000,
+		help='Number of protein coding genes in the reference.')
+
+	parser.add_argument(
+		'-P', '--pathways', type=int, default=120,
+		help='Number of KEGG pathways.')
+
+	parser.add_argument(
+		'--patients_per_trial', type=int, default=5,
+		help='Number of patients in each trial.')
+
+	parser.add_argument(
+		'--lost_genes', type=float, default=12,
+		help='Average number of high impact lost genes of a patient.')
+
+	parser.add_argument(
+		'--groups', type=int, default=5,
+		help='Number of hidden patient groups.')
+
+	parser.add_argument(
+		'--organism', default="Synthetic_organism",
+		help='Name of the organism directory.')
+
+	parser.add_argument(
+		'--seed', type=int, default=0,
+		help='Seed of the random generator, the same seed writes the same cohort.')
+
+	parser.add_argument(# customized description; put --help last
+		'-h', '--help', action='help',
+		help='Show this help message and exit.')
+
+	settings = parser.parse_args(argv)
+
+	return settings
+
+def mkdir(path):
+	#create directory with parents and don't crash if it already exists
+	if not os.path.isdir(path): os.makedirs(path)
+
+def random_sequence(random_state, alphabet, length):
+	"""
+	Random sequence of length letters of alphabet
+	"""
+	return "".join(np.array(list(alphabet))[random_state.randint(0, len(alphabet), length)])
+
+def write_fasta(outfile, records, line_length=80):
+	"""
+	Write gzipped fasta from list of (header, sequence)
+	"""
+	with gzip.open(outfile, "wb") as outfl:
+		for header, sequence in records:
+			lines = [">%s" % header] + [sequence[i:i + line_length] for i in range(0, len(sequence), line_length)]
+			outfl.write(("\n".join(lines) + "\n").encode("ascii"))
+
+def write_reference(reference_directory, organism_code, number_of_genes, random_state, rna_genes=30):
+	"""
+	Write cds, rna and protein files in NCBI format, return locus tags and protein names of the genes
+	"""
+	mkdir(reference_directory)
+	prefix = os.path.join(reference_directory, "GCF_000000000.1_Synthetic")
+	locus_tags = ["%s_%05d" % (organism_code.upper(), n + 1) for n in range(number_of_genes)]
+	proteins = ["WP_%09d.1" % (n + 1) for n in range(number_of_genes)]
+	#gene lengths like bacterial genes, around 300 amino acids
+	lengths = np.clip(random_state.gamma(2.5, 120, number_of_genes).astype(int), 40, 1500)
+	cds_records = []
+	protein_records = []
+	position = 1
+	for n in range(number_of_genes):
+		end = position + 3 * lengths[n] + 2
+		header = "lcl|NC_000001.1_cds_%s_%d [locus_tag=%s] [protein=hypothetical protein] [protein_id=%s] [location=%d..%d] [gbkey=CDS]" % (proteins[n], n + 1, locus_tags[n], proteins[n], position, end)
+		cds_records.append((header, "ATG" + random_sequence(random_state, "ACGT", 3 * lengths[n] - 3) + "TAA"))
+		protein_records.append(("%s hypothetical protein [%s]" % (proteins[n], organism_code), "M" + random_sequence(random_state, "ACDEFGHIKLMNPQRSTVWY", lengths[n] - 1)))
+		position = end + 1 + random_state.randint(0, 200)
+	rna_records = []
+	for n in range(rna_genes):
+		header = "lcl|NC_000001.1_rna_NR_%06d.1_%d [locus_tag=%s_R%03d] [product=tRNA] [gbkey=tRNA]" % (n + 1, number_of_genes + n + 1, organism_code.upper(), n + 1)
+		rna_records.append((header, random_sequence(random_state, "ACGT", 76)))
+	write_fasta(prefix + "_cds_from_genomic.fna.gz", cds_records)
+	write_fasta(prefix + "_rna_from_genomic.fna.gz", rna_records)
+	write_fasta(prefix + "_protein.faa.gz", protein_records)
+	#return
+	return locus_tags, proteins
+
+def make_pathways(number_of_pathways, number_of_genes, random_state):
+	"""
+	Draw pathways as lists of gene indices, metabolic genes are the first part of the genome and genes may be in many pathways
+	"""
+	metabolic_genes = max(1, int(number_of_genes * 0.4))
+	pathway_ids = sorted(random_state.choice(np.arange(10, 99999), number_of_pathways, replace=False))
+	pathways = {}
+	for pathway_id in pathway_ids:
+		size = int(min(metabolic_genes, max(3, random_state.lognormal(3, 0.8))))
+		pathways["%05d" % pathway_id] = sorted(random_state.choice(metabolic_genes, size, replace=False).tolist())
+	#return
+	return pathways
+
+def write_kegg(kegg_file, organism_code, pathways, locus_tags):
+	"""
+	Write KEGG .list file of pathway and locus tag pairs
+	"""
+	with open(kegg_file, "w") as outfl:
+		for pathway in sorted(pathways):
+			for gene in pathways[pathway]:
+				outfl.write("path:%s%s\t%s:%s\n" % (organism_code, pathway, organism_code, locus_tags[gene]))
+
+def write_descriptions(descriptions_file, pathways):
+	"""
+	Write map_title.tab with a description of each pathway
+	"""
+	with open(descriptions_file, "w") as outfl:
+		for n, pathway in enumerate(sorted(pathways)):
+			outfl.write("%s\tSynthetic pathway %d\n" % (pathway, n + 1))
+
+def write_patients(organism_dir, number_of_patients, patients_per_trial, proteins, pathways, lost_genes, groups, random_state):
+	"""
+	Write high_lost_genes_no_repeats.txt and changed_genes_no_repeats.txt of each patient, return list of (trial, patient number) of patients
+	Half of the lost genes of a patient are drawn from the pathways of its group, changed genes are the lost genes and more
+	"""
+	pathway_list = sorted(pathways)
+	group_genes = []
+	for group in range(groups):
+		chosen = random_state.choice(len(pathway_list), min(len(pathway_list), random_state.randint(3, 9)), replace=False)
+		group_genes.append(np.unique(np.concatenate([pathways[pathway_list[n]] for n in chosen])))
+	patients = []
+	for n in range(number_of_patients):
+		trial = n // patients_per_trial + 1
+		patient = n % patients_per_trial + 1
+		patients.append((trial, patient))
+		patient_dir = os.path.join(organism_dir, "trial_%d_patient_%d" % (trial, patient))
+		mkdir(patient_dir)
+		#lost genes, half from the group pathways and half from the whole genome
+		group = random_state.randint(0, groups)
+		number_of_lost = random_state.poisson(lost_genes)
+		from_group = random_state.binomial(number_of_lost, 0.5)
+		lost = set(random_state.choice(group_genes[group], from_group).tolist()) | set(random_state.randint(0, len(proteins), number_of_lost - from_group).tolist())
+		lost = sorted(lost)
+		#changed genes also have low impact changes
+		changed = sorted(set(lost) | set(random_state.randint(0, len(proteins), random_state.poisson(lost_genes)).tolist()))
+		#a gene has the same fraction in both files
+		fractions = dict(zip(changed, [FRACTIONS[i] for i in random_state.randint(0, len(FRACTIONS), len(changed))]))
+		for filename, genes in [("high_lost_genes_no_repeats.txt", lost), ("changed_genes_no_repeats.txt", changed)]:
+			with open(os.path.join(patient_dir, filename), "w") as outfl:
+				for gene in genes:
+					outfl.write("%s\t%s\t%s\n" % (proteins[gene], "lost", fractions[gene]))
+	#return
+	return patients
+
+def write_table(table_file, patients, random_state):
+	"""
+	Write Table S1 with tissue, treatment, additional condition and reference of each patient, rows are in trial and patient order
+	"""
+	def pick(vocabulary, maximum):
+		chosen = random_state.choice(len(vocabulary), random_state.randint(1, maximum + 1), replace=False)
+		return "+".join([vocabulary[i] for i in sorted(chosen)])
+	with open(table_file, "w") as outfl:
+		outfl.write("Experiment\tTissue\tTreatment\tAdditional_Condition\tReference\n")
+		for trial, patient in patients:
+			outfl.write("%d\t%s\t%s\t%s\t%s\n" % (trial, pick(TISSUES, 1), pick(TREATMENTS, 2), pick(CONDITIONS, 2), REFERENCES[trial % len(REFERENCES)]))
+
+def cohort_files(outdir, organism="Synthetic_organism", organism_code="syn"):
+	"""
+	Paths of the parts of a cohort in outdir
+	"""
+	return {"reference_directory": os.path.join(outdir, "reference"), "kegg_file": os.path.join(outdir, "%s.list" % organism_code),
+		"pathway_descriptions": os.path.join(outdir, "map_title.tab"), "organism": os.path.join(outdir, organism), "table": os.path.join(outdir, "Table_S1.txt")}
+
+def read_cohort(outdir):
+	"""
+	Read manifest of a complete cohort, None if the cohort was not written
+	"""
+	manifest_file = os.path.join(outdir, MANIFEST)
+	if not os.path.isfile(manifest_file): return None
+	with open(manifest_file) as fl: return json.load(fl)
+
+def generate(outdir, patients=100, genes=3000, pathways=120, patients_per_trial=5, lost_genes=12, groups=5, organism="Synthetic_organism", seed=0):
+	"""
+	Write cohort to outdir and return its manifest: parameters and paths of its parts
+	"""
+	random_state = np.random.RandomState(seed)
+	organism_code = "syn"
+	files = cohort_files(outdir, organism, organism_code)
+	mkdir(outdir)
+	locus_tags, proteins = write_reference(files["reference_directory"], organism_code, genes, random_state)
+	pathway_genes = make_pathways(pathways, genes, random_state)
+	write_kegg(files["kegg_file"], organism_code, pathway_genes, locus_tags)
+	write_descriptions(files["pathway_descriptions"], pathway_genes)
+	patient_list = write_patients(files["organism"], patients, patients_per_trial, proteins, pathway_genes, lost_genes, groups, random_state)
+	write_table(files["table"], patient_list, random_state)
+	#manifest is written last
+	manifest = {"patients": patients, "genes": genes, "pathways": pathways, "patients_per_trial": patients_per_trial, "lost_genes": lost_genes, "groups": groups, "seed": seed, "files": files}
+	with open(os.path.join(outdir, MANIFEST), "w") as outfl: json.dump(manifest, outfl, indent=1)
+	#return
+	return manifest
+
+def main(argv=None):
+	#process command line
+	settings = process_command_line(argv)
+	generate(settings.outdir, settings.patients, settings.genes, settings.pathways, settings.patients_per_trial, settings.lost_genes, settings.groups, settings.organism, settings.seed)
+
+if __name__ == "__main__":
+		exit(main())
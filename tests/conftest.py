@@ -0,0 +1,14 @@
+import sys, os
+import pytest
+
+#scripts of the repository are imported as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic_cohort
+
+@pytest.fixture(scope="session")
+def cohort(tmp_path_factory):
+	"""
+	Small synthetic cohort shared by the tests, return its manifest
+	"""
+	return synthetic_cohort.generate(str(tmp_path_factory.mktemp("cohort")), patients=30, genes=400, pathways=20, seed=1)
@@ -0,0 +1,26 @@
+import os
+import numpy as np
+from sklearn.mixture import GaussianMixture
+import metabolic_clustering
+import assign_patients
+
+def test_gmm_component_without_cohort_patients(tmp_path):
+	random_state = np.random.RandomState(0)
+	groups = [random_state.normal(center, 0.3, (20, 2)) for center in [0, 5, 10]]
+	mixture = GaussianMixture(n_components=3, random_state=0).fit(np.vstack(groups))
+	#the cohort has no patients of the third component
+	cohort = np.vstack(groups[:2])
+	labels = mixture.predict(cohort)
+	patients = ["patient_%d" % n for n in range(len(cohort))]
+	metabolic_dir = str(tmp_path)
+	metabolic_clustering.save_model(metabolic_dir, "gmm_numeric", metabolic_clustering.model_arrays("gmm", mixture, labels, cohort), ["pathway_a", "pathway_b"], patients)
+	with open(os.path.join(metabolic_dir, "Clusters.txt"), "w") as outfl:
+		outfl.write("gmm_numeric\n")
+		for n, label in enumerate(metabolic_clustering.cluster_order(labels)):
+			outfl.write("Cluster_%d\t%s\nPathways_%d\n" % (n + 1, "\t".join([patient for patient, patient_label in zip(patients, labels) if patient_label == label]), n + 1))
+	patients_dict = {"new_first": {"pathway_a": 0.1, "pathway_b": -0.1}, "new_third": {"pathway_a": 10.1, "pathway_b": 9.9}}
+	results = dict((patient, cluster_number) for patient, cluster_number, probability in assign_patients.assign_patients(metabolic_dir, patients_dict, ["gmm_numeric"])["gmm_numeric"])
+	assert results["new_third"] == metabolic_clustering.UNASSIGNED
+	assert results["new_first"] == metabolic_clustering.cluster_order(labels).index(labels[0]) + 1
+	with open(os.path.join(metabolic_dir, "Clusters.txt")) as fl: content = fl.read()
+	assert "new_first" in content and "new_third" not in content
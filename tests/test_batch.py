@@ -0,0 +1,23 @@
+import os
+import json
+import batch
+import metabolic_clustering
+
+def test_batch_runs_all_stages(cohort, tmp_path):
+	files = cohort["files"]
+	workdir = str(tmp_path / "work") + "/"
+	argv = ["-w", workdir, "-o", files["organism"], files["reference_directory"], files["kegg_file"], "-p", files["pathway_descriptions"],
+		"-t", files["table"], "-c", "kmeans", "spectral", "--exact", "-n", "2"]
+	assert batch.main(argv) == 0
+	for loss_type, lost_genes_file in batch.LOSS_TYPES:
+		organism_dir = os.path.join(workdir, loss_type, "Synthetic_organism")
+		clustering_dir = os.path.join(organism_dir, "clustering")
+		with open(os.path.join(clustering_dir, "Clusters.txt")) as fl: names = [line.strip() for line in fl if line.strip().endswith("_numeric")]
+		assert names == ["kmeans_numeric", "spectral_numeric"]
+		assert sorted(metabolic_clustering.saved_models(clustering_dir)) == ["kmeans_numeric", "spectral_numeric"]
+		assert not os.path.exists(os.path.join(clustering_dir, ".parts"))
+		with open(os.path.join(organism_dir, "significant_genes.txt")) as fl: content = fl.read().split("\n")
+		assert content[:2] == ["Synthetic_organism", "patients"] and "genes" in content
+		assert os.path.isfile(os.path.join(clustering_dir, "Clusters_properties_report.json"))
+	with open(os.path.join(workdir, "batch_report.json")) as fl: stages = [record["stage"] for record in json.load(fl)["stages"]]
+	assert "clusters high Synthetic_organism" in stages and "metabolic enrichment changed Synthetic_organism" in stages
@@ -0,0 +1,75 @@
+import sys
+import random
+import pytest
+import numpy as np
+import enrichment
+
+def continuous_cohort(patients=200, seed=3):
+	"""
+	Genes, pathways and lost fractions drawn from a continuous range, like fractions of real lost genes files
+	"""
+	random_state = np.random.RandomState(seed)
+	genes = ["gene_%d" % n for n in range(300)]
+	pathways = dict(("pathway_%d" % n, [str(gene) for gene in random_state.choice(genes, size, replace=False)]) for n, size in enumerate([5, 12, 25, 40, 60]))
+	#genes that are twice in a pathway
+	pathways["pathway_1"] += pathways["pathway_0"][:2]
+	gene_loss_vector = [list(random_state.uniform(0.05, 1, random_state.randint(3, 11))) for n in range(patients)]
+	return genes, pathways, enrichment.switch_dict(pathways), gene_loss_vector
+
+def test_exact_p_vals_continuous_fractions():
+	genes, pathways, gene_pathway_dict, gene_loss_vector = continuous_cohort()
+	null = enrichment.simulate_null(genes, gene_loss_vector, pathways, gene_pathway_dict, 20000, seed=5)
+	#observed values at the 90th percentile of the simulated null
+	pathway_patients_dict = dict((pathway, float(np.percentile(distribution, 90))) for pathway, distribution in zip(null.pathways, null.patient_distribution))
+	pathway_genes_dict = dict((pathway, float(np.percentile(distribution, 90))) for pathway, distribution in zip(null.pathways, null.genes_distribution))
+	simulated_patient_p_vals, simulated_genes_p_vals = null.p_values(pathway_patients_dict, pathway_genes_dict)
+	patient_p_vals, genes_p_vals = enrichment.exact_p_vals(genes, gene_loss_vector, pathways, gene_pathway_dict, pathway_patients_dict, pathway_genes_dict)
+	for pathway in pathways:
+		assert abs(patient_p_vals[pathway] - simulated_patient_p_vals[pathway]) < 0.015
+		assert abs(genes_p_vals[pathway] - simulated_genes_p_vals[pathway]) < 0.015
+
+def test_adaptive_p_vals_are_never_zero():
+	genes, pathways, gene_pathway_dict, gene_loss_vector = continuous_cohort(patients=40)
+	#observed values that every simulation reaches, and that none reaches
+	pathway_patients_dict = dict((pathway, 0) for pathway in pathways)
+	pathway_genes_dict = dict((pathway, 1e6) for pathway in pathways)
+	patient_p_vals, genes_p_vals, patient_simulations, genes_simulations = enrichment.adaptive_p_vals(genes, gene_loss_vector, pathways, gene_pathway_dict,
+		pathway_patients_dict, pathway_genes_dict, number_of_simulations=2000, exceedances=10, seed=1, first_block=500)
+	for pathway in pathways:
+		#stopped after 10 exceedances in 10 simulations
+		assert patient_simulations[pathway] == 10 and patient_p_vals[pathway] == 1.0
+		assert genes_simulations[pathway] == 2000 and genes_p_vals[pathway] == 1.0 / 2001
+
+#counts of the removed python loop simulate_pathways for random.seed(7), 6 simulations and the pathways and losses of legacy_cohort
+LEGACY_PATIENTS = {"pathway_a": [2, 3, 2, 2, 0, 2], "pathway_b": [3, 3, 1, 2, 2, 2], "pathway_c": [4, 2, 2, 1, 1, 1]}
+LEGACY_GENES = {"pathway_a": [2.25, 2.35, 0.6, 1.25, 0, 1.5], "pathway_b": [2.6, 4.7, 1.0, 1.75, 2.75, 1.75], "pathway_c": [2.5, 2.75, 1.25, 1.1, 1.0, 1.85]}
+#next random.random() after the loop
+LEGACY_NEXT_RANDOM = 0.465601865839674
+
+def legacy_cohort():
+	"""
+	Pathways with a gene listed twice and patients with no lost genes
+	"""
+	genes = ["gene_%d" % n for n in range(40)]
+	pathways = {"pathway_a": genes[0:6], "pathway_b": genes[4:14] + genes[4:6], "pathway_c": genes[20:35]}
+	gene_loss_vector = [[1.0, 0.5], [], [0.25], [1.0, 1.0, 0.75], [0.1, 0.5, 1.0, 0.25]]
+	return genes, pathways, enrichment.switch_dict(pathways), gene_loss_vector
+
+@pytest.mark.skipif(sys.version_info[0] < 3, reason="python 2 random.choice draws another stream")
+def test_vectorized_simulation_matches_legacy_loop():
+	genes, pathways, gene_pathway_dict, gene_loss_vector = legacy_cohort()
+	#seeded runs leave the random module untouched
+	random.seed(1)
+	state = random.getstate()
+	patient_distribution, genes_distribution = enrichment.simulate_pathways_vectorized(genes, gene_loss_vector, pathways, gene_pathway_dict, 6, seed=7)
+	assert random.getstate() == state
+	for pathway in pathways:
+		assert patient_distribution[pathway].tolist() == LEGACY_PATIENTS[pathway]
+		assert np.allclose(genes_distribution[pathway], LEGACY_GENES[pathway])
+	#unseeded runs draw from and advance the random module like the loop
+	random.seed(7)
+	patient_distribution, genes_distribution = enrichment.simulate_pathways_vectorized(genes, gene_loss_vector, pathways, gene_pathway_dict, 6)
+	assert random.random() == LEGACY_NEXT_RANDOM
+	for pathway in pathways:
+		assert patient_distribution[pathway].tolist() == LEGACY_PATIENTS[pathway]
+		assert np.allclose(genes_distribution[pathway], LEGACY_GENES[pathway])
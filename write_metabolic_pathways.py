@@ -7,10 +7,19 @@ Create patient metabolic pathways files, called from command line or python scri
 import sys, os
 import argparse
 import errno
-import create_pathways
-from Bio import SeqIO
-import gzip as gz
-import itertools
+import hashlib
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy import sparse
+import reference_bundle
+import instrumentation
+
+#gene names repeat across patients, keep one copy of each
+try: intern_string = sys.intern
+except AttributeError: intern_string = intern
+#bytes that str.split splits lines on
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[ord(i) for i in " \t\n\r\x0b\x0c"]] = True
 
 def process_call_from_script(argv):
 	command_line_settings = process_command_line(["-p", "/home/hosts/disk20/metabolic_pathways/map_title.tab"])
@@ -54,10 +63,30 @@ def process_command_line(argv):
 		'--skip', action='store_true', default=False,
 		help='Get existing files if already written.')
 
+	parser.add_argument(
+		'--incremental', action='store_true', default=False,
+		help='Only recompute patients whose lost genes file changed since the last run.')
+
+	parser.add_argument(
+		'--per_patient_files', action='store_true', default=False,
+		help='Also write pathways.txt and pathways_full.txt to every patient directory, results are always written to pathways_matrix.npz in workdir.')
+
+	parser.add_argument(
+		'--readers', type=int, default=8,
+		help='Number of threads reading lost genes files.')
+
 	parser.add_argument(
 		'-p', '--pathway_descriptions', default= "/home/hosts/disk20/metabolic_pathways/map_title.tab",
 		help='Kegg list of pathways and their descriptions.')
 
+	parser.add_argument(
+		'--profile', action='store_true', default=False,
+		help='Write cProfile stats of each stage next to the timing report.')
+
+	parser.add_argument(
+		'--trace_memory', action='store_true', default=False,
+		help='Record peak traced memory of each stage in the timing report, slows the run.')
+
 	parser.add_argument(# customized description; put --help last
 		'-h', '--help', action='help',
 		help='Show this help message and exit.')
@@ -75,60 +104,356 @@ def mkdir(path):
 			raise exc
 			pass
 
-def count_lost(lost_genes_files, pathways, metabolic_proteins, metabolic=False):
+def line_columns(content, lines):
+	"""
+	Number of whitespace separated columns in each of lines lines of content
+	"""
+	raw = np.frombuffer(content if isinstance(content, bytes) else content.encode("utf-8"), dtype=np.uint8)
+	space = WHITESPACE[raw]
+	starts = ~space & np.concatenate(([True], space[:-1]))
+	newlines = raw == ord("\n")
+	#line of each byte, a newline belongs to the line it ends
+	line_ids = np.cumsum(newlines) - newlines
+	#return
+	return np.bincount(line_ids[starts], minlength=lines)
+
+def parse_lost_genes_file(patient_lost_file):
+	"""
+	Parse lost genes file of a patient to interned gene names and fractions, gene is the first column and fraction the third
+	Files with the same number of columns in every line are split in bulk, other files line by line
+	"""
+	with open(patient_lost_file) as fl: content = fl.read()
+	tokens = content.split()
+	if not tokens: return [], np.zeros(0, dtype=np.float64)
+	#fast path: every line has as many columns as the first one
+	columns = len(content[:content.find("\n")].split()) if "\n" in content else len(tokens)
+	lines = content.count("\n") + (not content.endswith("\n"))
+	if columns >= 3 and len(tokens) == columns * lines and (line_columns(content, lines) == columns).all():
+		genes = [intern_string(gene) for gene in tokens[0::columns]]
+		fractions = np.array(tokens[2::columns], dtype=np.float64)
+	#otherwise go line by line, skipping empty lines
+	else:
+		genes = []
+		fractions = []
+		for i in content.splitlines():
+			gene = i.strip().split()
+			if not gene: continue
+			genes.append(intern_string(gene[0]))
+			fractions.append(float(gene[2]))
+		fractions = np.array(fractions, dtype=np.float64)
+	#return
+	return genes, fractions
+
+def read_lost_genes(lost_genes_files, readers=8):
+	"""
+	Parse lost genes files of all patients to patient names, gene names and one (patient, gene, fraction) entry for each line
+	Files are read by a pool of readers threads
+	"""
+	#define patient names
+	patients = [os.path.basename(os.path.dirname(patient_lost_file)) for patient_lost_file in lost_genes_files]
+	for n, patient in enumerate(patients):
+		if patient in patients[:n]: raise Exception("Patient %s appears twice in files" % patient)
+	#read files in parallel, results are in files order
+	with instrumentation.stage("read_lost_genes", files=len(lost_genes_files), readers=readers):
+		if readers > 1 and len(lost_genes_files) > 1:
+			pool = ThreadPool(min(readers, len(lost_genes_files)))
+			try: parsed = pool.map(parse_lost_genes_file, lost_genes_files)
+			finally:
+				pool.close()
+				pool.join()
+		else: parsed = [parse_lost_genes_file(patient_lost_file) for patient_lost_file in lost_genes_files]
+	#index genes in order of first appearance
+	gene_index = {}
+	columns = []
+	for genes, fractions in parsed:
+		for gene in genes:
+			if gene not in gene_index: gene_index[gene] = len(gene_index)
+		columns.append(np.array([gene_index[gene] for gene in genes], dtype=np.int64))
+	genes = sorted(gene_index, key=gene_index.get)
+	rows = np.repeat(np.arange(len(parsed), dtype=np.int64), [len(i[1]) for i in parsed])
+	#return
+	return patients, genes, rows, np.concatenate(columns + [np.zeros(0, dtype=np.int64)]), np.concatenate([i[1] for i in parsed] + [np.zeros(0, dtype=np.float64)])
+
+def pathway_membership(pathways, genes):
+	"""
+	Sparse gene x pathway matrix, 1 if the gene is in the pathway
+	"""
+	gene_index = dict((gene, n) for n, gene in enumerate(genes))
+	rows = []
+	columns = []
+	for n, pathway in enumerate(pathways):
+		for gene in set(pathways[pathway]):
+			if gene in gene_index:
+				rows.append(gene_index[gene])
+				columns.append(n)
+	#return
+	return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(genes), len(pathways)))
+
+def count_pathways(lost_genes, membership, gene_mask=None):
+	"""
+	Count how many time each pathway was affected in each patient as patient x pathway arrays:
+	1. If it was affected (0 or 1)
+	2. Sum of gene damage
+	Only genes in gene_mask are counted if it is given
+	"""
+	patients, genes, rows, columns, fractions = lost_genes
+	#keep only masked genes
+	if gene_mask is not None:
+		keep = gene_mask[columns]
+		rows, columns, fractions = rows[keep], columns[keep], fractions[keep]
+	#patient x gene matrices times gene x pathway matrix
+	damage = sparse.csr_matrix((fractions, (rows, columns)), shape=(len(patients), len(genes))) * membership
+	lost = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(patients), len(genes))) * membership
+	#return
+	return (lost.toarray() > 0).astype(np.int8), damage.toarray()
+
+def loss_vectors(lost_genes, gene_mask=None):
+	"""
+	Get list of lost fractions of each patient, only for genes in gene_mask if it is given
+	"""
+	patients, genes, rows, columns, fractions = lost_genes
+	if gene_mask is not None:
+		keep = gene_mask[columns]
+		rows, fractions = rows[keep], fractions[keep]
+	#split by patient, entries are in patient order
+	offsets = np.searchsorted(rows, np.arange(len(patients) + 1))
+	#return
+	return [fractions[offsets[n]:offsets[n + 1]].tolist() for n in range(len(patients))]
+
+def pathway_dicts(patients, pathways, lost, damage):
+	"""
+	Convert patient x pathway arrays to the pathway and per patient dicts, gene damage is normalized by pathway size for the patient dicts
+	"""
+	pathway_list = list(pathways)
+	normalization_factors = np.array([len(pathways[pathway]) for pathway in pathway_list], dtype=np.float64)
+	normalized_damage = damage / normalization_factors
+	#unaffected pathways are integer zeros
+	clustering_patients_dict = {}
+	clustering_genes_dict = {}
+	for n, patient in enumerate(patients):
+		clustering_patients_dict[patient] = dict(zip(pathway_list, lost[n].tolist()))
+		clustering_genes_dict[patient] = dict(zip(pathway_list, [i if i else 0 for i in normalized_damage[n].tolist()]))
+	pathway_patients_dict = dict(zip(pathway_list, lost.sum(axis=0).tolist()))
+	pathway_genes_dict = dict(zip(pathway_list, [i if i else 0 for i in damage.sum(axis=0).tolist()]))
+	#return
+	return pathway_patients_dict, pathway_genes_dict, clustering_patients_dict, clustering_genes_dict
+
+def count_lost(lost_genes_files, pathways, metabolic_proteins, metabolic=False, readers=8):
 	"""
 	Count how many time each pathway was affected in two ways:
 	1. In how many patients
 	2. How many genes
 	"""
-	#initialize dicts
-	pathway_patients_dict = {}
-	pathway_genes_dict = {}
-	gene_loss_vector = []
-	#for clustering
-	clustering_patients_dict = {}
-	clustering_genes_dict = {}
-	#initialize all pathways
+	lost_genes = read_lost_genes(lost_genes_files, readers)
+	membership = pathway_membership(pathways, lost_genes[1])
+	#metabolic mode only looks at metabolic genes
+	if metabolic:
+		metabolic_proteins = set(metabolic_proteins)
+		gene_mask = np.array([gene in metabolic_proteins for gene in lost_genes[1]], dtype=bool)
+	else: gene_mask = None
+	lost, damage = count_pathways(lost_genes, membership, gene_mask)
+	pathway_patients_dict, pathway_genes_dict, clustering_patients_dict, clustering_genes_dict = pathway_dicts(lost_genes[0], pathways, lost, damage)
+	#return
+	return pathway_patients_dict, pathway_genes_dict, loss_vectors(lost_genes, gene_mask), clustering_patients_dict, clustering_genes_dict
+
+def count_cohort(lost_genes_files, pathways, metabolic_proteins, readers=8):
+	"""
+	Count how many times each pathway was affected for all patients, in all genes and in metabolic genes only
+	Return patients, patient x pathway lost and damage arrays and gene loss vectors of all genes and metabolic genes
+	"""
+	lost_genes = read_lost_genes(lost_genes_files, readers)
+	membership = pathway_membership(pathways, lost_genes[1])
+	metabolic_proteins = set(metabolic_proteins)
+	metabolic_genes = np.array([gene in metabolic_proteins for gene in lost_genes[1]], dtype=bool)
+	lost, damage = count_pathways(lost_genes, membership)
+	#metabolic mode only looks at metabolic genes and must give the same counts
+	metabolic_lost, metabolic_damage = count_pathways(lost_genes, membership, metabolic_genes)
+	if not np.array_equal(metabolic_lost, lost) or not np.array_equal(metabolic_damage, damage): raise Exception("Something is weird in the behaviour of metaboilc mode. Results differ from baseline.")
+	#return
+	return lost_genes[0], lost, damage, loss_vectors(lost_genes), loss_vectors(lost_genes, metabolic_genes)
+
+def pathways_signature(pathways):
+	"""
+	Hash of pathways and their genes, cached patient results are only valid for the same pathways
+	"""
+	signature = hashlib.sha1()
 	for pathway in pathways:
-		pathway_patients_dict[pathway] = 0
-		pathway_genes_dict[pathway] = 0
-	#iterate through lost files
-	for patient_lost_file in lost_genes_files:
-		#define patient name
-		patient = os.path.basename(os.path.dirname(patient_lost_file))
-		#initialize clustering dict patient entry
-		if patient in clustering_patients_dict: raise Exception("Patient %s appears twice in files" % patient)
-		clustering_patients_dict[patient] = {}
-		clustering_genes_dict[patient] = {}
-		#parse lost genes from file
-		with open(patient_lost_file) as fl:
-			patient_genes = []
-			for i in fl.readlines():
-				gene = i.strip().split()
-				if not metabolic or gene[0] in metabolic_proteins: patient_genes.append(gene)
-			#add to vector
-			gene_loss_vector.append([float(i[2]) for i in patient_genes])
-		#iterate through pathways and see what genes they lost
-		for pathway in pathways:
-			normalization_factor = len(pathways[pathway])
-			clustering_genes_dict[patient][pathway] = 0
-			clustering_patients_dict[patient][pathway] = 0
-			#flag symbolizing gene in pathways affected already
-			patient_pathway_flag = 0
-			#iterate through genes
-			for gene in patient_genes:
-				#check if gene in pathway
-				if gene[0] in pathways[pathway]: #gene[0].split(".")[0]
-					#add gene damage
-					pathway_genes_dict[pathway] += float(gene[2])
-					clustering_genes_dict[patient][pathway] += float(gene[2]) / normalization_factor
-					#add to patient if not counted yet
-					if patient_pathway_flag == 0:
-						pathway_patients_dict[pathway] += 1
-						clustering_patients_dict[patient][pathway] += 1
-						patient_pathway_flag = 1
-	#return
-	return pathway_patients_dict, pathway_genes_dict, gene_loss_vector, clustering_patients_dict, clustering_genes_dict
+		signature.update(("%s\t%s\n" % (pathway, " ".join(pathways[pathway]))).encode("utf-8"))
+	#return
+	return signature.hexdigest()
+
+def lost_genes_hash(patient_lost_file, signature):
+	"""
+	Content hash of a lost genes file together with the pathways signature
+	"""
+	with open(patient_lost_file, "rb") as fl: content = fl.read()
+	return hashlib.sha1(content + signature.encode("utf-8")).hexdigest()
+
+def file_stamps(files):
+	"""
+	Get path, size and modification time of files
+	"""
+	stamps = []
+	for path in files:
+		stat = os.stat(path)
+		stamps.append((os.path.abspath(path), stat.st_size, stat.st_mtime))
+	#return
+	return stamps
+
+def lost_genes_hashes(lost_genes_files, signature, readers=8, store=None, stamps=None):
+	"""
+	Content hashes of all lost genes files, read by a pool of readers threads
+	Files with the path, size and modification time stamped in the store of the same pathways signature keep their stored hash without being read
+	"""
+	if stamps is None: stamps = file_stamps(lost_genes_files)
+	known = {}
+	if store is not None and "signature" in store and str(store["signature"]) == signature:
+		for path, size, mtime, content_hash in zip(store["files"], store["sizes"], store["mtimes"], store["hashes"]): known[(str(path), int(size), float(mtime))] = str(content_hash)
+	hashes = [known.get(stamp) for stamp in stamps]
+	unread = [lost_genes_files[n] for n in range(len(hashes)) if hashes[n] is None]
+	if readers <= 1 or len(unread) <= 1: read_hashes = [lost_genes_hash(patient_lost_file, signature) for patient_lost_file in unread]
+	else:
+		pool = ThreadPool(min(readers, len(unread)))
+		try: read_hashes = pool.map(lambda patient_lost_file: lost_genes_hash(patient_lost_file, signature), unread)
+		finally:
+			pool.close()
+			pool.join()
+	read_hashes = iter(read_hashes)
+	#return
+	return [content_hash if content_hash is not None else next(read_hashes) for content_hash in hashes]
+
+def ragged(vectors):
+	"""
+	Concatenate list of lists to values and offsets arrays, list n is values[offsets[n]:offsets[n + 1]]
+	"""
+	offsets = np.zeros(len(vectors) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum([len(i) for i in vectors])
+	values = np.array([j for i in vectors for j in i], dtype=np.float64)
+	#return
+	return values, offsets
+
+class LossVector(object):
+	"""
+	Gene loss vectors of a cohort as values and offsets arrays, patient n lost genes with fractions values[offsets[n]:offsets[n + 1]]
+	"""
+	def __init__(self, values, offsets):
+		"""
+		Initialize object from values and offsets arrays, arrays may be memory mapped
+		"""
+		self.values = values
+		self.offsets = offsets
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, n):
+		return self.values[self.offsets[n]:self.offsets[n + 1]]
+
+	def __iter__(self):
+		for n in range(len(self)): yield self[n]
+
+	def lengths(self):
+		"""
+		Number of lost genes of each patient
+		"""
+		return np.diff(self.offsets)
+
+def loss_vector_file(workdir, metabolic=False):
+	"""
+	File of the gene loss vector of an organism and loss type
+	"""
+	if metabolic: name = "metabolic_gene_loss_vector"
+	else: name = "gene_loss_vector"
+	return os.path.join(workdir, "%s.npy" % name)
+
+def write_loss_vector(workdir, vectors, metabolic=False):
+	"""
+	Write gene loss vector as one array of the number of offsets, the offsets and the values, so its values and offsets always match
+	The array is written to a temporary file and renamed, so processes memory mapping it never see a partial vector
+	"""
+	values, offsets = ragged(vectors)
+	temporary_file = "%s.%s.tmp" % (loss_vector_file(workdir, metabolic), os.getpid())
+	with open(temporary_file, "wb") as outfl: np.save(outfl, np.concatenate(([len(offsets)], offsets, values)).astype(np.float64))
+	os.rename(temporary_file, loss_vector_file(workdir, metabolic))
+
+def read_loss_vector(workdir, metabolic=False):
+	"""
+	Memory map gene loss vector written by write_loss_vector as LossVector, offsets are copied and values are memory mapped
+	"""
+	array = np.load(loss_vector_file(workdir, metabolic), mmap_mode="r")
+	number_of_offsets = int(array[0])
+	#return
+	return LossVector(array[number_of_offsets + 1:], np.array(array[1:number_of_offsets + 1], dtype=np.int64))
+
+def store_file(workdir):
+	"""
+	Cohort store of an organism and loss type
+	"""
+	return os.path.join(workdir, "pathways_matrix.npz")
+
+def read_store(workdir):
+	"""
+	Read cohort store written by write_store as dict of arrays, None if there is no store
+	"""
+	if not os.path.isfile(store_file(workdir)): return None
+	with np.load(store_file(workdir)) as store:
+		return dict((name, store[name]) for name in store.files)
+
+def write_store(workdir, patients, hashes, pathways, lost, damage, gene_loss_vector, metabolic_gene_loss_vector, stamps, signature):
+	"""
+	Write the cohort store: patient and pathway index, patient x pathway binary (pathways.txt) and normalized gene damage (pathways_full.txt) matrices,
+	raw gene damage, content hashes and stamps of lost genes files and gene loss vectors, so later runs can reuse unchanged patients
+	"""
+	pathway_list = list(pathways)
+	normalization_factors = np.array([len(pathways[pathway]) for pathway in pathway_list], dtype=np.float64)
+	loss_values, loss_offsets = ragged(gene_loss_vector)
+	metabolic_loss_values, metabolic_loss_offsets = ragged(metabolic_gene_loss_vector)
+	#write through a temporary file so a partial store is never read
+	mkdir(workdir)
+	temporary_file = "%s.%s.tmp" % (store_file(workdir), os.getpid())
+	with open(temporary_file, "wb") as outfl:
+		np.savez(outfl, patients=np.array([u"%s" % i for i in patients], dtype=np.str_), hashes=np.array(hashes, dtype=np.str_), pathways=np.array([u"%s" % i for i in pathway_list], dtype=np.str_),
+			binary=lost.astype(np.int8), full=damage / normalization_factors, damage=damage,
+			loss_values=loss_values, loss_offsets=loss_offsets, metabolic_loss_values=metabolic_loss_values, metabolic_loss_offsets=metabolic_loss_offsets,
+			files=np.array([u"%s" % i[0] for i in stamps], dtype=np.str_), sizes=np.array([i[1] for i in stamps], dtype=np.int64), mtimes=np.array([i[2] for i in stamps], dtype=np.float64), signature=np.array(signature))
+	os.rename(temporary_file, store_file(workdir))
+
+def count_cohort_incremental(lost_genes_files, hashes, pathways, metabolic_proteins, store, readers=8):
+	"""
+	Same as count_cohort, but patients whose lost genes file and pathways did not change since the store was written are taken from the store
+	Also return the lost genes files that were recomputed
+	"""
+	#patients must be unique
+	patients = [os.path.basename(os.path.dirname(patient_lost_file)) for patient_lost_file in lost_genes_files]
+	for n, patient in enumerate(patients):
+		if patient in patients[:n]: raise Exception("Patient %s appears twice in files" % patient)
+	#find stored patients with the same hash
+	stored = {}
+	if store is not None and list(store["pathways"]) == list(pathways):
+		for n, (patient, content_hash) in enumerate(zip(store["patients"], store["hashes"])): stored[(str(patient), str(content_hash))] = n
+	rows = [stored.get((patient, content_hash)) for patient, content_hash in zip(patients, hashes)]
+	changed = [n for n in range(len(patients)) if rows[n] is None]
+	#initialize from store
+	lost = np.zeros((len(patients), len(pathways)), dtype=np.int8)
+	damage = np.zeros((len(patients), len(pathways)), dtype=np.float64)
+	gene_loss_vector = [None] * len(patients)
+	metabolic_gene_loss_vector = [None] * len(patients)
+	for n, row in enumerate(rows):
+		if row is None: continue
+		lost[n] = store["binary"][row]
+		damage[n] = store["damage"][row]
+		gene_loss_vector[n] = store["loss_values"][store["loss_offsets"][row]:store["loss_offsets"][row + 1]].tolist()
+		metabolic_gene_loss_vector[n] = store["metabolic_loss_values"][store["metabolic_loss_offsets"][row]:store["metabolic_loss_offsets"][row + 1]].tolist()
+	#recompute new and changed patients
+	if changed:
+		changed_patients, changed_lost, changed_damage, changed_gene_loss_vector, changed_metabolic_gene_loss_vector = count_cohort([lost_genes_files[n] for n in changed], pathways, metabolic_proteins, readers)
+		lost[changed] = changed_lost
+		damage[changed] = changed_damage
+		for i, n in enumerate(changed):
+			gene_loss_vector[n] = changed_gene_loss_vector[i]
+			metabolic_gene_loss_vector[n] = changed_metabolic_gene_loss_vector[i]
+	#return
+	return patients, lost, damage, gene_loss_vector, metabolic_gene_loss_vector, [lost_genes_files[n] for n in changed]
 
 def write_results(workdir, lost_genes_files, clustering_patients_dict, clustering_genes_dict, pathway_patients_dict, pathway_genes_dict, gene_loss_vector, metabolic_gene_loss_vector):
 	"""
@@ -156,12 +481,8 @@ def write_results(workdir, lost_genes_files, clustering_patients_dict, clusterin
 	#pathway results
 	#make directory for bacteria if it doesn't exist
 	mkdir(workdir)
-	with open(os.path.join(workdir,"gene_loss_vector.txt"), "w") as outfl:
-		for i in gene_loss_vector:
-			outfl.write(str(i) + "\n")
-	with open(os.path.join(workdir,"metabolic_gene_loss_vector.txt"), "w") as outfl:
-		for i in gene_loss_vector:
-			outfl.write(str(i) + "\n")
+	write_loss_vector(workdir, gene_loss_vector)
+	write_loss_vector(workdir, metabolic_gene_loss_vector, metabolic=True)
 	with open(os.path.join(workdir,"pathways_patients.txt"), "w") as outfl:
 		for pathway in pathway_patients_dict:
 			line = pathway + "\t" + str(pathway_patients_dict[pathway]) + "\n"
@@ -172,9 +493,11 @@ def write_results(workdir, lost_genes_files, clustering_patients_dict, clusterin
 			outfl.write(line)
 
 
-def filter_skipped(workdir, lost_genes_files,skip):
-	#remove skipped patients from lost genes_files if skip==True
+def filter_skipped(workdir, lost_genes_files,skip, store=None):
+	#remove skipped patients from lost genes_files if skip==True, patients in the cohort store are skipped too
 	if not skip: return lost_genes_files
+	if store is not None: stored_patients = set([str(i) for i in store["patients"]])
+	else: stored_patients = set()
 	#get patient workdir
 	name = os.path.basename(os.path.dirname(os.path.dirname(workdir)))
 	#initialize non-skipped
@@ -184,6 +507,7 @@ def filter_skipped(workdir, lost_genes_files,skip):
 		patient_dir = os.path.dirname(patient_lost_file)
 		metabolics_dir = os.path.join(patient_dir,name)
 		#if no directory patient is not to be skipped
+		if os.path.basename(patient_dir) in stored_patients: continue
 		if not os.path.isdir(metabolics_dir) or not os.path.isfile(os.path.join(metabolics_dir,"pathways.txt")):
 			lost_genes_files_nonskipped.append(patient_lost_file)
 	#return
@@ -193,28 +517,45 @@ def main(argv=None):
 	#process command line
 	if argv == None: settings = process_command_line(argv)
 	else: settings = process_call_from_script(argv)
+	#record stages
+	with instrumentation.recording(os.path.join(settings.workdir, "write_metabolic_pathways_report.json"), settings.profile, settings.trace_memory):
+		return write_pathways(settings)
+
+def write_pathways(settings):
+	"""
+	Count affected pathways of all patients and write results
+	"""
 	#filter skipped
-	write_lost_genes_files = filter_skipped(settings.workdir, settings.lost_genes_files, settings.skip)
+	with instrumentation.stage("filter_skipped"):
+		store = read_store(settings.workdir)
+		write_lost_genes_files = filter_skipped(settings.workdir, settings.lost_genes_files, settings.skip, store)
 	#skip if no patients are left
-	if len(write_lost_genes_files) == 0 and os.path.isfile(os.path.join(settings.workdir,"metabolic_gene_loss_vector.txt")): return 0
+	if len(write_lost_genes_files) == 0 and store is not None and os.path.isfile(loss_vector_file(settings.workdir, metabolic=True)): return 0
 	#otherwise calculate how many times each pathway is affected for all patients and write files for the ones that are not to be skipped
-	#list files in reference directory
-	onlyfiles = [os.path.join(settings.reference_directory, f) for f in os.listdir(settings.reference_directory) if os.path.isfile(os.path.join(settings.reference_directory, f))]
-	#get ncbi files
-	cds_file = [i for i in onlyfiles if i.endswith("_cds_from_genomic.fna.gz")][0]
-	rna_file = [i for i in onlyfiles if i.endswith("_rna_from_genomic.fna.gz")][0]
-	protein_file = [i for i in onlyfiles if i.endswith("_protein.faa.gz")][0]
-	#get pathways
-	pathways, cds_dict = create_pathways.main([settings.kegg_file, cds_file, rna_file])
-	#get list of metabolic proteins
-	pathway_proteins = pathways.values()
-	metabolic_proteins = list(set(itertools.chain.from_iterable(pathway_proteins)))
+	#get pathways and list of metabolic proteins, parsed once per reference directory
+	bundle = reference_bundle.load_bundle(settings.reference_directory, settings.kegg_file, settings.pathway_descriptions)
+	pathways = bundle.pathways()
+	metabolic_proteins = bundle.metabolic_proteins()
+	#content hashes of lost genes files are stored for incremental runs, files are only read if their stamps changed
+	with instrumentation.stage("hashes", files=len(settings.lost_genes_files)):
+		signature = pathways_signature(pathways)
+		stamps = file_stamps(settings.lost_genes_files)
+		hashes = lost_genes_hashes(settings.lost_genes_files, signature, settings.readers, store, stamps)
 	#count how many times each pathway was affected in two ways: number of patients and number of genes
-	metabolic_pathway_patients_dict, metabolic_pathway_genes_dict, metabolic_gene_loss_vector, metabolic_clustering_patients_dict, metabolic_clustering_genes_dict = count_lost(settings.lost_genes_files, pathways, metabolic_proteins, metabolic=True)
-	pathway_patients_dict, pathway_genes_dict, gene_loss_vector, clustering_patients_dict, clustering_genes_dict = count_lost(settings.lost_genes_files, pathways, metabolic_proteins, metabolic=False)
-	if metabolic_pathway_genes_dict != pathway_genes_dict or metabolic_clustering_genes_dict != clustering_genes_dict or metabolic_clustering_patients_dict != clustering_patients_dict or metabolic_pathway_patients_dict != pathway_patients_dict: raise Exception("Something is weird in the behaviour of metaboilc mode. Results differ from baseline.")
-	#write results
-	write_results(settings.workdir, write_lost_genes_files, clustering_patients_dict, clustering_genes_dict, pathway_patients_dict, pathway_genes_dict, gene_loss_vector, metabolic_gene_loss_vector)
+	with instrumentation.stage("count_lost", incremental=settings.incremental) as details:
+		if settings.incremental:
+			patients, lost, damage, gene_loss_vector, metabolic_gene_loss_vector, changed_files = count_cohort_incremental(settings.lost_genes_files, hashes, pathways, metabolic_proteins, store, settings.readers)
+			details["recomputed"] = len(changed_files)
+			#unchanged patients already have their files
+			name = os.path.basename(os.path.dirname(os.path.dirname(settings.workdir)))
+			write_lost_genes_files = [i for i in write_lost_genes_files if i in changed_files or not os.path.isfile(os.path.join(os.path.dirname(i), name, "pathways.txt"))]
+		else: patients, lost, damage, gene_loss_vector, metabolic_gene_loss_vector = count_cohort(settings.lost_genes_files, pathways, metabolic_proteins, settings.readers)
+		pathway_patients_dict, pathway_genes_dict, clustering_patients_dict, clustering_genes_dict = pathway_dicts(patients, pathways, lost, damage)
+	#write results, per patient files only if asked for
+	if not settings.per_patient_files: write_lost_genes_files = []
+	with instrumentation.stage("write_results", patients=len(write_lost_genes_files)):
+		write_results(settings.workdir, write_lost_genes_files, clustering_patients_dict, clustering_genes_dict, pathway_patients_dict, pathway_genes_dict, gene_loss_vector, metabolic_gene_loss_vector)
+		write_store(settings.workdir, patients, hashes, pathways, lost, damage, gene_loss_vector, metabolic_gene_loss_vector, stamps, signature)
 
 if __name__ == "__main__":
 		exit(main())